@@ -18,19 +18,24 @@ const TerminalScreen = () => {
 
   useEffect(() => {
     fetchOutput();
-    const interval = setInterval(fetchOutput, 1500);
-    return () => clearInterval(interval);
+    return ApiService.subscribeEvents({
+      terminal: (line) => appendOutput([line]),
+    });
   }, []);
 
+  const appendOutput = (lines) => {
+    setOutput(prev => [...prev, ...lines]);
+    // Auto-scroll to bottom
+    setTimeout(() => {
+      scrollViewRef.current?.scrollToEnd({ animated: true });
+    }, 100);
+  };
+
   const fetchOutput = async () => {
     try {
       const response = await ApiService.getTerminalOutput();
       if (response.output && response.output.length > 0) {
-        setOutput(prev => [...prev, ...response.output]);
-        // Auto-scroll to bottom
-        setTimeout(() => {
-          scrollViewRef.current?.scrollToEnd({ animated: true });
-        }, 100);
+        appendOutput(response.output);
       }
     } catch (error) {
       console.error('Failed to fetch terminal output:', error);
@@ -35,8 +35,9 @@ const VMControlScreen = () => {
   useEffect(() => {
     loadDefaults();
     updateVmStatus();
-    const interval = setInterval(updateVmStatus, 5000);
-    return () => clearInterval(interval);
+    return ApiService.subscribeEvents({
+      vm_status: (status) => setVmStatus(status.running ? 'Running' : 'Stopped'),
+    });
   }, []);
 
   const loadDefaults = async () => {
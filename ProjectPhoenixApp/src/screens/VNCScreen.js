@@ -17,8 +17,9 @@ const VNCScreen = () => {
 
   useEffect(() => {
     updateVmStatus();
-    const interval = setInterval(updateVmStatus, 5000);
-    return () => clearInterval(interval);
+    return ApiService.subscribeEvents({
+      vm_status: (status) => setVmStatus(status.running ? 'Running' : 'Stopped'),
+    });
   }, []);
 
   const updateVmStatus = async () => {
@@ -1,5 +1,9 @@
 import AsyncStorage from '@react-native-async-storage/async-storage';
 
+// xhr.responseText keeps everything the event stream has sent, so the
+// request is replaced once this much has been read
+const EVENT_STREAM_MAX_BYTES = 4 * 1024 * 1024;
+
 class ApiService {
   constructor() {
     this.baseUrl = 'https://localhost:5000';
@@ -51,8 +55,12 @@ class ApiService {
     }
   }
 
-  async getVmStatus() {
-    return this.makeRequest('/vm_status');
+  async getVmStatus(vmId = 'default') {
+    return this.makeRequest(`/vm_status?vm_id=${vmId}`);
+  }
+
+  async listVMs() {
+    return this.makeRequest('/vms');
   }
 
   async startVM(config) {
@@ -62,9 +70,10 @@ class ApiService {
     });
   }
 
-  async stopVM() {
+  async stopVM(vmId = 'default') {
     return this.makeRequest('/stop_vm', {
       method: 'POST',
+      body: JSON.stringify({ vm_id: vmId }),
     });
   }
 
@@ -72,8 +81,8 @@ class ApiService {
     return this.makeRequest('/get_defaults');
   }
 
-  async getQemuLogs() {
-    return this.makeRequest('/qemu_logs');
+  async getQemuLogs(since = 0, vmId = 'default') {
+    return this.makeRequest(`/qemu_logs?vm_id=${vmId}&since=${since}`);
   }
 
   async runTerminalCommand(command) {
@@ -83,8 +92,118 @@ class ApiService {
     });
   }
 
-  async getTerminalOutput() {
-    return this.makeRequest('/get_terminal_output');
+  async getTerminalOutput(since = 0) {
+    return this.makeRequest(`/get_terminal_output?since=${since}`);
+  }
+
+  async getJob(jobId, since = 0) {
+    return this.makeRequest(`/jobs/${jobId}?since=${since}`);
+  }
+
+  async cancelJob(jobId) {
+    return this.makeRequest(`/jobs/${jobId}`, {
+      method: 'DELETE',
+    });
+  }
+
+  // Fetch several UI sections in one round-trip. cursors holds logs/terminal/
+  // metrics positions from the previous response's `next` values; pass that
+  // response's etag and wait > 0 to long-poll. Resolves to
+  // { notModified, etag, data } - data is null on a 304.
+  async getDashboard({ vmId = 'default', sections = ['status', 'logs', 'terminal'], cursors = {}, wait = 0 } = {}, etag = null) {
+    await this.loadServerUrl();
+    const params = [`vm_id=${vmId}`, `sections=${sections.join(',')}`, `wait=${wait}`];
+    Object.entries(cursors).forEach(([name, since]) => params.push(`${name}_since=${since}`));
+    const response = await fetch(`${this.baseUrl}/dashboard?${params.join('&')}`, {
+      headers: etag ? { 'If-None-Match': etag } : {},
+    });
+    if (response.status === 304) {
+      return { notModified: true, etag, data: null };
+    }
+    const data = await response.json();
+    if (!response.ok) {
+      throw new Error(data.message || `HTTP error! status: ${response.status}`);
+    }
+    return { notModified: false, etag: response.headers.get('ETag'), data };
+  }
+
+  // Subscribe to the server's /events stream (Server-Sent Events).
+  // handlers maps event types (qemu_log, terminal, vm_status) to callbacks;
+  // VM events are limited to vmId.
+  // React Native has no EventSource, so the stream is read incrementally
+  // through XMLHttpRequest progress events. Reconnects resume from the last
+  // received event id, as does the periodic reconnect that keeps
+  // responseText from growing without bound. Returns a function that closes
+  // the subscription.
+  subscribeEvents(handlers, types = Object.keys(handlers), vmId = 'default') {
+    let xhr = null;
+    let closed = false;
+    let lastEventId = null;
+    let retryMs = 3000;
+    let reconnectTimer = null;
+
+    const dispatch = (block) => {
+      let eventType = 'message';
+      let data = '';
+      block.split('\n').forEach(line => {
+        if (line.startsWith('id: ')) {
+          lastEventId = parseInt(line.slice(4), 10);
+        } else if (line.startsWith('event: ')) {
+          eventType = line.slice(7);
+        } else if (line.startsWith('data: ')) {
+          data += line.slice(6);
+        } else if (line.startsWith('retry: ')) {
+          retryMs = parseInt(line.slice(7), 10);
+        }
+      });
+      if (data && handlers[eventType]) {
+        handlers[eventType](JSON.parse(data));
+      }
+    };
+
+    const connect = async () => {
+      await this.loadServerUrl();
+      if (closed) {
+        return;
+      }
+
+      let consumed = 0;
+      xhr = new XMLHttpRequest();
+      const resume = lastEventId !== null ? `&last_event_id=${lastEventId}` : '';
+      xhr.open('GET', `${this.baseUrl}/events?types=${types.join(',')}&vm_id=${vmId}${resume}`);
+      xhr.setRequestHeader('Accept', 'text/event-stream');
+      xhr.onprogress = () => {
+        const text = xhr.responseText;
+        let end = text.indexOf('\n\n', consumed);
+        while (end !== -1) {
+          dispatch(text.slice(consumed, end));
+          consumed = end + 2;
+          end = text.indexOf('\n\n', consumed);
+        }
+        if (consumed > EVENT_STREAM_MAX_BYTES && !closed) {
+          xhr.onprogress = null;
+          xhr.onloadend = null;
+          xhr.abort();
+          connect();
+        }
+      };
+      xhr.onloadend = () => {
+        if (!closed) {
+          reconnectTimer = setTimeout(connect, retryMs);
+        }
+      };
+      xhr.send();
+    };
+
+    connect();
+
+    return () => {
+      closed = true;
+      clearTimeout(reconnectTimer);
+      if (xhr) {
+        xhr.abort();
+      }
+    };
   }
 }
 
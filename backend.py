@@ -5,14 +5,43 @@ Flask REST API server for controlling QEMU virtual machines from mobile app
 """
 
 import os
-import subprocess
+import sys
+import shlex
+import asyncio
 import threading
 import time
-import queue
 import re
 import ssl
-from flask import Flask, request, jsonify
+import json
+import math
+import collections
+import socket
+import tempfile
+import urllib.parse
+import uuid
+import codecs
+import fcntl
+import select
+import struct
+import signal
+import termios
+import hashlib
+import itertools
+import bisect
+import atexit
+import datetime
+import gzip
+import mmap
+import platform
+import ctypes
+import shutil
+import errno
+import concurrent.futures
+import psutil
+from flask import Flask, request, jsonify, Response, stream_with_context, g, send_file
 from flask_cors import CORS
+from werkzeug.http import http_date, parse_range_header
+from werkzeug.wsgi import FileWrapper
 
 app = Flask(__name__)
 CORS(app)
@@ -27,408 +56,7165 @@ DEFAULT_CPU_MODEL = "max"
 DEFAULT_BOOT_ORDER = "c"
 DEFAULT_VGA_MODEL = "virtio"
 DEFAULT_NET_DEVICE = "virtio-net-pci"
+DEFAULT_VM_ID = "default"
+
+# Host admission control
+MAX_VMS = 4
+HOST_RAM_RESERVE_MB = 1024
+VCPU_OVERCOMMIT_RATIO = 1.0
+
+# QMP (QEMU Machine Protocol) settings
+QMP_SOCKET_DIR = os.path.join(tempfile.gettempdir(), "phoenix-qmp")
+QMP_READY_TIMEOUT_SECONDS = 30
+QMP_READY_MAX_SECONDS = 600
+QMP_COMMAND_TIMEOUT_SECONDS = 10
+
+# Guest metrics sampling
+METRICS_SAMPLE_INTERVAL_SECONDS = 2
+METRICS_CAPACITY = 1800
+METRICS_IDLE_SECONDS = 60
+METRICS_MAX_POINTS = 300
+
+# Event stream settings
+STREAM_HEARTBEAT_SECONDS = 15
+STREAM_RETRY_MS = 3000
+STREAM_BACKLOG_SIZE = 1000
+
+# Dashboard endpoint settings
+DASHBOARD_SECTIONS = ("status", "logs", "terminal", "metrics", "defaults")
+DASHBOARD_DEFAULT_SECTIONS = "status,logs,terminal"
+DASHBOARD_MAX_WAIT_SECONDS = 30
+
+# Log buffer settings
+QEMU_LOG_CAPACITY = 5000
+TERMINAL_LOG_CAPACITY = 5000
+LOG_READ_LIMIT = 1000
+
+# Persistent log store: every QEMU and terminal line is also written to
+# segment files on disk, gzipped once rotated, with a time/sequence index
+# used by /logs/search. Appends only queue the line; a writer thread batches
+# them to disk.
+LOG_STORE_ENABLED = True
+LOG_STORE_DIR = os.path.join(os.path.expanduser("~"), ".phoenix", "logs")
+LOG_SEGMENT_MAX_BYTES = 8 * 1024 * 1024
+LOG_SEGMENT_MAX_SECONDS = 3600
+LOG_STORE_MAX_BYTES = 256 * 1024 * 1024
+LOG_FLUSH_INTERVAL_SECONDS = 0.5
+LOG_FLUSH_BATCH_RECORDS = 1000 # queued lines that wake the writer before the interval
+LOG_INDEX_SAVE_SECONDS = 30 # index.json is also rewritten on open and rotation
+LOG_STORE_MAX_PENDING = 100000 # queued lines beyond this are dropped (and counted)
+LOG_SEARCH_LIMIT = 1000
+
+# Control-plane metrics served at /metrics in Prometheus text format
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PROFILER_INTERVAL_SECONDS = 0.01
+PROFILER_MAX_STACKS = 5000
+
+# Subprocess settings
+PROCESS_STOP_TIMEOUT_SECONDS = 5
+PROCESS_LINE_LIMIT = 1024 * 1024
+
+# Copy-on-write overlay images
+OVERLAY_DIR = os.path.join(os.path.expanduser("~"), ".phoenix", "overlays")
+OVERLAY_STOP_ACTIONS = ("discard", "commit", "keep")
+QEMU_IMG_BINARY = "qemu-img"
+QEMU_SYSTEM_BINARY = "qemu-system-x86_64"
+
+# Disk and ISO image catalog (/images). Files in these directories are probed
+# with qemu-img once per change and the results cached for /start_vm.
+IMAGE_DIRS = [os.path.join(os.path.expanduser("~"), ".phoenix", "images")]
+IMAGE_EXTENSIONS = (".qcow2", ".img", ".raw", ".iso", ".vmdk", ".vhdx", ".vpc")
+IMAGE_PROBE_CONCURRENCY = 2
+IMAGE_EVENT_DEBOUNCE_SECONDS = 0.5
+IMAGE_RESCAN_INTERVAL_SECONDS = 60 # only used when inotify is unavailable
+
+# Image uploads (PUT /images/<name>) land in IMAGE_DIRS[0]. Partial uploads
+# are kept as .<name>.part next to a .<name>.upload.json progress file.
+IMAGE_NAME_PATTERN = r'[A-Za-z0-9][A-Za-z0-9._-]{0,127}'
+IMAGE_TRANSFER_BLOCK_BYTES = 1024 * 1024
+IMAGE_UPLOAD_PREALLOCATE = False # True reserves every block up front (no holes)
+IMAGE_UPLOAD_FREE_SPACE_RESERVE_MB = 512
+IMAGE_UPLOAD_PROBE_TIMEOUT_SECONDS = 30 # wait for qemu-img info before answering the last chunk
+
+# qemu-img maintenance jobs (POST /images/<name>/jobs). They run one at a
+# time at idle I/O priority and lowest CPU priority so guests keep priority.
+MAX_RUNNING_IMAGE_JOBS = 1
+IMAGE_JOB_HISTORY_SIZE = 50
+IMAGE_JOB_OPERATIONS = ("compact", "convert", "compress", "check", "map", "resize")
+IMAGE_JOB_FORMATS = {"qcow2": ".qcow2", "raw": ".img"}
+IMAGE_JOB_COMPRESSION = ("zstd", "zlib")
+IMAGE_JOB_IO_PRIORITY = "idle" # "idle", "low" (best-effort 7) or "normal"
+IMAGE_JOB_NICE = 19
+IMAGE_JOB_MAP_EXTENTS = 1000 # extents kept in a map job's result
+
+# Live backups (/backup). Every drive gets a dirty bitmap when the VM starts
+# (persistent in qcow2 images), so incremental backups copy only the
+# clusters written since the previous backup. Each VM's chain is kept in
+# BACKUP_DIR/<vm_id> with a manifest.json.
+BACKUP_DIR = os.path.join(os.path.expanduser("~"), ".phoenix", "backups")
+BACKUP_BITMAP_NAME = "phoenix-backup"
+BACKUP_MODES = ("auto", "full", "incremental")
+BACKUP_POLL_SECONDS = 0.5
+
+# Disk I/O profiles for /start_vm's disk_io parameter. A request may name a
+# profile or pass a dict of overrides ({"profile": ..., "aio": ...}).
+# num_queues "auto" gives each disk one virtio-blk queue per vCPU.
+DISK_IO_PROFILES = {
+    "default": {"aio": "threads", "cache": "writeback", "iothread": False,
+                "num_queues": 1, "discard": "ignore", "detect_zeroes": "off"},
+    "throughput": {"aio": "io_uring", "cache": "none", "iothread": True,
+                   "num_queues": "auto", "discard": "unmap", "detect_zeroes": "unmap"}
+}
+DEFAULT_DISK_IO_PROFILE = "default"
+DISK_AIO_MODES = ("threads", "native", "io_uring")
+DISK_CACHE_MODES = ("writeback", "none", "writethrough", "directsync", "unsafe")
+DISK_DISCARD_MODES = ("ignore", "unmap")
+DISK_DETECT_ZEROES_MODES = ("off", "on", "unmap")
+DISK_MAX_QUEUES = 16
+DISK_IO_PROBE_TIMEOUT_SECONDS = 10
+
+# TCG tuning. /tcg_benchmark boots a disk under every combination in the
+# matrix and saves the fastest per host in TCG_PROFILE_PATH. /start_vm uses
+# the saved profile unless the request passes tcg="default" or its own values.
+TCG_PROFILE_PATH = os.path.join(os.path.expanduser("~"), ".phoenix", "tcg-profiles.json")
+TCG_DEFAULTS = {"thread": "multi", "tb_size": None, "smp_layout": None}
+TCG_THREAD_MODES = ("multi", "single")
+TCG_SMP_LAYOUTS = ("sockets", "cores")
+TCG_MAX_TB_SIZE_MB = 4096
+TCG_BENCHMARK_VM_ID = "tcg-benchmark" # VMS entry holding the benchmark guest's resources
+BENCHMARK_MATRIX = {
+    "tb_size": [256, 1024],
+    "thread": ["multi", "single"],
+    "smp_layout": ["cores", "sockets"],
+    "cpu_model": ["max", "qemu64"]
+}
+BENCHMARK_MAX_RUNS = 32
+BENCHMARK_LOGIN_PATTERN = r"login:\s*$"
+BENCHMARK_BOOT_TIMEOUT_SECONDS = 300
+BENCHMARK_WORKLOAD = "i=0; while [ $i -lt 300000 ]; do i=$((i+1)); done"
+
+# Host CPU pinning. /start_vm's cpu_pinning is "off", "auto" (one host CPU per
+# vCPU, fastest cores first) or a list of host CPU ids. This server and its
+# terminal jobs then run on the CPUs no guest is pinned to.
+DEFAULT_CPU_PINNING = "off"
+CPU_PINNING_SUPPORTED = hasattr(os, "sched_setaffinity")
+CONTROL_PLANE_RESERVED_CPUS = 1 # slowest CPUs "auto" leaves to the control plane
+
+# Guest memory. /start_vm's memory object picks a backend ("default", "memfd"
+# or "file"), hugepages, prealloc, share and whether to add a virtio-balloon.
+# Guests with auto_reclaim give memory back through the balloon while host
+# available memory is below BALLOON_HOST_FREE_THRESHOLD_MB.
+MEMORY_DEFAULTS = {"backend": "default", "hugepages": False, "prealloc": False,
+                   "share": False, "path": None, "balloon": True, "auto_reclaim": False}
+MEMORY_BACKENDS = ("default", "memfd", "file")
+HUGEPAGES_PATH = "/dev/hugepages"
+BALLOON_MIN_MB = 256
+BALLOON_MIN_FRACTION = 0.5 # auto_reclaim never shrinks a guest below this share of its RAM
+BALLOON_HOST_FREE_THRESHOLD_MB = 1024
+BALLOON_STEP_MB = 256
+BALLOON_CHECK_INTERVAL_SECONDS = 5
+
+# Guest networking. /start_vm's network is a mode name or an object of
+# NETWORK_DEFAULTS overrides. "user" is QEMU's SLIRP stack: no privileges, but
+# single-threaded. "tap" attaches a pre-created tap device ("ifname") with
+# vhost-net where /dev/vhost-net is usable and one virtio-net queue pair per
+# vCPU. "socket" joins two VMs on a named "link" over a local stream socket.
+# hostfwd forwards host ports into a "user" guest.
+NETWORK_DEFAULTS = {"mode": "user", "ifname": None, "vhost": "auto", "queues": "auto",
+                    "link": None, "hostfwd": []}
+NETWORK_MODES = ("user", "tap", "socket")
+NETWORK_MAX_QUEUES = 8
+NETWORK_HOSTFWD_ADDRESS = "127.0.0.1" # default host address of a port forward
+NETWORK_LINK_PORT_BASE = 47000 # socket links listen on 127.0.0.1 from this port
+NETWORK_LINK_PORT_COUNT = 1000 # ...up to NETWORK_LINK_PORT_BASE + NETWORK_LINK_PORT_COUNT - 1
+VHOST_NET_PATH = "/dev/vhost-net"
+NETWORK_BENCHMARK_SECONDS = 10
+NETWORK_BENCHMARK_MAX_SECONDS = 60
+NETWORK_BENCHMARK_CONNECT_TIMEOUT_SECONDS = 120
+
+# Warm pool of pre-launched, paused guests. Each profile holds /start_vm
+# parameters, e.g. {"desktop": {"size": 1, "config": {"ram_mb": 2048,
+# "primary_disk_path": "/path/to/disk.qcow2", "resume_from": "desktop-ready"}}}
+POOL_PROFILES = {}
+POOL_MAX_RAM_FRACTION = 0.5
+
+# Saved machine states (suspend / resume)
+SAVED_STATE_DIR = os.path.join(os.path.expanduser("~"), ".phoenix", "states")
+SAVE_STATE_TIMEOUT_SECONDS = 600
+SAVE_STATE_POLL_SECONDS = 0.2
+SAVE_STATE_MAX_BANDWIDTH = 1 << 40
+
+# Terminal command jobs
+MAX_RUNNING_JOBS = 4
+MAX_QUEUED_JOBS = 32
+JOB_OUTPUT_CAPACITY = 2000
+JOB_HISTORY_SIZE = 100
+
+# Interactive PTY terminal sessions
+PTY_SHELL = os.environ.get("SHELL", "/bin/sh")
+PTY_READ_SIZE = 64 * 1024
+PTY_OUTPUT_CAPACITY = 2000
+PTY_IDLE_TIMEOUT_SECONDS = 1800
+PTY_WRITE_TIMEOUT_SECONDS = 5
+# Run by the interpreter in the new session: take stdin as controlling TTY, then exec the shell
+PTY_CTTY_STUB = "import fcntl, os, sys, termios; fcntl.ioctl(0, termios.TIOCSCTTY, 0); os.execvp(sys.argv[1], sys.argv[1:])"
+MAX_PTY_SESSIONS = 8
+
+# WebSocket-to-VNC proxy settings (--asgi mode)
+VNC_PROXY_PATH = "/websockify"
+VNC_PROXY_HOST = "127.0.0.1"
+VNC_PROXY_CHUNK_SIZE = 64 * 1024
+VNC_PROXY_WRITE_HIGH_WATER = 256 * 1024
+VNC_PROXY_CONNECT_TIMEOUT_SECONDS = 5
+VNC_PROXY_DEFLATE = False
+
+
+class ApiError(Exception):
+    """A request that should be answered with a JSON status message"""
+
+    def __init__(self, message, status_code=400, status="error"):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.status = status
+
+    def payload(self):
+        return {
+            "status": self.status,
+            "message": self.message
+        }
+
+
+class LogBuffer:
+    """Fixed-capacity ring buffer of sequence-numbered entries.
+
+    Reads are non-destructive: each reader keeps its own cursor (the last
+    sequence number it has seen) and only receives newer entries, so several
+    clients can follow the same output. Sequence numbers start at 1 and are
+    never reused, so an entry's slot is simply seq % capacity.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._entries = [None] * capacity
+        self._next_seq = 1
+        self._first_seq = 1
+        self._cleared_seq = 0
+        self._condition = threading.Condition()
+        self._async_waiters = []
+
+    def append(self, entry):
+        """Add an entry, evicting the oldest one when full. Returns its seq"""
+        with self._condition:
+            seq = self._next_seq
+            self._entries[seq % self.capacity] = entry
+            self._next_seq += 1
+            if self._next_seq - self._first_seq > self.capacity:
+                self._first_seq += 1
+            self._condition.notify_all()
+
+            for loop, event in self._async_waiters:
+                try:
+                    loop.call_soon_threadsafe(event.set)
+                except RuntimeError:
+                    # The waiter's loop has been closed
+                    pass
+            self._async_waiters = []
+            return seq
+
+    def clear(self):
+        """Drop all entries without resetting the sequence numbers"""
+        with self._condition:
+            self._entries = [None] * self.capacity
+            self._first_seq = self._next_seq
+            self._cleared_seq = self._next_seq - 1
+
+    def last_seq(self):
+        """Sequence number of the newest entry (0 if nothing was ever added)"""
+        with self._condition:
+            return self._next_seq - 1
+
+    def __len__(self):
+        with self._condition:
+            return self._next_seq - self._first_seq
+
+    def read(self, since=0, limit=None):
+        """Return (entries, next_cursor, overflow) for entries after since.
+
+        entries is a list of (seq, entry) tuples. overflow is True when
+        entries newer than since were evicted before this reader got to them.
+        A cursor ahead of the buffer (e.g. from before a server restart) is
+        treated as a fresh reader.
+        """
+        with self._condition:
+            if since >= self._next_seq:
+                since = 0
+
+            start = max(since + 1, self._first_seq)
+            end = self._next_seq
+            if limit is not None:
+                end = min(end, start + limit)
+
+            entries = [(seq, self._entries[seq % self.capacity]) for seq in range(start, end)]
+            overflow = self._first_seq - 1 > max(since, self._cleared_seq)
+            return entries, max(end - 1, since), overflow
+
+    def wait(self, since, timeout):
+        """Block until there is an entry newer than since or timeout expires"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._next_seq - 1 != since, timeout=timeout)
+
+    async def wait_async(self, since, timeout):
+        """Like wait(), but awaitable from an asyncio event loop"""
+        event = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), event)
+        with self._condition:
+            if self._next_seq - 1 != since:
+                return True
+            self._async_waiters.append(waiter)
+
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._condition:
+                if waiter in self._async_waiters:
+                    self._async_waiters.remove(waiter)
+
+
+class LogStore:
+    """Append-only on-disk log of (time, seq, stream, line) records
+
+    Records are tab-separated lines in segment files. The newest segment is
+    plain text; full or old segments are gzipped and listed in index.json
+    with their time and sequence range, so a search only opens segments
+    that overlap the requested window. append() never touches the disk: it
+    queues the record for a writer thread that flushes in batches.
+    index.json lags behind the active segment, which is rescanned after a
+    crash.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = [] # [{"file", "first_ts", "last_ts", "first_seq", "last_seq", "bytes"}]
+        self.active = None # index entry of the segment being written
+        self._file = None
+        self._pending = []
+        self._next_seq = 1
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock() # taken before _condition
+        self._thread = None
+        self.error = None # set when the store could not be opened; appends are then dropped
+        self._opened = False
+        self.dropped = 0
+        self._index_saved_at = 0
+
+    @staticmethod
+    def encode(ts, seq, stream, line):
+        line = line.rstrip("\n").replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+        return f"{ts:.3f}\t{seq}\t{stream}\t{line}\n".encode("utf-8", errors="replace")
+
+    @staticmethod
+    def decode(raw):
+        ts, seq, stream, line = raw.decode("utf-8", errors="replace").rstrip("\n").split("\t", 3)
+        line = re.sub(r'\\([\\tn])', lambda m: {"\\": "\\", "t": "\t", "n": "\n"}[m.group(1)], line)
+        return {"ts": float(ts), "seq": int(seq), "stream": stream, "line": line}
+
+    def append(self, stream, line):
+        """Queue a line for writing. Never blocks on disk I/O
+
+        Lines are dropped once LOG_STORE_MAX_PENDING are queued (the disk
+        is not keeping up) or when the store failed to open.
+        """
+        with self._condition:
+            if self.error is not None or len(self._pending) >= LOG_STORE_MAX_PENDING:
+                self.dropped += 1
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._writer, daemon=True)
+                self._thread.start()
+            self._pending.append((time.time(), stream, line))
+            if len(self._pending) == LOG_FLUSH_BATCH_RECORDS:
+                self._condition.notify()
+
+    def _writer(self):
+        with self._write_lock:
+            try:
+                self._open()
+            except Exception as e:
+                with self._condition:
+                    self.error = str(e)
+                    self.dropped += len(self._pending)
+                    self._pending = []
+                print(f"ERROR: Log store disabled, could not open {self.directory}: {e}")
+                return
+            self._opened = True
+        while True:
+            with self._condition:
+                if len(self._pending) < LOG_FLUSH_BATCH_RECORDS:
+                    self._condition.wait(LOG_FLUSH_INTERVAL_SECONDS)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"ERROR: Log store write failed: {e}")
+
+    def _open(self):
+        """Load the index and gzip segments left uncompressed by the last run"""
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(os.path.join(self.directory, "index.json")) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = []
+
+        indexed = {entry["file"] for entry in self.index}
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(".log"):
+                # The index entry of the active segment may be older than its contents
+                self.index = [entry for entry in self.index if entry["file"] != name]
+                entry = self._scan_segment(name)
+                if entry is None:
+                    os.remove(os.path.join(self.directory, name))
+                    continue
+                self.index.append(entry)
+                self._compress(entry)
+            elif name.endswith(".log.gz") and name not in indexed:
+                os.remove(os.path.join(self.directory, name))
+
+        self.index.sort(key=lambda entry: entry["first_seq"])
+        self._next_seq = max([entry["last_seq"] for entry in self.index] + [0]) + 1
+        self._save_index()
+
+    def _scan_segment(self, name):
+        """Rebuild the index entry of a segment written before a crash"""
+        first = last = None
+        with open(os.path.join(self.directory, name), "rb") as f:
+            for raw in f:
+                try:
+                    record = self.decode(raw)
+                except ValueError:
+                    continue
+                first = first or record
+                last = record
+        if first is None:
+            return None
+        return {"file": name, "first_ts": first["ts"], "last_ts": last["ts"],
+                "first_seq": first["seq"], "last_seq": last["seq"],
+                "bytes": os.path.getsize(os.path.join(self.directory, name))}
+
+    def _compress(self, entry):
+        path = os.path.join(self.directory, entry["file"])
+        with open(path, "rb") as src, gzip.open(path + ".gz.tmp", "wb") as dst:
+            while chunk := src.read(1024 * 1024):
+                dst.write(chunk)
+        os.replace(path + ".gz.tmp", path + ".gz")
+        os.remove(path)
+        entry["file"] += ".gz"
+        entry["bytes"] = os.path.getsize(path + ".gz")
+
+    def _save_index(self):
+        path = os.path.join(self.directory, "index.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(path + ".tmp", path)
+        self._index_saved_at = time.monotonic()
+
+    def _rotate(self):
+        """Close the active segment, gzip it and enforce LOG_STORE_MAX_BYTES"""
+        self._file.close()
+        self._file = None
+        self._compress(self.active)
+        self.active = None
+        while sum(entry["bytes"] for entry in self.index) > LOG_STORE_MAX_BYTES and len(self.index) > 1:
+            oldest = self.index.pop(0)
+            os.remove(os.path.join(self.directory, oldest["file"]))
+        self._save_index()
+
+    def flush(self):
+        """Write all queued records to the active segment"""
+        # The batch is taken under _write_lock so batches are written in order
+        with self._write_lock:
+            with self._condition:
+                if self.error is not None or not self._opened:
+                    return
+                batch, self._pending = self._pending, []
+            if not batch:
+                return
+
+            if self.active is not None and (self.active["bytes"] >= LOG_SEGMENT_MAX_BYTES or
+                                            batch[0][0] - self.active["first_ts"] >= LOG_SEGMENT_MAX_SECONDS):
+                self._rotate()
+            if self.active is None:
+                name = f"segment-{self._next_seq:012d}.log"
+                self._file = open(os.path.join(self.directory, name), "ab")
+                self.active = {"file": name, "first_ts": batch[0][0], "last_ts": batch[0][0],
+                               "first_seq": self._next_seq, "last_seq": self._next_seq, "bytes": 0}
+                self.index.append(self.active)
+
+            data = []
+            for ts, stream, line in batch:
+                data.append(self.encode(ts, self._next_seq, stream, line))
+                self._next_seq += 1
+            data = b"".join(data)
+            self._file.write(data)
+            self._file.flush()
+
+            self.active["last_ts"] = batch[-1][0]
+            self.active["last_seq"] = self._next_seq - 1
+            self.active["bytes"] += len(data)
+            if time.monotonic() - self._index_saved_at >= LOG_INDEX_SAVE_SECONDS:
+                self._save_index()
+
+    def pending_count(self):
+        """Records queued but not yet written"""
+        with self._condition:
+            return len(self._pending)
+
+    def close(self):
+        """Flush queued records and gzip the active segment"""
+        if self._thread is None or self.error is not None:
+            return
+        self.flush()
+        with self._write_lock:
+            if self.active is not None:
+                self._rotate()
+
+    def _search_segment(self, entry, needle):
+        path = os.path.join(self.directory, entry["file"])
+        if entry["file"].endswith(".gz"):
+            with gzip.open(path, "rb") as f:
+                for raw in f:
+                    if needle in raw:
+                        yield raw
+            return
+
+        with open(path, "rb") as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return # empty file
+            with mm:
+                # Jump from match to match instead of splitting every line
+                pos = mm.find(needle)
+                while pos != -1:
+                    start = mm.rfind(b"\n", 0, pos) + 1
+                    end = mm.find(b"\n", pos)
+                    if end == -1:
+                        break # partially written last line
+                    yield mm[start:end + 1]
+                    pos = mm.find(needle, end + 1)
+
+    def search(self, query="", since_ts=None, until_ts=None, stream=None, limit=LOG_SEARCH_LIMIT):
+        """Return (records, truncated, segments scanned), oldest first"""
+        self.flush()
+        with self._write_lock:
+            segments = [dict(entry) for entry in self.index
+                        if (since_ts is None or entry["last_ts"] >= since_ts)
+                        and (until_ts is None or entry["first_ts"] <= until_ts)]
+
+        needle = query.encode("utf-8") if query else b"\n"
+        records = []
+        for entry in segments:
+            try:
+                for raw in self._search_segment(entry, needle):
+                    record = self.decode(raw)
+                    if query and query not in record["line"]:
+                        continue
+                    if (since_ts is not None and record["ts"] < since_ts) or \
+                            (until_ts is not None and record["ts"] > until_ts):
+                        continue
+                    if stream is not None and record["stream"] != stream:
+                        continue
+                    records.append(record)
+                    if len(records) > limit:
+                        return records[:limit], True, len(segments)
+            except (OSError, ValueError):
+                # Rotated away while searching
+                continue
+        return records, False, len(segments)
+
+
+class Histogram:
+    """Prometheus-style histogram with fixed upper bounds
+
+    Not thread-safe; callers hold SERVER_METRICS_LOCK.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+
+    def exposition(self, name, labels=None):
+        """Return the _bucket, _sum and _count lines for this histogram"""
+        labels = labels or {}
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{prom_labels(labels, le=bound)} {cumulative}")
+        lines.append(f"{name}_bucket{prom_labels(labels, le='+Inf')} {self.count}")
+        lines.append(f"{name}_sum{prom_labels(labels)} {self.sum:.6f}")
+        lines.append(f"{name}_count{prom_labels(labels)} {self.count}")
+        return lines
+
+
+class SamplingProfiler:
+    """Statistical profiler for the server's own Python threads
+
+    While running, a thread snapshots every other thread's stack with
+    sys._current_frames() each interval and counts identical stacks, giving
+    folded output for flamegraph tools. Nothing is traced between samples.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.started_at = time.time()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def running(self):
+        return self._thread.is_alive() and not self._stop.is_set()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                if key not in self.stacks and len(self.stacks) >= PROFILER_MAX_STACKS:
+                    key = "[other]"
+                self.stacks[key] += 1
+            self.samples += 1
+
+    def folded(self, top=None):
+        """Stacks in folded format ("frame;frame;frame count"), busiest first"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common(top))
+
+
+class ImageCatalog:
+    """Cache of qemu-img metadata for disk and ISO images
+
+    Entries are keyed by real path and remember the (mtime, size) they were
+    probed at, so a lookup is one stat() and a dict access. Files in
+    IMAGE_DIRS are watched with inotify and re-probed shortly after they
+    change; without inotify the directories are rescanned periodically.
+    Probes run on IO_LOOP and never block a request.
+    """
+
+    # inotify(7) event bits
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+
+    def __init__(self, directories):
+        self.directories = directories
+        self.entries = {}
+        self.watching = None
+        self._lock = threading.Lock()
+        self._probes = {} # path -> asyncio.Task
+        self._semaphore = None
+        self._inotify_fd = None
+        self._watches = {} # watch descriptor -> directory
+        self._changed = set()
+        self._flush_handle = None
+
+    @staticmethod
+    def key(stat_result):
+        return (stat_result.st_mtime_ns, stat_result.st_size)
+
+    def lookup(self, path):
+        """Return the cached entry for path if it is still current, else None
+
+        A stale or missing entry queues a probe so the next lookup hits.
+        """
+        path = os.path.realpath(path)
+        try:
+            key = self.key(os.stat(path))
+        except OSError:
+            return None
+        with self._lock:
+            entry = self.entries.get(path)
+        if entry is not None and entry["key"] == key:
+            return entry
+        run_on_io_loop(self.probe(path))
+        return None
+
+    def list(self, kind=None):
+        """Current entries sorted by path, with the VM using each image"""
+        with self._lock:
+            entries = sorted(self.entries.values(), key=lambda entry: entry["path"])
+        return [self.describe(entry) for entry in entries if not kind or entry["kind"] == kind]
+
+    def tracks(self, path):
+        """Whether path is catalogued or lies in one of the image directories"""
+        with self._lock:
+            if path in self.entries:
+                return True
+        return os.path.dirname(path) in {os.path.realpath(directory) for directory in self.directories}
+
+    def describe(self, entry):
+        """Public form of a catalog entry, with the VM using the image"""
+        image = {name: value for name, value in entry.items() if name != "key"}
+        with VM_LOCK:
+            image["vm_id"] = find_disk_owner(None, [entry["path"]])
+        return image
+
+    async def probe(self, path):
+        """Run qemu-img info on path unless an equivalent probe is in flight"""
+        path = os.path.realpath(path)
+        task = self._probes.get(path)
+        if task is None:
+            task = asyncio.ensure_future(self._probe(path))
+            self._probes[path] = task
+            task.add_done_callback(lambda _: self._probes.pop(path, None))
+        return await asyncio.shield(task)
+
+    async def _probe(self, path):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(IMAGE_PROBE_CONCURRENCY)
+        async with self._semaphore:
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                with self._lock:
+                    self.entries.pop(path, None)
+                return None
+
+            # -U: images attached to a running VM are locked by QEMU
+            returncode, output = await run_probe(
+                QEMU_IMG_BINARY, "info", "--output=json", "--backing-chain", "-U", path
+            )
+
+        entry = {
+            "path": path,
+            "name": os.path.basename(path),
+            "kind": "iso" if path.lower().endswith(".iso") else "disk",
+            "key": self.key(stat_result),
+            "size_bytes": stat_result.st_size,
+            "modified_at": stat_result.st_mtime,
+            "probed_at": time.time(),
+            "format": sniff_image_format(path),
+            "virtual_size": None,
+            "actual_size": None,
+            "backing_chain": [],
+            "dirty": False,
+            "corrupt": False,
+            "encrypted": False,
+            "error": None
+        }
+        try:
+            if returncode != 0:
+                raise ValueError(output.strip().splitlines()[-1] if output.strip() else f"exit code {returncode}")
+            chain = json.loads(output)
+            if isinstance(chain, dict):
+                chain = [chain]
+            top = chain[0]
+            entry.update({
+                "format": top["format"],
+                "virtual_size": top.get("virtual-size"),
+                "actual_size": top.get("actual-size"),
+                "backing_chain": [{"path": layer["filename"], "format": layer.get("format")} for layer in chain[1:]],
+                "dirty": bool(top.get("dirty-flag", False)),
+                "corrupt": bool(top.get("format-specific", {}).get("data", {}).get("corrupt", False)),
+                "encrypted": bool(top.get("encrypted", False))
+            })
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            entry["error"] = str(e) or "qemu-img info failed"
+
+        with self._lock:
+            self.entries[path] = entry
+        return entry
+
+    def image_paths(self):
+        """Image files currently present in the catalog directories"""
+        paths = []
+        for directory in self.directories:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(directory, name)
+                if name.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(path):
+                    paths.append(os.path.realpath(path))
+        return paths
+
+    async def scan(self):
+        """Probe new and changed images and forget deleted ones"""
+        present = set(self.image_paths())
+        watched = tuple(os.path.realpath(directory) + os.sep for directory in self.directories)
+        with self._lock:
+            entries = dict(self.entries)
+            # Images outside the directories stay listed while they exist
+            for path in set(entries) - present:
+                if path.startswith(watched) or not os.path.exists(path):
+                    del self.entries[path]
+
+        changed = []
+        for path in present:
+            try:
+                key = self.key(os.stat(path))
+            except OSError:
+                continue
+            if path not in entries or entries[path]["key"] != key:
+                changed.append(path)
+        await asyncio.gather(*(self.probe(path) for path in changed))
+        return len(changed)
+
+    def watch(self):
+        """Watch the catalog directories with inotify. Returns False if unavailable"""
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return False
+        if fd < 0:
+            return False
+
+        mask = self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_DELETE
+        for directory in self.directories:
+            wd = libc.inotify_add_watch(fd, os.fsencode(directory), mask)
+            if wd >= 0:
+                self._watches[wd] = directory
+        if not self._watches:
+            os.close(fd)
+            return False
+
+        self._inotify_fd = fd
+        asyncio.get_running_loop().add_reader(fd, self._on_inotify)
+        return True
+
+    def _on_inotify(self):
+        try:
+            data = os.read(self._inotify_fd, 65536)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        rescan = False
+        while offset + 16 <= len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b"\0").decode(errors='replace')
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                rescan = True
+            elif wd in self._watches and name.lower().endswith(IMAGE_EXTENSIONS):
+                self._changed.add(os.path.join(self._watches[wd], name))
+
+        if rescan:
+            asyncio.ensure_future(self.scan())
+        if self._changed and self._flush_handle is None:
+            # Copies and downloads fire many events; probe once they settle
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                IMAGE_EVENT_DEBOUNCE_SECONDS, self._flush_changes)
+
+    def _flush_changes(self):
+        self._flush_handle = None
+        changed, self._changed = self._changed, set()
+        for path in changed:
+            if os.path.isfile(path):
+                asyncio.ensure_future(self.probe(path))
+            else:
+                with self._lock:
+                    self.entries.pop(os.path.realpath(path), None)
+
+    async def run(self):
+        """Initial scan, then follow changes with inotify or periodic rescans"""
+        for directory in self.directories:
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError as e:
+                print(f"Image catalog: cannot use {directory}: {e}")
+
+        self.watching = "inotify" if self.watch() else "polling"
+        print(f"Image catalog: watching {', '.join(self.directories)} ({self.watching})")
+        while True:
+            try:
+                await self.scan()
+            except Exception as e:
+                print(f"Image catalog scan failed: {e}")
+            if self.watching == "inotify":
+                return
+            await asyncio.sleep(IMAGE_RESCAN_INTERVAL_SECONDS)
+
+
+class ImageUpload:
+    """A resumable upload into the image directory
+
+    The partial file is created at its final size, so chunks can arrive in
+    any order, in parallel, and after a server restart. Received byte ranges
+    are recorded in a JSON progress file. Blocks that are all zeros are not
+    written, which leaves holes in the sparse partial file. The upload is
+    renamed into place once every byte has been received and verified.
+    """
+
+    def __init__(self, name, state):
+        self.name = name
+        self.state = state
+        self.part_path, self.state_path, self.path = image_upload_paths(name)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._writers = 0 # requests inside pwrite; the fd is closed once this drops to 0
+        self._closed = False
+        self._fd = os.open(self.part_path, os.O_RDWR | os.O_CLOEXEC)
+
+    @classmethod
+    def open(cls, name, size=None, sha256=None, overwrite=False):
+        """Resume the upload for name, or start it when size is given"""
+        with IMAGE_UPLOADS_LOCK:
+            upload = IMAGE_UPLOADS.get(name)
+            if upload is None:
+                part_path, state_path, path = image_upload_paths(name)
+                try:
+                    with open(state_path) as f:
+                        upload = cls(name, json.load(f))
+                except (OSError, ValueError):
+                    if size is None:
+                        raise ApiError(f"No upload in progress for {name}", 404)
+                    upload = cls.create(name, size, overwrite)
+                IMAGE_UPLOADS[name] = upload
+
+        if size is not None and size != upload.state["size"]:
+            raise ApiError(f"Upload of {name} was started with size {upload.state['size']}, not {size}", 409)
+        if sha256:
+            with upload._lock:
+                if upload.state["sha256"] not in (None, sha256):
+                    raise ApiError("X-Image-Sha256 differs from the checksum the upload was started with", 409)
+                upload.state["sha256"] = sha256
+        return upload
+
+    @classmethod
+    def create(cls, name, size, overwrite):
+        part_path, state_path, path = image_upload_paths(name)
+        if os.path.exists(path):
+            if not overwrite:
+                raise ApiError(f"Image {name} already exists. Use ?overwrite=1 to replace it", 409)
+            with VM_LOCK:
+                owner = find_disk_owner(None, [os.path.realpath(path)])
+                job = find_image_job([os.path.realpath(path)])
+            if owner:
+                raise ApiError(f"Image {name} is in use by VM {owner}", 409)
+            if job:
+                raise ApiError(f"Image {name} is busy with {job.operation} job {job.job_id}", 409)
+
+        directory = os.path.dirname(part_path)
+        os.makedirs(directory, exist_ok=True)
+        free = shutil.disk_usage(directory).free
+        if size + IMAGE_UPLOAD_FREE_SPACE_RESERVE_MB * 1024 * 1024 > free:
+            raise ApiError(f"Not enough disk space: {size} bytes needed, {free} free", 507)
+
+        fd = os.open(part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+        try:
+            if IMAGE_UPLOAD_PREALLOCATE and size:
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+
+        upload = cls(name, {
+            "name": name,
+            "size": size,
+            "sha256": None,
+            "ranges": [],
+            "overwrite": bool(overwrite),
+            "started_at": time.time()
+        })
+        upload.save()
+        return upload
+
+    def save(self):
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, self.state_path)
+
+    def _pwrite(self, block, offset):
+        """pwrite to the partial file unless the upload has been closed"""
+        with self._lock:
+            if self._closed:
+                raise ApiError(f"Upload of {self.name} was already completed or aborted", 409)
+            self._writers += 1
+        try:
+            os.pwrite(self._fd, block, offset)
+        finally:
+            with self._lock:
+                self._writers -= 1
+                if not self._writers:
+                    self._idle.notify_all()
+
+    def _close(self, sync=False):
+        """Refuse further writes, wait for those in flight, then close the fd"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            while self._writers:
+                self._idle.wait()
+        if sync:
+            os.fsync(self._fd)
+        os.close(self._fd)
+
+    def write(self, offset, block):
+        """Write one block at offset, skipping blocks of zeros"""
+        if offset + len(block) > self.state["size"]:
+            raise ApiError("Chunk extends past the end of the image", 416)
+        zeros = ZERO_BLOCK if len(block) == len(ZERO_BLOCK) else bytes(len(block))
+        if block != zeros:
+            self._pwrite(block, offset)
+
+    def received_bytes(self):
+        return sum(end - start for start, end in self.state["ranges"])
+
+    def missing(self):
+        """Byte ranges [start, end) that have not been received yet"""
+        gaps = []
+        position = 0
+        for start, end in self.state["ranges"]:
+            if start > position:
+                gaps.append([position, start])
+            position = end
+        if position < self.state["size"]:
+            gaps.append([position, self.state["size"]])
+        return gaps
+
+    def finish_chunk(self, start, length, received, digest=None, expected_digest=None):
+        """Record a received chunk and complete the upload when nothing is missing
+
+        Returns the finished catalog entry, or None while ranges are missing.
+        """
+        if expected_digest and (received < length or digest != expected_digest):
+            # Unverified bytes may sit where a later chunk skips zeros
+            for offset in range(start, start + received, IMAGE_TRANSFER_BLOCK_BYTES):
+                self._pwrite(ZERO_BLOCK[:min(IMAGE_TRANSFER_BLOCK_BYTES, start + received - offset)], offset)
+            if received == length:
+                raise ApiError("Chunk checksum mismatch (X-Chunk-Sha256). Send the chunk again", 422)
+        if received < length:
+            if not expected_digest:
+                self.mark(start, start + received)
+            raise ApiError(f"Incomplete chunk: received {received} of {length} bytes")
+
+        if self.mark(start, start + length):
+            return self.complete()
+        return None
+
+    def mark(self, start, end):
+        """Merge [start, end) into the received ranges. True once complete"""
+        with self._lock:
+            if self._closed:
+                raise ApiError(f"Upload of {self.name} was already completed or aborted", 409)
+            ranges = sorted(self.state["ranges"] + [[start, end]])
+            merged = []
+            for range_start, range_end in ranges:
+                if merged and range_start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], range_end)
+                elif range_end > range_start:
+                    merged.append([range_start, range_end])
+            self.state["ranges"] = merged
+            self.save()
+            return self.received_bytes() == self.state["size"]
+
+    def status(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "size": self.state["size"],
+                "received_bytes": self.received_bytes(),
+                "ranges": self.state["ranges"],
+                "missing": self.missing(),
+                "sha256": self.state["sha256"],
+                "started_at": self.state["started_at"]
+            }
+
+    def complete(self):
+        """Verify the whole-file checksum, then move the image into place"""
+        with IMAGE_UPLOADS_LOCK:
+            if IMAGE_UPLOADS.get(self.name) is not self:
+                raise ApiError(f"Upload of {self.name} was already completed or aborted", 409)
+            del IMAGE_UPLOADS[self.name]
+
+        self._close(sync=True)
+        expected = self.state["sha256"]
+        if expected and file_sha256(self.part_path) != expected.lower():
+            self.discard()
+            raise ApiError("Image checksum mismatch (X-Image-Sha256). The upload was discarded", 422)
+
+        if os.path.exists(self.path) and not self.state.get("overwrite"):
+            self.discard()
+            raise ApiError(f"Image {self.name} was created while uploading", 409)
+        os.replace(self.part_path, self.path)
+        os.remove(self.state_path)
+        print(f"Image upload complete: {self.path} ({self.state['size']} bytes)")
+        probe = run_on_io_loop(IMAGE_CATALOG.probe(self.path))
+        try:
+            entry = probe.result(timeout=IMAGE_UPLOAD_PROBE_TIMEOUT_SECONDS)
+        except concurrent.futures.TimeoutError:
+            # The probe keeps running and fills the catalog later
+            return {"name": self.name, "path": os.path.realpath(self.path),
+                    "size_bytes": self.state["size"], "probed_at": None}
+        return IMAGE_CATALOG.describe(entry)
+
+    def abort(self):
+        with IMAGE_UPLOADS_LOCK:
+            if IMAGE_UPLOADS.get(self.name) is self:
+                del IMAGE_UPLOADS[self.name]
+        self._close()
+        self.discard()
+
+    def discard(self):
+        for path in (self.part_path, self.state_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class QMPError(Exception):
+    """Raised when a QMP command fails or the QMP connection is lost"""
+
+
+class QMPClient:
+    """Minimal QEMU Machine Protocol client over a UNIX socket.
+
+    Commands are serialized with a lock so several threads can share one
+    connection. Asynchronous events that arrive while waiting for a reply are
+    kept in self.events.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+        self.greeting = None
+        self.events = collections.deque(maxlen=100)
+        self._buffer = b""
+        self._lock = threading.Lock()
+
+    def connect(self, timeout=QMP_COMMAND_TIMEOUT_SECONDS):
+        """Connect, read the greeting and enter command mode"""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(self.path)
+            self.greeting = self._read_message()
+            self.execute('qmp_capabilities')
+        except Exception:
+            self.close()
+            raise
+
+    def _read_message(self, allow_timeout=False):
+        # Split lines out of our own buffer: a makefile() reader becomes
+        # unusable after its first socket timeout, which wait_event relies on
+        while b"\n" not in self._buffer:
+            try:
+                chunk = self.sock.recv(65536)
+            except socket.timeout:
+                if allow_timeout:
+                    raise
+                raise QMPError("QMP connection failed: timed out")
+            except OSError as e:
+                raise QMPError(f"QMP connection failed: {str(e)}")
+            if not chunk:
+                raise QMPError("QMP connection closed")
+            self._buffer += chunk
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return json.loads(line)
+
+    def execute(self, command, arguments=None):
+        """Run a QMP command and return its result"""
+        message = {"execute": command}
+        if arguments:
+            message["arguments"] = arguments
+
+        with self._lock:
+            if self.sock is None:
+                raise QMPError("QMP is not connected")
+            try:
+                self.sock.sendall(json.dumps(message).encode() + b"\n")
+            except OSError as e:
+                raise QMPError(f"QMP connection failed: {str(e)}")
+
+            while True:
+                response = self._read_message()
+                if "event" in response:
+                    self.events.append(response)
+                elif "error" in response:
+                    raise QMPError(response["error"].get("desc", "Unknown QMP error"))
+                else:
+                    return response.get("return")
+
+    def wait_event(self, names, timeout):
+        """Wait for one of the named events, returning it or None on timeout"""
+        deadline = time.monotonic() + timeout
+
+        with self._lock:
+            while True:
+                for event in list(self.events):
+                    if event["event"] in names:
+                        self.events.remove(event)
+                        return event
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+
+                self.sock.settimeout(remaining)
+                try:
+                    self.events.append(self._read_message(allow_timeout=True))
+                except socket.timeout:
+                    return None
+                finally:
+                    self.sock.settimeout(QMP_COMMAND_TIMEOUT_SECONDS)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+
+class VirtualMachine:
+    """A QEMU guest managed by this server.
+
+    Entries stay in the registry after the guest stops so that its logs and
+    exit code can still be read; starting the same vm_id again reuses them.
+    """
+
+    ACTIVE_STATES = ("starting", "pooled", "running", "stopping")
+
+    def __init__(self, vm_id):
+        self.vm_id = vm_id
+        # Fixed at creation: a pooled guest keeps its socket when it is renamed
+        self.qmp_socket_path = os.path.join(QMP_SOCKET_DIR, f"{vm_id}.sock")
+        self.pool_profile = None
+        self.process = None
+        self.state = "stopped"
+        self.config = {}
+        self.vnc_display = None
+        self.log_buffer = LogBuffer(QEMU_LOG_CAPACITY)
+        self.started_at = None
+        self.exit_code = None
+        self.qmp = None
+        self.ready_event = threading.Event()
+        self.metrics = LogBuffer(METRICS_CAPACITY)
+        self.metrics_state = {}
+        self.overlay = None
+        self.start_params = {}
+        self.cpu_placement = None
+        self.stop_requested_at = None
+        self.backup_bitmaps = {} # drive -> True while its bitmap is new since the last backup
+
+    @property
+    def vnc_port(self):
+        return 5900 + self.vnc_display if self.vnc_display is not None else None
+
+    @property
+    def running(self):
+        return self.state == "running"
+
+    @property
+    def active(self):
+        return self.state in self.ACTIVE_STATES
+
+    def set_state(self, state):
+        """Update the lifecycle state and publish the change"""
+        if self.state != state:
+            self.state = state
+            publish_event("vm_status", self.status())
+
+    def push_output(self, line):
+        """Store a QEMU log line and publish it to stream subscribers"""
+        self.log_buffer.append(line)
+        if LOG_STORE_ENABLED:
+            LOG_STORE.append(f"qemu:{self.vm_id}", line)
+        publish_event("qemu_log", {"vm_id": self.vm_id, "line": line})
+
+    def qmp_execute(self, command, arguments=None):
+        """Run a QMP command against this VM"""
+        if self.qmp is None:
+            raise QMPError(f"VM {self.vm_id} has no QMP connection")
+        return self.qmp.execute(command, arguments)
+
+    def recent_output(self, count=20):
+        """Return the last few QEMU log lines"""
+        entries, _, _ = self.log_buffer.read(max(self.log_buffer.last_seq() - count, 0))
+        return [line for _, line in entries]
+
+    def status(self):
+        """Return a JSON-serializable summary of this VM"""
+        return {
+            "vm_id": self.vm_id,
+            "state": self.state,
+            "running": self.running,
+            "pid": self.process.pid if self.process else None,
+            "vnc_display": self.vnc_display,
+            "vnc_port": self.vnc_port,
+            "ram_mb": self.config.get("ram_mb"),
+            "cores": self.config.get("cores"),
+            "started_at": self.started_at,
+            "exit_code": self.exit_code,
+            "overlay": dict(self.overlay) if self.overlay else None,
+            "pool_profile": self.pool_profile,
+            "disk_io": self.start_params.get("disk_io"),
+            "tcg": self.start_params.get("tcg"),
+            "cpu_placement": dict(self.cpu_placement, control_plane_cpus=CONTROL_PLANE_CPUS) if self.cpu_placement else None,
+            "memory": self.start_params.get("memory"),
+            "network": self.start_params.get("network")
+        }
+
+
+class VNCProxyConnection:
+    """Byte and frame counters for one WebSocket-to-VNC connection"""
+
+    _next_id = 1
+
+    def __init__(self, vm_id, client):
+        self.conn_id = VNCProxyConnection._next_id
+        VNCProxyConnection._next_id += 1
+        self.vm_id = vm_id
+        self.client = client
+        self.opened_at = time.time()
+        self.bytes_to_vnc = 0
+        self.bytes_to_client = 0
+        self.frames_to_vnc = 0
+        self.frames_to_client = 0
+
+    def status(self):
+        return {
+            "id": self.conn_id,
+            "vm_id": self.vm_id,
+            "client": self.client,
+            "opened_at": self.opened_at,
+            "bytes_to_vnc": self.bytes_to_vnc,
+            "bytes_to_client": self.bytes_to_client,
+            "frames_to_vnc": self.frames_to_vnc,
+            "frames_to_client": self.frames_to_client
+        }
+
+
+class TerminalJob:
+    """A one-shot terminal command with its own output buffer"""
+
+    FINISHED_STATES = ("finished", "failed", "cancelled")
+
+    def __init__(self, command):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.command = command
+        self.state = "queued"
+        self.process = None
+        self.exit_code = None
+        self.output = LogBuffer(JOB_OUTPUT_CAPACITY)
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.state in self.FINISHED_STATES
+
+    def push_output(self, line):
+        """Store a line in this job's buffer and in the shared terminal log"""
+        self.output.append(line)
+        push_terminal_output(line, self.job_id)
+
+    def status(self):
+        return {
+            "job_id": self.job_id,
+            "command": self.command,
+            "state": self.state,
+            "pid": self.process.pid if self.process else None,
+            "exit_code": self.exit_code,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+class ImageJob:
+    """A qemu-img maintenance operation on a catalogued image
+
+    Operations that rewrite an image write to a temporary file next to it
+    and replace the original only once qemu-img has succeeded.
+    """
+
+    FINISHED_STATES = ("finished", "failed", "cancelled")
+
+    def __init__(self, operation, path, command, temp_path=None, output_path=None, params=None):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.operation = operation
+        self.path = path
+        self.command = command
+        self.temp_path = temp_path
+        self.output_path = output_path
+        self.params = params or {}
+        self.state = "queued"
+        self.progress = None
+        self.process = None
+        self.exit_code = None
+        self.result = None
+        self.error = None
+        self.output = LogBuffer(JOB_OUTPUT_CAPACITY)
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.state in self.FINISHED_STATES
+
+    @property
+    def paths(self):
+        """Files this job reads or writes"""
+        return [path for path in (self.path, self.output_path) if path]
+
+    def set_state(self, state):
+        self.state = state
+        publish_event("image_job", self.status())
+
+    def status(self):
+        return {
+            "job_id": self.job_id,
+            "operation": self.operation,
+            "image": os.path.basename(self.path),
+            "output": os.path.basename(self.output_path) if self.output_path else None,
+            "params": self.params,
+            "state": self.state,
+            "progress": self.progress,
+            "pid": self.process.pid if self.process else None,
+            "exit_code": self.exit_code,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+class VMBackup:
+    """A full or incremental backup of a running VM's drives
+
+    Each drive is copied by a QEMU blockdev-backup job into a qcow2 file in
+    BACKUP_DIR/<vm_id> while the guest keeps running. Incremental files hold
+    only the clusters marked in the drive's dirty bitmap and use the parent
+    backup's file as their backing file, so every point reads as a full disk.
+    """
+
+    FINISHED_STATES = ("finished", "failed")
+
+    def __init__(self, vm_id, mode, parent, drives):
+        self.backup_id = time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:6]
+        self.vm_id = vm_id
+        self.mode = mode
+        self.parent = parent
+        self.drives = {drive: dict(info, file=f"{self.backup_id}.{drive}.qcow2") for drive, info in drives.items()}
+        self.state = "running"
+        self.progress = 0.0
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.state in self.FINISHED_STATES
+
+    def set_state(self, state):
+        self.state = state
+        publish_event("backup", self.status())
+
+    def manifest_entry(self):
+        return {
+            "backup_id": self.backup_id,
+            "mode": self.mode,
+            "parent": self.parent,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "drives": self.drives
+        }
+
+    def status(self):
+        return dict(
+            self.manifest_entry(),
+            vm_id=self.vm_id,
+            state=self.state,
+            progress=self.progress,
+            error=self.error
+        )
+
+
+class TerminalSession:
+    """A persistent shell running on a pseudo-terminal
+
+    Output is read in chunks as soon as the PTY has data, without waiting
+    for newlines, so prompts, \r progress updates and full-screen programs
+    reach the client intact. Chunks are kept in a LogBuffer for polling and
+    published as pty_output events.
+    """
+
+    def __init__(self, shell, cols, rows):
+        self.session_id = uuid.uuid4().hex[:12]
+        self.shell = shell
+        self.cols = cols
+        self.rows = rows
+        self.master_fd = None
+        self.process = None
+        self.output = LogBuffer(PTY_OUTPUT_CAPACITY)
+        self.created_at = time.time()
+        self.last_active = time.monotonic()
+        self.exit_code = None
+        self.closed = False
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    async def start(self):
+        """Open the PTY and launch the shell as its session leader"""
+        self.master_fd, slave_fd = os.openpty()
+        self.resize(self.cols, self.rows)
+        try:
+            # The stub makes the PTY the shell's controlling terminal (job
+            # control and ^C) and execs it, so no preexec_fn runs in the fork
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, "-c", PTY_CTTY_STUB, self.shell,
+                stdin=slave_fd,
+                stdout=slave_fd,
+                stderr=slave_fd,
+                start_new_session=True,
+                env=dict(os.environ, TERM="xterm-256color")
+            )
+        except Exception:
+            os.close(self.master_fd)
+            raise
+        finally:
+            os.close(slave_fd)
+
+        os.set_blocking(self.master_fd, False)
+        asyncio.get_running_loop().add_reader(self.master_fd, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.master_fd, PTY_READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            # EIO once the shell and all its children have closed the PTY
+            data = b""
+
+        if not data:
+            asyncio.get_running_loop().remove_reader(self.master_fd)
+            return
+
+        text = self._decoder.decode(data)
+        if text:
+            self.output.append(text)
+            publish_event("pty_output", {"session_id": self.session_id, "data": text})
+
+    def write(self, data):
+        """Send input to the shell, waiting while the PTY buffer is full"""
+        self.last_active = time.monotonic()
+        view = memoryview(data.encode())
+        deadline = time.monotonic() + PTY_WRITE_TIMEOUT_SECONDS
+        while view:
+            try:
+                written = os.write(self.master_fd, view)
+                view = view[written:]
+            except BlockingIOError:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("Terminal is not accepting input")
+                select.select([], [self.master_fd], [], remaining)
+
+    def resize(self, cols, rows):
+        """Set the terminal size; the shell receives SIGWINCH"""
+        self.cols = cols
+        self.rows = rows
+        fcntl.ioctl(self.master_fd, termios.TIOCSWINSZ, struct.pack("HHHH", rows, cols, 0, 0))
+
+    async def close(self):
+        """Hang up the shell's process group and release the PTY"""
+        if self.closed:
+            return
+        self.closed = True
+
+        if self.process is not None and self.process.returncode is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+            await stop_process(self.process, timeout=2)
+
+        asyncio.get_running_loop().remove_reader(self.master_fd)
+        os.close(self.master_fd)
+        self.exit_code = self.process.returncode if self.process else None
+        publish_event("pty_closed", {"session_id": self.session_id, "exit_code": self.exit_code})
+
+    def status(self):
+        return {
+            "session_id": self.session_id,
+            "shell": self.shell,
+            "pid": self.process.pid if self.process else None,
+            "cols": self.cols,
+            "rows": self.rows,
+            "created_at": self.created_at,
+            "idle_seconds": round(time.monotonic() - self.last_active, 1),
+            "closed": self.closed,
+            "exit_code": self.exit_code
+        }
+
 
 # Global state
-QEMU_PROCESS = None
-QEMU_RUNNING = False
-QEMU_OUTPUT_QUEUE = queue.Queue()
-TERMINAL_OUTPUT_QUEUE = queue.Queue()
+VMS = {}
+DISK_IO_SUPPORT = None # filled in by probe_disk_io_support()
+NETWORK_SUPPORT = None # filled in by probe_network_support()
+NETWORK_BENCHMARKS = {} # vm_id -> progress of its last /network_benchmark run
+TCG_BENCHMARK = {"state": "idle"} # progress of the last /tcg_benchmark run
+TCG_BENCHMARK_FUTURE = None
+HOST_CPUS = sorted(os.sched_getaffinity(0)) if CPU_PINNING_SUPPORTED else []
+CONTROL_PLANE_CPUS = list(HOST_CPUS)
+BALLOON_POLICY_TASK = None
+POOL_NEXT_ID = 1
+VM_LOCK = threading.RLock()
+TERMINAL_LOG_BUFFER = LogBuffer(TERMINAL_LOG_CAPACITY)
+LOG_STORE = LogStore(LOG_STORE_DIR)
+atexit.register(LOG_STORE.close)
+IMAGE_CATALOG = ImageCatalog(IMAGE_DIRS)
+IMAGE_CATALOG_TASK = None
+IMAGE_UPLOADS = {} # name -> ImageUpload in progress
+IMAGE_UPLOADS_LOCK = threading.Lock()
+ZERO_BLOCK = bytes(IMAGE_TRANSFER_BLOCK_BYTES)
+
+# Event loop that owns all QEMU and terminal subprocesses. In threaded Flask
+# mode it runs in a background thread; in --asgi mode it is the server's loop.
+IO_LOOP = asyncio.new_event_loop()
+IO_LOOP_LOCK = threading.Lock()
+IO_THREAD = None
+
+# Metrics sampler state
+METRICS_THREAD = None
+METRICS_WAKE = threading.Event()
+METRICS_LAST_READ = 0.0
+
+# Recent events kept for /events subscribers, as (type, data) entries
+EVENT_BUFFER = LogBuffer(STREAM_BACKLOG_SIZE)
+
+# Control-plane metrics. Request metrics are keyed by (method, route rule).
+SERVER_METRICS_LOCK = threading.Lock()
+REQUEST_LATENCY = collections.defaultdict(Histogram)
+REQUEST_COUNT = collections.Counter() # (method, route, status)
+REQUESTS_IN_FLIGHT = collections.Counter() # route
+VM_START_SECONDS = Histogram() # QEMU launch until ready
+VM_STOP_SECONDS = Histogram() # stop request until QEMU exited
+START_VM_WAIT = collections.defaultdict(Histogram) # /start_vm hold time by result
+PROFILER = None
+
+# Terminal command jobs in submission order, keyed by job id. The semaphore
+# is created on IO_LOOP the first time a job runs.
+JOBS = collections.OrderedDict()
+JOBS_LOCK = threading.Lock()
+JOB_SLOTS = None
+
+# qemu-img maintenance jobs, keyed by job id. Lock order: VM_LOCK first.
+IMAGE_JOBS = collections.OrderedDict()
+IMAGE_JOBS_LOCK = threading.Lock()
+IMAGE_JOB_SLOTS = None
+
+# Live backups: the running or last backup of each VM, keyed by vm_id.
+# BACKUPS_LOCK also guards manifest updates. Lock order: VM_LOCK first.
+BACKUPS = {}
+BACKUPS_LOCK = threading.Lock()
+
+# Interactive terminal sessions, keyed by session id
+PTY_SESSIONS = {}
+PTY_SESSIONS_LOCK = threading.Lock()
+PTY_REAPER = None
+
+# Open WebSocket-to-VNC proxy connections, keyed by connection id
+VNC_CONNECTIONS = {}
+VNC_CONNECTIONS_LOCK = threading.Lock()
+VNC_TOTALS = {"connections": 0, "bytes_to_vnc": 0, "bytes_to_client": 0, "frames_to_vnc": 0, "frames_to_client": 0}
+
+
+def prom_labels(labels, **extra):
+    """Format a Prometheus label set, e.g. {method="GET",route="/vms"}"""
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for key, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+def observe_metric(histogram, value):
+    with SERVER_METRICS_LOCK:
+        histogram.observe(value)
+
+
+def request_started(route):
+    """Count a request as in flight and return its start time"""
+    with SERVER_METRICS_LOCK:
+        REQUESTS_IN_FLIGHT[route] += 1
+    return time.perf_counter()
+
+
+def request_finished(method, route, status, started):
+    """Record a finished request's latency and status"""
+    elapsed = time.perf_counter() - started
+    with SERVER_METRICS_LOCK:
+        REQUESTS_IN_FLIGHT[route] -= 1
+        REQUEST_LATENCY[(method, route)].observe(elapsed)
+        REQUEST_COUNT[(method, route, status)] += 1
+
+
+@app.before_request
+def start_request_timer():
+    g.metrics_route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.metrics_started = request_started(g.metrics_route)
+
+
+@app.after_request
+def record_response_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def finish_request_timer(error=None):
+    # Streaming responses (/events) finish here when the stream closes
+    if "metrics_started" in g:
+        request_finished(request.method, g.metrics_route, g.get("metrics_status", 500), g.metrics_started)
+
+
+def publish_event(event_type, data):
+    """Record an event and wake up all /events subscribers"""
+    EVENT_BUFFER.append((event_type, data))
+
+
+def parse_cursor_args():
+    """Parse the since/limit query parameters used by the log endpoints"""
+    since = int(request.args.get('since', 0))
+    limit = min(int(request.args.get('limit', LOG_READ_LIMIT)), LOG_READ_LIMIT)
+    if since < 0 or limit < 1:
+        raise ValueError("since must be >= 0 and limit must be >= 1")
+    return since, limit
+
+
+def format_sse(event_type, data, event_id=None):
+    """Format a single Server-Sent Events message"""
+    message = ""
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    message += f"event: {event_type}\n"
+    message += f"data: {json.dumps(data)}\n\n"
+    return message
+
+
+def classify_terminal_line(line):
+    """Determine the display type of a terminal output line"""
+    if line.startswith('$ '):
+        return 'command'
+    elif line.startswith('[Command finished'):
+        return 'status'
+    elif line.startswith('ERROR'):
+        return 'error'
+    return 'info'
+
+
+def push_terminal_output(line, job_id=None):
+    """Store a terminal output line and publish it to stream subscribers"""
+    TERMINAL_LOG_BUFFER.append(line)
+    if LOG_STORE_ENABLED:
+        LOG_STORE.append("terminal", line)
+    publish_event("terminal", {
+        "message": line,
+        "type": classify_terminal_line(line),
+        "job_id": job_id
+    })
+
+
+def get_vm(vm_id):
+    """Look up a registered VM, or None"""
+    with VM_LOCK:
+        return VMS.get(vm_id)
+
+
+def any_vm_running():
+    """Return True if at least one guest is running"""
+    with VM_LOCK:
+        return any(vm.running for vm in VMS.values())
+
+
+def check_admission(vm_id, ram_mb, cores):
+    """Return an error message if the host cannot fit another guest, else None
+
+    Must be called with VM_LOCK held so that concurrent starts see each
+    other's reservations.
+    """
+    active = [vm for vm in VMS.values() if vm.active and vm.vm_id != vm_id]
+
+    if len(active) >= MAX_VMS:
+        return f"Maximum number of running VMs reached ({MAX_VMS})"
+
+    host_cores = psutil.cpu_count(logical=True) or 1
+    reserved_cores = sum(vm.config.get("cores", 0) for vm in active)
+    if reserved_cores + cores > host_cores * VCPU_OVERCOMMIT_RATIO:
+        return (f"Not enough host CPU cores: {reserved_cores} of {host_cores} "
+                f"already assigned, {cores} requested")
+
+    memory = psutil.virtual_memory()
+    total_mb = memory.total // (1024 * 1024)
+    available_mb = memory.available // (1024 * 1024)
+    reserved_mb = sum(vm.config.get("ram_mb", 0) for vm in active)
+    if reserved_mb + ram_mb > total_mb - HOST_RAM_RESERVE_MB:
+        return (f"Not enough host RAM: {reserved_mb} MB of {total_mb} MB "
+                f"already assigned, {ram_mb} MB requested")
+    if ram_mb > available_mb - HOST_RAM_RESERVE_MB:
+        return f"Not enough free host RAM: {available_mb} MB available, {ram_mb} MB requested"
+
+    return None
+
+
+def allocate_vnc_display():
+    """Return the lowest VNC display number not used by an active VM
+
+    Must be called with VM_LOCK held.
+    """
+    used = set(vm.vnc_display for vm in VMS.values() if vm.active)
+    display = 0
+    while display in used:
+        display += 1
+    return display
+
+
+def find_disk_owner(vm_id, paths, backing=None):
+    """Return the id of another active VM using one of paths, or None
+
+    paths are opened read-write and conflict with any use of the same file.
+    backing is the read-only base of an overlay, which several VMs may share
+    as long as none of them writes to it directly.
+    Must be called with VM_LOCK held.
+    """
+    for vm in VMS.values():
+        if vm.vm_id == vm_id or not vm.active:
+            continue
+        used = set(vm.config.get("disks", []))
+        if set(paths) & (used | {vm.config.get("backing")}) or backing in used:
+            return vm.vm_id
+    return None
+
+
+# Header magic -> QEMU format name, for images the catalog has not probed yet
+IMAGE_MAGIC = (
+    (b'QFI\xfb', "qcow2"),
+    (b'KDMV', "vmdk"),
+    (b'vhdxfile', "vhdx"),
+    (b'conectix', "vpc")
+)
+
+
+def sniff_image_format(path):
+    """Guess an image's format from its first bytes; anything unknown is raw"""
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(8)
+    except OSError:
+        return "raw"
+    for magic, image_format in IMAGE_MAGIC:
+        if header.startswith(magic):
+            return image_format
+    return "raw"
+
+
+def check_image(path, label):
+    """Check a disk or ISO path against the image catalog and return its format
+
+    Uses the cached qemu-img result when the file has not changed since it
+    was probed. A file the catalog has not seen yet only gets a header check
+    and is probed in the background, so this never waits on qemu-img.
+    Raises ApiError for missing, unreadable or corrupt images.
+    """
+    if not os.path.exists(path):
+        raise ApiError(f"{label} not found: {path}")
+
+    image = IMAGE_CATALOG.lookup(path)
+    if image is None:
+        return sniff_image_format(path)
+    if image["error"]:
+        raise ApiError(f"{label} is not a usable image: {image['error']}")
+    if image["corrupt"]:
+        raise ApiError(f"{label} is marked corrupt. Repair it with: qemu-img check -r all {path}", 409)
+    if image["encrypted"]:
+        raise ApiError(f"{label} is encrypted, which is not supported")
+    return image["format"]
+
+
+def image_upload_paths(name):
+    """Return (partial file, progress file, final path) for an uploaded image"""
+    directory = IMAGE_DIRS[0]
+    return (os.path.join(directory, f".{name}.part"),
+            os.path.join(directory, f".{name}.upload.json"),
+            os.path.join(directory, name))
+
+
+def validate_image_name(name):
+    if not re.fullmatch(IMAGE_NAME_PATTERN, name) or not name.lower().endswith(IMAGE_EXTENSIONS):
+        raise ApiError(f"Invalid image name. Use letters, digits, '.', '_' or '-' and one of: {', '.join(IMAGE_EXTENSIONS)}")
+
+
+def find_image(name):
+    """Return the path of a catalogued image by file name. Raises ApiError"""
+    validate_image_name(name)
+    for directory in IMAGE_DIRS:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+    raise ApiError(f"Unknown image: {name}", 404)
+
+
+def image_etag(st):
+    """ETag of an image file, the same in Flask and --asgi mode"""
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+
+def image_download_headers(name, st):
+    return {
+        "Content-Disposition": f"attachment; filename=\"{name}\"",
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{image_etag(st)}"',
+        "Last-Modified": http_date(st.st_mtime)
+    }
+
+
+def data_extents(path):
+    """Return the (offset, length) ranges of a file that hold data
+
+    Holes in sparse files are skipped using SEEK_DATA/SEEK_HOLE. Filesystems
+    without them report the whole file as data.
+    """
+    size = os.path.getsize(path)
+    extents = []
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO: # only a hole remains
+                    break
+                return [(0, size)] if size else []
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            extents.append((start, end - start))
+            offset = end
+    finally:
+        os.close(fd)
+    return extents
+
+
+def file_sha256(path):
+    """SHA-256 of a file, hashing holes from memory instead of reading them"""
+    digest = hashlib.sha256()
+    position = 0
+    with open(path, 'rb') as f:
+        for start, length in data_extents(path) + [(os.path.getsize(path), 0)]:
+            while position < start:
+                step = min(IMAGE_TRANSFER_BLOCK_BYTES, start - position)
+                digest.update(memoryview(ZERO_BLOCK)[:step])
+                position += step
+            f.seek(start)
+            while position < start + length:
+                block = f.read(min(IMAGE_TRANSFER_BLOCK_BYTES, start + length - position))
+                if not block:
+                    break
+                digest.update(block)
+                position += len(block)
+    return digest.hexdigest()
+
+
+def parse_image_chunk(name, headers, args):
+    """Open the upload a PUT /images/<name> request belongs to
+
+    Returns (upload, start, length, zero_range, chunk_sha256). Without a
+    Content-Range header the body is the whole image.
+    """
+    validate_image_name(name)
+    content_range = headers.get('Content-Range')
+    try:
+        if content_range:
+            match = re.fullmatch(r'bytes (\d+)-(\d+)/(\d+)', content_range.strip())
+            if not match:
+                raise ValueError("Content-Range must be 'bytes <start>-<end>/<size>'")
+            start, end, size = (int(value) for value in match.groups())
+            if end < start or end >= size:
+                raise ValueError("Content-Range is outside the image")
+            length = end - start + 1
+        else:
+            start = 0
+            size = length = int(headers.get('Content-Length', ''))
+    except ValueError as e:
+        raise ApiError(f"Invalid parameters: {str(e)}")
+
+    zero_range = headers.get('X-Zero-Range', '').lower() in ('1', 'true')
+    if zero_range and int(headers.get('Content-Length') or 0):
+        raise ApiError("X-Zero-Range chunks must have an empty body")
+
+    upload = ImageUpload.open(
+        name, size,
+        (headers.get('X-Image-Sha256') or '').lower() or None,
+        args.get('overwrite') in ('1', 'true')
+    )
+    return upload, start, length, zero_range, (headers.get('X-Chunk-Sha256') or '').lower() or None
+
+
+def image_upload_response(upload, image):
+    """JSON payload for a PUT /images/<name> chunk"""
+    if image is not None:
+        return {
+            "status": "success",
+            "message": f"Image {upload.name} uploaded",
+            "image": image
+        }, 200
+    return {
+        "status": "processing",
+        "message": f"Received {upload.received_bytes()} of {upload.state['size']} bytes",
+        "upload": upload.status()
+    }, 202
+
+
+def read_qcow2_backing_file(path):
+    """Return the backing file name stored in a qcow2 header, or None"""
+    with open(path, 'rb') as f:
+        header = f.read(20)
+        if len(header) < 20 or header[:4] != b'QFI\xfb':
+            return None
+        offset = int.from_bytes(header[8:16], 'big')
+        size = int.from_bytes(header[16:20], 'big')
+        if not offset:
+            return None
+        f.seek(offset)
+        return f.read(size).decode(errors='replace')
+
+
+def list_overlays():
+    """Describe the overlay images in OVERLAY_DIR, oldest first"""
+    if not os.path.isdir(OVERLAY_DIR):
+        return []
+
+    # A saved state's RAM refers to its overlay, so the overlay must outlive it
+    saved = {}
+    for state in list_saved_states():
+        path = saved_state_overlay(state)
+        if path:
+            saved.setdefault(path, state["name"])
+
+    overlays = []
+    with VM_LOCK:
+        for name in os.listdir(OVERLAY_DIR):
+            path = os.path.join(OVERLAY_DIR, name)
+            if not name.endswith(".qcow2") or not os.path.isfile(path):
+                continue
+            try:
+                info = os.stat(path)
+                backing = read_qcow2_backing_file(path)
+            except OSError:
+                continue
+            overlays.append({
+                "name": name,
+                "path": path,
+                "size_bytes": info.st_size,
+                "modified_at": info.st_mtime,
+                "backing_file": backing,
+                "vm_id": find_disk_owner(None, [os.path.realpath(path)]),
+                "saved_state": saved.get(os.path.realpath(path))
+            })
+
+    overlays.sort(key=lambda overlay: overlay["modified_at"])
+    return overlays
+
+
+async def run_qemu_img(vm, *args):
+    """Run qemu-img, copying its output to the VM log. Returns the exit code"""
+    process = await asyncio.create_subprocess_exec(
+        QEMU_IMG_BINARY, *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT
+    )
+    output, _ = await process.communicate()
+    for line in output.decode(errors='replace').splitlines():
+        if line.strip():
+            vm.push_output(line.strip())
+    return process.returncode
+
+
+async def create_overlay(vm, overlay):
+    """Create a qcow2 overlay on top of the VM's primary disk"""
+    os.makedirs(OVERLAY_DIR, exist_ok=True)
+
+    started = time.monotonic()
+    returncode = await run_qemu_img(
+        vm, "create", "-q", "-f", "qcow2", "-F", overlay.get("backing_format", "qcow2"),
+        "-b", overlay["backing"], overlay["path"]
+    )
+    if returncode != 0:
+        raise RuntimeError(f"qemu-img could not create overlay {overlay['path']}")
+
+    vm.push_output(f"Created overlay {overlay['path']} in {time.monotonic() - started:.3f}s")
+
+
+async def release_overlay(vm, overlay):
+    """Commit, discard or keep a VM's overlay once QEMU has exited"""
+    path = overlay["path"]
+    if not os.path.exists(path):
+        return
+
+    action = overlay["on_stop"]
+    if action == "commit":
+        with VM_LOCK:
+            sharer = find_disk_owner(vm.vm_id, [overlay["backing"]])
+        if sharer:
+            vm.push_output(f"Not committing overlay: {overlay['backing']} is in use by VM {sharer}. Overlay kept.")
+            action = "keep"
+        elif await run_qemu_img(vm, "commit", "-q", path) != 0:
+            vm.push_output("Overlay commit failed. Overlay kept.")
+            action = "keep"
+
+    if action in ("commit", "discard"):
+        os.remove(path)
+    vm.push_output(f"Overlay {os.path.basename(path)}: {action}")
+
+
+async def run_probe(*args):
+    """Run a short-lived QEMU command and return (exit code, output)"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+    except OSError as e:
+        return None, str(e)
+
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), DISK_IO_PROBE_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return None, "timed out"
+    return process.returncode, output.decode(errors='replace')
+
+
+async def probe_disk_io_support():
+    """Find out which disk I/O options the installed QEMU accepts
+
+    AIO backends are checked by opening a scratch file through qemu-img
+    with each backend; iothreads and virtio-blk multiqueue by asking
+    qemu-system for its object and device properties.
+    """
+    global DISK_IO_SUPPORT
+
+    os.makedirs(OVERLAY_DIR, exist_ok=True)
+    probe_path = os.path.join(OVERLAY_DIR, f".aio-probe-{os.getpid()}.raw")
+    with open(probe_path, "wb") as f:
+        f.truncate(1024 * 1024)
+
+    aio_modes = []
+    try:
+        for mode in DISK_AIO_MODES:
+            # Linux native AIO only works with O_DIRECT
+            direct = ",cache.direct=on" if mode == "native" else ""
+            returncode, output = await run_probe(
+                QEMU_IMG_BINARY, "info", "--image-opts",
+                f"driver=raw,file.driver=file,file.filename={probe_path},file.aio={mode}{direct}"
+            )
+            if returncode == 0:
+                aio_modes.append(mode)
+            else:
+                detail = output.strip().splitlines()[-1] if output.strip() else f"exit code {returncode}"
+                print(f"Disk I/O probe: aio={mode} unavailable: {detail}")
+    finally:
+        os.remove(probe_path)
+
+    _, objects = await run_probe(QEMU_SYSTEM_BINARY, "-object", "help")
+    _, blk_options = await run_probe(QEMU_SYSTEM_BINARY, "-device", "virtio-blk-pci,help")
+
+    DISK_IO_SUPPORT = {
+        "aio": aio_modes,
+        "iothread": bool(re.search(r'^\s*iothread\b', objects, re.M)) and "iothread=" in blk_options,
+        "num_queues": "num-queues=" in blk_options
+    }
+    print(f"Disk I/O support: {DISK_IO_SUPPORT}")
+    return DISK_IO_SUPPORT
+
+
+async def probe_network_support():
+    """Find out which netdev backends the installed QEMU offers
+
+    QEMU 7.2 added the "stream" backend for socket links; older versions
+    only have "socket". vhost-net also needs access to /dev/vhost-net.
+    """
+    global NETWORK_SUPPORT
+
+    returncode, output = await run_probe(QEMU_SYSTEM_BINARY, "-netdev", "help")
+    backends = [line.strip() for line in output.splitlines()[1:]
+                if re.fullmatch(r'[a-z][a-z0-9-]*', line.strip())] if returncode == 0 else []
+    if not backends:
+        print(f"Network probe: no netdev backends listed, options will not be checked: {output.strip()}")
+        return None
+
+    NETWORK_SUPPORT = {
+        "backends": backends,
+        "vhost_net": os.access(VHOST_NET_PATH, os.R_OK | os.W_OK)
+    }
+    print(f"Network support: {NETWORK_SUPPORT}")
+    return NETWORK_SUPPORT
+
+
+def saved_state_paths(name):
+    """Return (state_file, metadata_file) for a saved state name"""
+    base = os.path.join(SAVED_STATE_DIR, name)
+    return base + ".state", base + ".json"
+
+
+def load_saved_state(name):
+    """Read a saved state's metadata. Raises ApiError if it does not exist"""
+    if not re.fullmatch(r'[a-zA-Z0-9_-]{1,64}', name):
+        raise ApiError("Invalid saved state name")
+
+    state_path, meta_path = saved_state_paths(name)
+    if not (os.path.exists(state_path) and os.path.exists(meta_path)):
+        raise ApiError(f"Unknown saved state: {name}", 404)
+
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def list_saved_states():
+    """Return the metadata of all saved states, newest first"""
+    if not os.path.isdir(SAVED_STATE_DIR):
+        return []
+
+    states = []
+    for filename in os.listdir(SAVED_STATE_DIR):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            states.append(load_saved_state(filename[:-5]))
+        except (ApiError, OSError, ValueError):
+            continue
+
+    states.sort(key=lambda state: state["created_at"], reverse=True)
+    return states
+
+
+def saved_state_overlay(state):
+    """The overlay in OVERLAY_DIR that a saved state boots from, or None"""
+    path = state.get("overlay") or state.get("config", {}).get("primary_disk_path") or ""
+    path = os.path.realpath(path)
+    return path if os.path.dirname(path) == os.path.realpath(OVERLAY_DIR) else None
+
+
+def save_vm_state(vm, state_path):
+    """Pause a VM and migrate its full machine state into state_path
+
+    Blocking; runs in an executor. The guest is left paused on success.
+    """
+    vm.qmp_execute("stop")
+    vm.qmp_execute("migrate-set-parameters", {"max-bandwidth": SAVE_STATE_MAX_BANDWIDTH})
+    vm.qmp_execute("migrate", {"uri": f"exec:cat > {shlex.quote(state_path)}"})
+
+    deadline = time.monotonic() + SAVE_STATE_TIMEOUT_SECONDS
+    while True:
+        info = vm.qmp_execute("query-migrate")
+        status = info.get("status")
+        if status == "completed":
+            return
+        if status in ("failed", "cancelled"):
+            raise QMPError(info.get("error-desc", f"Migration {status}"))
+        if time.monotonic() > deadline:
+            vm.qmp_execute("migrate_cancel")
+            raise QMPError(f"Saving state took longer than {SAVE_STATE_TIMEOUT_SECONDS}s")
+        time.sleep(SAVE_STATE_POLL_SECONDS)
+
+
+async def suspend_vm_async(vm, process, name):
+    """Save a VM's machine state under name, then shut QEMU down
+
+    Returns the saved state's metadata. On failure the guest is resumed and
+    ApiError is raised.
+    """
+    state_path, meta_path = saved_state_paths(name)
+    os.makedirs(SAVED_STATE_DIR, exist_ok=True)
+    loop = asyncio.get_running_loop()
+
+    started = time.monotonic()
+    try:
+        await loop.run_in_executor(None, save_vm_state, vm, state_path)
+    except Exception as e:
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        try:
+            await loop.run_in_executor(None, vm.qmp_execute, "cont")
+        except Exception:
+            pass
+        if vm.process is process:
+            vm.set_state("running")
+        raise ApiError(f"Failed to save VM state: {str(e)}", 500)
+
+    save_seconds = round(time.monotonic() - started, 3)
+    vm.push_output(f"Saved machine state to {state_path} in {save_seconds}s")
+
+    # The saved RAM refers to the disk as it is now, so an overlay must survive
+    if vm.overlay is not None:
+        vm.overlay["on_stop"] = "keep"
+
+    await stop_process(process)
+    if vm.overlay is None:
+        finish_vm(vm, process)
+
+    # Disk times are taken after QEMU has exited and flushed its images
+    metadata = {
+        "name": name,
+        "vm_id": vm.vm_id,
+        "created_at": time.time(),
+        "save_seconds": save_seconds,
+        "size_bytes": os.path.getsize(state_path),
+        "config": vm.start_params,
+        "overlay": vm.overlay["path"] if vm.overlay else None,
+        "disk_mtimes": {path: os.path.getmtime(path) for path in vm.config.get("disks", []) if os.path.exists(path)}
+    }
+    with open(meta_path, "w") as f:
+        json.dump(metadata, f, indent=2)
+
+    return metadata
+
+
+def run_on_io_loop(coro):
+    """Schedule a coroutine on IO_LOOP from any thread
+
+    Starts the background loop thread on first use unless the loop is
+    already being run by the ASGI server. Returns a concurrent.futures.Future.
+    """
+    global IO_THREAD
+
+    with IO_LOOP_LOCK:
+        if IO_THREAD is None and not IO_LOOP.is_running():
+            IO_THREAD = threading.Thread(target=IO_LOOP.run_forever, daemon=True)
+            IO_THREAD.start()
+
+    return asyncio.run_coroutine_threadsafe(coro, IO_LOOP)
+
+
+async def read_output(stream, push_line):
+    """Read process output line by line and hand each line to push_line"""
+    while True:
+        try:
+            line = await stream.readline()
+        except ValueError:
+            push_line(f"ERROR: Output line longer than {PROCESS_LINE_LIMIT} bytes skipped")
+            continue
+        except Exception as e:
+            push_line(f"ERROR: {str(e)}")
+            break
+
+        if not line:
+            break
+        push_line(line.decode(errors='replace').strip())
+
+
+async def stop_process(process, timeout=PROCESS_STOP_TIMEOUT_SECONDS):
+    """Terminate a subprocess, killing it if it does not exit within timeout"""
+    try:
+        process.terminate()
+    except ProcessLookupError:
+        return
+
+    try:
+        await asyncio.wait_for(process.wait(), timeout)
+    except asyncio.TimeoutError:
+        print("Process didn't stop gracefully, killing...")
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+
+async def wait_until_async(predicate, timeout):
+    """Wait without blocking the loop until predicate() is true
+
+    The predicate is re-checked whenever an event is published, which
+    covers every VM state change. Returns False on timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        cursor = EVENT_BUFFER.last_seq()
+        if predicate():
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        await EVENT_BUFFER.wait_async(cursor, remaining)
+
+
+def finish_vm(vm, process):
+    """Record that a VM's QEMU process has exited
+
+    Safe to call more than once; does nothing if a newer start of the same
+    VM already owns the entry.
+    """
+    with VM_LOCK:
+        if vm.process is not process:
+            return
+
+        vm.exit_code = process.returncode if process else None
+        vm.process = None
+        if vm.stop_requested_at is not None:
+            observe_metric(VM_STOP_SECONDS, time.monotonic() - vm.stop_requested_at)
+            vm.stop_requested_at = None
+        if vm.qmp is not None:
+            vm.qmp.close()
+            vm.qmp = None
+
+        if vm.state == "stopping" or vm.exit_code == 0:
+            vm.set_state("stopped")
+        else:
+            vm.set_state("failed")
+
+
+def wait_for_qmp_ready(vm, process, ready_states=("running",)):
+    """Connect to a VM's QMP socket and wait until the guest is ready
+
+    Returns True once query-status reports one of ready_states, or False if
+    QEMU exits or QMP_READY_MAX_SECONDS passes first. The socket is created
+    by QEMU itself, so connection attempts are retried until it appears.
+    """
+    deadline = time.monotonic() + QMP_READY_MAX_SECONDS
+
+    qmp = QMPClient(vm.qmp_socket_path)
+    while True:
+        if process.returncode is not None or time.monotonic() > deadline:
+            return False
+        try:
+            qmp.connect()
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            time.sleep(0.05)
+        except (OSError, QMPError) as e:
+            vm.push_output(f"ERROR: QMP connection failed: {str(e)}")
+            return False
+
+    vm.qmp = qmp
+    try:
+        status = qmp.execute('query-status')["status"]
+        while status not in ready_states:
+            remaining = deadline - time.monotonic()
+            if process.returncode is not None or remaining <= 0:
+                return False
+            # Re-check after any run state change (e.g. an incoming migration finishing)
+            qmp.wait_event(("RESUME", "STOP", "SHUTDOWN"), min(remaining, 1.0))
+            status = qmp.execute('query-status')["status"]
+    except QMPError as e:
+        vm.push_output(f"ERROR: QMP status check failed: {str(e)}")
+        return False
+
+    return True
+
+
+def rank_host_cpus():
+    """Host CPUs ordered fastest first
+
+    Uses cpu_capacity where the kernel exposes it (big.LITTLE), otherwise
+    the maximum frequency, so performance cores come before efficiency cores.
+    """
+    def speed(cpu):
+        for name in ("cpu_capacity", "cpufreq/cpuinfo_max_freq"):
+            try:
+                with open(f"/sys/devices/system/cpu/cpu{cpu}/{name}") as f:
+                    return int(f.read())
+            except (OSError, ValueError):
+                continue
+        return 0
+    return sorted(HOST_CPUS, key=lambda cpu: (-speed(cpu), cpu))
+
+
+def reset_cpu_affinity(pid):
+    """Let every thread of a child use all host CPUs, not just the control plane's
+
+    Children inherit the control plane's affinity. It is reset from here after
+    the spawn because a preexec_fn is not safe in a multi-threaded server.
+    """
+    try:
+        threads = [thread.id for thread in psutil.Process(pid).threads()]
+    except psutil.Error:
+        threads = [pid]
+    for tid in threads:
+        try:
+            os.sched_setaffinity(tid, HOST_CPUS)
+        except OSError:
+            pass
+
+
+def update_control_plane_affinity():
+    """Move this server's threads to the CPUs no guest is pinned to"""
+    global CONTROL_PLANE_CPUS
+
+    with VM_LOCK:
+        pinned = {entry["host_cpu"] for vm in VMS.values() if vm.cpu_placement
+                  for entry in vm.cpu_placement["vcpus"]}
+    free = [cpu for cpu in HOST_CPUS if cpu not in pinned] or list(HOST_CPUS)
+    if free == CONTROL_PLANE_CPUS:
+        return
+
+    # Affinity is per thread; threads started later inherit it
+    for tid in os.listdir("/proc/self/task"):
+        try:
+            os.sched_setaffinity(int(tid), free)
+        except OSError:
+            pass
+    CONTROL_PLANE_CPUS = free
+    print(f"Control plane CPUs: {free}")
+
+
+def pin_vm_cpus(vm):
+    """Pin a ready VM's vCPU threads according to its cpu_pinning policy
+
+    vCPU threads are found with QMP query-cpus-fast and each gets one host
+    CPU, preferring CPUs no other guest is pinned to. QEMU's remaining
+    threads (main loop, I/O) share the VM's CPUs.
+    """
+    policy = vm.start_params.get("cpu_pinning", "off")
+    if not CPU_PINNING_SUPPORTED:
+        return
+    if policy == "off":
+        # Threads QEMU started before the reset after spawn
+        reset_cpu_affinity(vm.process.pid)
+        return
+
+    vcpus = vm.qmp_execute('query-cpus-fast')
+    if isinstance(policy, list):
+        candidates = policy
+    else:
+        ranked = rank_host_cpus()
+        reserve = CONTROL_PLANE_RESERVED_CPUS if len(ranked) > CONTROL_PLANE_RESERVED_CPUS else 0
+        candidates = ranked[:len(ranked) - reserve]
+
+    with VM_LOCK:
+        used = collections.Counter(entry["host_cpu"] for other in VMS.values()
+                                   if other is not vm and other.cpu_placement
+                                   for entry in other.cpu_placement["vcpus"])
+        # Least shared first; the sort is stable, so speed order breaks ties
+        order = sorted(candidates, key=lambda cpu: used[cpu])
+        placement = [{"vcpu": cpu["cpu-index"], "thread_id": cpu["thread-id"], "host_cpu": order[i % len(order)]}
+                     for i, cpu in enumerate(vcpus)]
+        vm.cpu_placement = {
+            "policy": "cpus" if isinstance(policy, list) else policy,
+            "vcpus": placement,
+            "emulator_cpus": sorted({entry["host_cpu"] for entry in placement}),
+            "shared": any(used[entry["host_cpu"]] for entry in placement) or len(vcpus) > len(order)
+        }
+
+    for entry in placement:
+        os.sched_setaffinity(entry["thread_id"], {entry["host_cpu"]})
+    vcpu_threads = {entry["thread_id"] for entry in placement}
+    for thread in psutil.Process(vm.process.pid).threads():
+        if thread.id not in vcpu_threads:
+            try:
+                os.sched_setaffinity(thread.id, vm.cpu_placement["emulator_cpus"])
+            except OSError:
+                pass
+
+    vm.push_output(f"Pinned vCPUs to host CPUs {[entry['host_cpu'] for entry in placement]}")
+    update_control_plane_affinity()
+
+
+def release_vm_cpus(vm):
+    """Give a stopped VM's pinned CPUs back to the control plane"""
+    if vm.cpu_placement is None:
+        return
+    vm.cpu_placement = None
+    update_control_plane_affinity()
+
+
+def balloon_size_mb(vm):
+    """The memory a ballooned guest currently has, in MB"""
+    return vm.qmp_execute('query-balloon')["actual"] // (1024 * 1024)
+
+
+def set_balloon_target(vm, target_mb):
+    """Ask a guest's balloon driver to grow or shrink the guest to target_mb"""
+    vm.qmp_execute('balloon', {"value": target_mb * 1024 * 1024})
+    vm.push_output(f"Balloon target set to {target_mb} MB")
+
+
+def balloon_policy_step():
+    """Reclaim memory from auto_reclaim guests while the host runs short
+
+    Below BALLOON_HOST_FREE_THRESHOLD_MB of available host memory, the guest
+    with the most memory shrinks by BALLOON_STEP_MB (never below
+    BALLOON_MIN_FRACTION of its RAM). Above twice the threshold, the guest
+    that gave up the most grows back by one step. Returns the action taken.
+    """
+    with VM_LOCK:
+        guests = [vm for vm in VMS.values()
+                  if vm.running and (vm.start_params.get("memory") or {}).get("auto_reclaim")]
+    if not guests:
+        return None
+
+    available_mb = psutil.virtual_memory().available // (1024 * 1024)
+    sizes = {}
+    for vm in guests:
+        try:
+            sizes[vm.vm_id] = balloon_size_mb(vm)
+        except Exception as e:
+            print(f"Balloon policy: cannot query {vm.vm_id}: {e}")
+
+    if available_mb < BALLOON_HOST_FREE_THRESHOLD_MB:
+        candidates = [vm for vm in guests if vm.vm_id in sizes
+                      and sizes[vm.vm_id] - BALLOON_STEP_MB >= vm.config["ram_mb"] * BALLOON_MIN_FRACTION]
+        if candidates:
+            vm = max(candidates, key=lambda vm: sizes[vm.vm_id])
+            set_balloon_target(vm, sizes[vm.vm_id] - BALLOON_STEP_MB)
+            return ("shrink", vm.vm_id)
+    elif available_mb > 2 * BALLOON_HOST_FREE_THRESHOLD_MB:
+        candidates = [vm for vm in guests if vm.vm_id in sizes and sizes[vm.vm_id] < vm.config["ram_mb"]]
+        if candidates:
+            vm = max(candidates, key=lambda vm: vm.config["ram_mb"] - sizes[vm.vm_id])
+            set_balloon_target(vm, min(sizes[vm.vm_id] + BALLOON_STEP_MB, vm.config["ram_mb"]))
+            return ("grow", vm.vm_id)
+    return None
+
+
+async def balloon_policy_loop():
+    """Run balloon_policy_step every BALLOON_CHECK_INTERVAL_SECONDS"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(BALLOON_CHECK_INTERVAL_SECONDS)
+        try:
+            await loop.run_in_executor(None, balloon_policy_step)
+        except Exception as e:
+            print(f"Balloon policy error: {e}")
+
+
+async def supervise_qemu(vm, command):
+    """Run a VM's QEMU process (command is an argv list) on IO_LOOP until it exits
+
+    Output is read by coroutines instead of reader threads. The blocking
+    QMP readiness check runs in the loop's executor only while starting.
+    """
+    print(f"Starting QEMU [{vm.vm_id}]: {shlex.join(command)}")
+
+    ready_event = vm.ready_event
+    overlay = vm.overlay
+    pooled = vm.pool_profile is not None
+    process = None
+    try:
+        os.makedirs(QMP_SOCKET_DIR, exist_ok=True)
+        if os.path.exists(vm.qmp_socket_path):
+            os.remove(vm.qmp_socket_path)
+
+        if overlay is not None:
+            await create_overlay(vm, overlay)
+
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=PROCESS_LINE_LIMIT
+        )
+        if CPU_PINNING_SUPPORTED:
+            reset_cpu_affinity(process.pid)
+
+        vm.process = process
+        vm.started_at = time.time()
+        launched = time.monotonic()
+        print(f"QEMU [{vm.vm_id}] started with PID: {process.pid}")
+
+        readers = [
+            asyncio.ensure_future(read_output(process.stdout, vm.push_output)),
+            asyncio.ensure_future(read_output(process.stderr, vm.push_output))
+        ]
+
+        # Pooled guests start with -S and are ready once they sit paused
+        loop = asyncio.get_running_loop()
+        ready_states = ("prelaunch", "paused") if pooled else ("running",)
+        if await loop.run_in_executor(None, wait_for_qmp_ready, vm, process, ready_states):
+            try:
+                await loop.run_in_executor(None, pin_vm_cpus, vm)
+            except Exception as e:
+                vm.push_output(f"WARNING: CPU pinning failed, vCPUs stay unpinned: {str(e)}")
+            try:
+                await loop.run_in_executor(None, add_backup_bitmaps, vm)
+            except Exception as e:
+                vm.push_output(f"WARNING: Dirty bitmaps unavailable, backups will be full: {str(e)}")
+            vm.set_state("pooled" if pooled else "running")
+            ready_event.set()
+            observe_metric(VM_START_SECONDS, time.monotonic() - launched)
+            print(f"QEMU [{vm.vm_id}] is {vm.state}")
+
+        # Wait for process to complete
+        await process.wait()
+
+        # Let the readers drain so QEMU's exit message reaches the log
+        await asyncio.wait(readers, timeout=1)
+
+    except FileNotFoundError:
+        error_msg = "QEMU executable not found. Please install QEMU."
+        print(f"ERROR: {error_msg}")
+        vm.push_output(error_msg)
+    except Exception as e:
+        error_msg = f"Failed to start QEMU: {str(e)}"
+        print(f"ERROR: {error_msg}")
+        vm.push_output(error_msg)
+    finally:
+        if overlay is not None:
+            # The VM stays "stopping" until its overlay has been dealt with
+            try:
+                await release_overlay(vm, overlay)
+            except Exception as e:
+                vm.push_output(f"ERROR: Failed to release overlay: {str(e)}")
+            vm.overlay = None
+        finish_vm(vm, process)
+        release_vm_cpus(vm)
+        ready_event.set()
+        print(f"QEMU [{vm.vm_id}] process terminated")
+
+        # Pooled guests that were never handed out leave no registry entry
+        if vm.pool_profile is not None:
+            with VM_LOCK:
+                if VMS.get(vm.vm_id) is vm:
+                    del VMS[vm.vm_id]
+
+
+def find_qemu_process(vm):
+    """Return the psutil.Process for a VM's QEMU binary
+
+    QEMU is executed directly, so this is the process that was spawned.
+    Its children (such as qemu-bridge-helper) are not QEMU.
+    """
+    cached = vm.metrics_state.get("ps_process")
+    if cached is not None and cached.is_running():
+        return cached
+
+    ps_process = psutil.Process(vm.process.pid)
+    vm.metrics_state["ps_process"] = ps_process
+    return ps_process
+
+
+def rate(current, previous, key, elapsed):
+    """Per-second rate of a counter between two raw readings, or None"""
+    if previous is None or key not in previous or key not in current or elapsed <= 0:
+        return None
+    return round(max(current[key] - previous[key], 0) / elapsed, 1)
+
+
+def sample_vm(vm):
+    """Take one metrics sample of a running VM
+
+    Counters (I/O bytes, block operations, per-thread CPU time) are turned
+    into per-second rates against the previous sample, which is kept in
+    vm.metrics_state. Returns a flat dict so samples downsample uniformly.
+    """
+    now = time.time()
+    state = vm.metrics_state
+    previous = state.get("raw")
+    elapsed = now - state["time"] if "time" in state else 0
+    raw = {}
+    sample = {"t": round(now, 3)}
+
+    ps_process = find_qemu_process(vm)
+    with ps_process.oneshot():
+        sample["cpu_percent"] = ps_process.cpu_percent(interval=None)
+        sample["rss_mb"] = round(ps_process.memory_info().rss / (1024 * 1024), 1)
+        sample["threads"] = ps_process.num_threads()
+        try:
+            io = ps_process.io_counters()
+            raw["io_read"] = io.read_bytes
+            raw["io_write"] = io.write_bytes
+        except (AttributeError, psutil.AccessDenied):
+            pass
+        thread_times = {t.id: t.user_time + t.system_time for t in ps_process.threads()}
+
+    sample["io_read_bps"] = rate(raw, previous, "io_read", elapsed)
+    sample["io_write_bps"] = rate(raw, previous, "io_write", elapsed)
+
+    counters = network_counters(vm)
+    if counters is not None:
+        raw["net_rx"] = counters["rx_bytes"]
+        raw["net_tx"] = counters["tx_bytes"]
+        sample["net_rx_bps"] = rate(raw, previous, "net_rx", elapsed)
+        sample["net_tx_bps"] = rate(raw, previous, "net_tx", elapsed)
+
+    try:
+        for entry in vm.qmp_execute('query-blockstats'):
+            name = entry.get("device") or entry.get("node-name") or entry.get("qdev", "?")
+            stats = entry["stats"]
+            for key, field in (("rd_bytes", "rd_bps"), ("wr_bytes", "wr_bps"),
+                               ("rd_operations", "rd_iops"), ("wr_operations", "wr_iops")):
+                raw_key = f"block.{name}.{key}"
+                raw[raw_key] = stats.get(key, 0)
+                sample[f"block.{name}.{field}"] = rate(raw, previous, raw_key, elapsed)
+
+        for cpu in vm.qmp_execute('query-cpus-fast'):
+            raw_key = f"vcpu.{cpu['cpu-index']}.time"
+            if cpu.get("thread-id") in thread_times:
+                raw[raw_key] = thread_times[cpu["thread-id"]]
+                cpu_rate = rate(raw, previous, raw_key, elapsed)
+                sample[f"vcpu.{cpu['cpu-index']}.cpu_percent"] = (
+                    round(cpu_rate * 100, 1) if cpu_rate is not None else None)
+    except QMPError as e:
+        print(f"Metrics: QMP query failed for VM {vm.vm_id}: {str(e)}")
+
+    state["raw"] = raw
+    state["time"] = now
+    return sample
+
+
+def metrics_sampler_thread():
+    """Sample all running VMs while someone is reading /vm_metrics
+
+    Sampling stops after METRICS_IDLE_SECONDS without a reader, and the
+    thread then sleeps until the next /vm_metrics request wakes it up.
+    """
+    while True:
+        if time.monotonic() - METRICS_LAST_READ > METRICS_IDLE_SECONDS:
+            METRICS_WAKE.wait()
+            METRICS_WAKE.clear()
+            continue
+
+        with VM_LOCK:
+            running = [vm for vm in VMS.values() if vm.running]
+
+        for vm in running:
+            try:
+                vm.metrics.append(sample_vm(vm))
+            except (psutil.Error, AttributeError) as e:
+                # The VM stopped while being sampled
+                vm.metrics_state = {}
+                print(f"Metrics: sampling VM {vm.vm_id} failed: {str(e)}")
+
+        time.sleep(METRICS_SAMPLE_INTERVAL_SECONDS)
+
+
+def touch_metrics_sampler():
+    """Record a metrics read, starting or waking the sampler if needed"""
+    global METRICS_LAST_READ, METRICS_THREAD
+
+    METRICS_LAST_READ = time.monotonic()
+    with VM_LOCK:
+        if METRICS_THREAD is None:
+            METRICS_THREAD = threading.Thread(target=metrics_sampler_thread, daemon=True)
+            METRICS_THREAD.start()
+    METRICS_WAKE.set()
+
+
+def downsample(samples, points):
+    """Average consecutive samples into at most `points` buckets
+
+    Returns a column-oriented dict ({"t": [...], "cpu_percent": [...]}) that
+    charts can consume directly. Missing values are skipped when averaging.
+    """
+    if not samples:
+        return {}
+
+    size = max(math.ceil(len(samples) / points), 1)
+    keys = []
+    for sample in samples:
+        for key in sample:
+            if key not in keys:
+                keys.append(key)
+
+    series = {key: [] for key in keys}
+    for start in range(0, len(samples), size):
+        bucket = samples[start:start + size]
+        for key in keys:
+            if key == "t":
+                series[key].append(bucket[-1]["t"])
+                continue
+            values = [sample[key] for sample in bucket if sample.get(key) is not None]
+            series[key].append(round(sum(values) / len(values), 2) if values else None)
+
+    return series
+
+
+def submit_job(command):
+    """Queue a terminal command. Raises ApiError when the queue is full"""
+    with JOBS_LOCK:
+        queued = sum(1 for job in JOBS.values() if job.state == "queued")
+        if queued >= MAX_QUEUED_JOBS:
+            raise ApiError(f"Too many queued commands ({MAX_QUEUED_JOBS}), try again later", 429)
+
+        job = TerminalJob(command)
+        JOBS[job.job_id] = job
+
+        # Forget the oldest finished jobs beyond the history limit
+        finished = [job_id for job_id, old in JOBS.items() if old.finished]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY_SIZE)]:
+            del JOBS[job_id]
+
+    run_on_io_loop(run_job(job))
+    return job
+
+
+def get_job(job_id):
+    with JOBS_LOCK:
+        return JOBS.get(job_id)
+
+
+async def run_job(job):
+    """Run a terminal job once one of MAX_RUNNING_JOBS slots is free"""
+    global JOB_SLOTS
+
+    if JOB_SLOTS is None:
+        JOB_SLOTS = asyncio.Semaphore(MAX_RUNNING_JOBS)
+
+    async with JOB_SLOTS:
+        if job.state != "queued":
+            # Cancelled while waiting for a slot
+            return
+
+        job.state = "running"
+        job.started_at = time.time()
+        job.push_output(f"$ {job.command}")
+        print(f"Executing [{job.job_id}]: {job.command}")
+
+        try:
+            # Own process group, so cancelling also stops the command's children
+            job.process = await asyncio.create_subprocess_shell(
+                job.command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                limit=PROCESS_LINE_LIMIT,
+                start_new_session=True
+            )
+
+            await read_output(job.process.stdout, job.push_output)
+
+            await job.process.wait()
+            job.exit_code = job.process.returncode
+            if job.state == "running":
+                job.state = "finished"
+            job.push_output(f"[Command finished with exit code {job.exit_code}]")
+            print(f"Command finished [{job.job_id}]: exit code {job.exit_code}")
+
+        except Exception as e:
+            job.state = "failed"
+            error_msg = f"ERROR: Command execution failed: {str(e)}"
+            job.push_output(error_msg)
+            print(error_msg)
+        finally:
+            job.finished_at = time.time()
+
+
+async def cancel_job(job):
+    """Stop a queued or running job, killing its whole process group"""
+    if job.finished:
+        return
+
+    process = job.process
+    job.state = "cancelled"
+    if process is None:
+        job.finished_at = time.time()
+        return
+
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            await asyncio.wait_for(process.wait(), PROCESS_STOP_TIMEOUT_SECONDS)
+            return
+        except asyncio.TimeoutError:
+            pass
+
+
+def find_image_job(paths):
+    """Return an unfinished image job that uses any of paths, or None"""
+    with IMAGE_JOBS_LOCK:
+        for job in IMAGE_JOBS.values():
+            if not job.finished and set(paths) & set(job.paths):
+                return job
+    return None
+
+
+def image_job_output_path(path, name, extension):
+    """Resolve a job's "output" name next to the source image"""
+    output_name = name or os.path.splitext(os.path.basename(path))[0] + extension
+    validate_image_name(output_name)
+    return os.path.realpath(os.path.join(os.path.dirname(path), output_name))
+
+
+def build_image_job(name, data):
+    """Validate a POST /images/<name>/jobs request and build its ImageJob
+
+    compact, convert and compress rewrite the image with qemu-img convert;
+    check, map and resize run in place.
+    """
+    path = os.path.realpath(find_image(name))
+    operation = data.get('operation')
+    if operation not in IMAGE_JOB_OPERATIONS:
+        raise ApiError(f"operation must be one of: {', '.join(IMAGE_JOB_OPERATIONS)}")
+
+    image = IMAGE_CATALOG.lookup(path)
+    source_format = image["format"] if image else sniff_image_format(path)
+    params = {}
+    output_path = None
+
+    if operation in ("compact", "convert", "compress"):
+        if operation == "convert":
+            target_format = data.get('format')
+            if target_format not in IMAGE_JOB_FORMATS:
+                raise ApiError(f"format must be one of: {', '.join(IMAGE_JOB_FORMATS)}")
+        else:
+            target_format = "qcow2" if operation == "compress" else source_format
+        params["format"] = target_format
+
+        options = []
+        if operation == "compress":
+            compression = data.get('compression', 'zstd')
+            if compression not in IMAGE_JOB_COMPRESSION:
+                raise ApiError(f"compression must be one of: {', '.join(IMAGE_JOB_COMPRESSION)}")
+            params["compression"] = compression
+            options = ["-c", "-o", f"compression_type={compression}"]
+
+        # compact keeps the name; the others default to the target format's extension
+        extension = os.path.splitext(path)[1] if operation == "compact" else IMAGE_JOB_FORMATS[target_format]
+        output_path = image_job_output_path(path, data.get('output'), extension)
+        if output_path != path and os.path.exists(output_path):
+            raise ApiError(f"Output image {os.path.basename(output_path)} already exists", 409)
+
+        # The result is written beside the source and renamed into place
+        temp_path = os.path.join(os.path.dirname(output_path), f".{os.path.basename(output_path)}.{uuid.uuid4().hex[:8]}.tmp")
+        backing = []
+        if image and image["backing_chain"] and target_format == "qcow2":
+            layer = image["backing_chain"][0]
+            backing = ["-B", layer["path"], "-F", layer["format"] or "qcow2"]
+        command = [QEMU_IMG_BINARY, "convert", "-p", "-f", source_format, "-O", target_format,
+                   *options, *backing, path, temp_path]
+
+        needed = os.stat(path).st_blocks * 512
+        free = shutil.disk_usage(os.path.dirname(output_path)).free
+        if needed + IMAGE_UPLOAD_FREE_SPACE_RESERVE_MB * 1024 * 1024 > free:
+            raise ApiError(f"Not enough disk space: up to {needed} bytes needed, {free} free", 507)
+        return ImageJob(operation, path, command, temp_path, None if output_path == path else output_path, params)
+
+    if operation == "check":
+        repair = data.get('repair')
+        if repair not in (None, "leaks", "all"):
+            raise ApiError("repair must be \"leaks\" or \"all\"")
+        params["repair"] = repair
+        command = [QEMU_IMG_BINARY, "check", "--output=json", "-f", source_format, path]
+        if repair:
+            command[2:2] = ["-r", repair]
+    elif operation == "map":
+        command = [QEMU_IMG_BINARY, "map", "--output=json", "-f", source_format, path]
+    else:
+        size = str(data.get('size', '')).strip()
+        if not re.fullmatch(r'[+-]?\d+[KMGT]?', size):
+            raise ApiError("size must look like 20G, +2G or 10737418240")
+        shrink = bool(data.get('shrink', False))
+        if size.startswith('-') and not shrink:
+            raise ApiError("Shrinking loses data at the end of the disk. Pass \"shrink\": true to confirm")
+        params.update(size=size, shrink=shrink)
+        command = [QEMU_IMG_BINARY, "resize", "-f", source_format, *(["--shrink"] if shrink else []), path, size]
+    return ImageJob(operation, path, command, params=params)
+
+
+def submit_image_job(job):
+    """Queue an image job unless a VM or another job is using its files"""
+    with VM_LOCK:
+        owner = find_disk_owner(None, job.paths)
+        if owner:
+            raise ApiError(f"Image is in use by VM {owner}", 409)
+        other = find_image_job(job.paths)
+        if other:
+            raise ApiError(f"Image is busy with {other.operation} job {other.job_id}", 409)
+
+        with IMAGE_JOBS_LOCK:
+            IMAGE_JOBS[job.job_id] = job
+            finished = [job_id for job_id, old in IMAGE_JOBS.items() if old.finished]
+            for job_id in finished[:max(0, len(finished) - IMAGE_JOB_HISTORY_SIZE)]:
+                del IMAGE_JOBS[job_id]
+
+    publish_event("image_job", job.status())
+    run_on_io_loop(run_image_job(job))
+    return job
+
+
+def lower_io_priority(pid):
+    """Give a maintenance process idle I/O and lowest CPU priority"""
+    try:
+        process = psutil.Process(pid)
+        process.nice(IMAGE_JOB_NICE)
+        if IMAGE_JOB_IO_PRIORITY == "idle":
+            process.ionice(psutil.IOPRIO_CLASS_IDLE)
+        elif IMAGE_JOB_IO_PRIORITY == "low":
+            process.ionice(psutil.IOPRIO_CLASS_BE, 7)
+    except (psutil.Error, AttributeError, OSError) as e:
+        # ionice is Linux-only; the job still runs at normal priority
+        print(f"Image job: could not lower priority of {pid}: {e}")
+
+
+async def read_image_job_output(stream, job, capture=None):
+    """Follow qemu-img output, turning -p progress into job.progress
+
+    qemu-img redraws "(12.34/100%)" with carriage returns, so output is
+    split on both \r and \n. With capture, stdout is collected for JSON
+    parsing instead of being logged.
+    """
+    pending = b""
+    last_published = None
+    while True:
+        chunk = await stream.read(PTY_READ_SIZE)
+        if not chunk:
+            break
+        if capture is not None:
+            capture.extend(chunk)
+            continue
+        pending += chunk
+        *lines, pending = re.split(rb'[\r\n]', pending)
+        for line in lines:
+            text = line.decode(errors='replace').strip()
+            match = re.fullmatch(r'\((\d+(?:\.\d+)?)/100%\)', text)
+            if match:
+                job.progress = float(match.group(1))
+                if last_published is None or job.progress - last_published >= 1:
+                    last_published = job.progress
+                    publish_event("image_job", job.status())
+            elif text:
+                job.output.append(text)
+    if pending.strip():
+        job.output.append(pending.decode(errors='replace').strip())
+
+
+def summarize_image_map(extents):
+    """Reduce qemu-img map output to allocation and fragmentation figures"""
+    data_bytes = zero_bytes = fragments = 0
+    next_offset = None
+    for extent in extents:
+        if extent.get("zero"):
+            zero_bytes += extent["length"]
+        elif extent.get("data"):
+            data_bytes += extent["length"]
+        if extent.get("offset") is not None:
+            if extent["offset"] != next_offset:
+                fragments += 1
+            next_offset = extent["offset"] + extent["length"]
+    return {
+        "data_bytes": data_bytes,
+        "zero_bytes": zero_bytes,
+        "extents": len(extents),
+        "fragments": fragments,
+        "map": extents[:IMAGE_JOB_MAP_EXTENTS],
+        "map_truncated": len(extents) > IMAGE_JOB_MAP_EXTENTS
+    }
+
+
+async def run_image_job(job):
+    """Run an image job once one of MAX_RUNNING_IMAGE_JOBS slots is free"""
+    global IMAGE_JOB_SLOTS
+
+    if IMAGE_JOB_SLOTS is None:
+        IMAGE_JOB_SLOTS = asyncio.Semaphore(MAX_RUNNING_IMAGE_JOBS)
+
+    async with IMAGE_JOB_SLOTS:
+        if job.state != "queued":
+            return
+
+        job.started_at = time.time()
+        job.set_state("running")
+        job.output.append("$ " + " ".join(shlex.quote(arg) for arg in job.command))
+        print(f"Image job [{job.job_id}]: {job.operation} {job.path}")
+        captured = bytearray() if job.operation in ("check", "map") else None
+
+        try:
+            # The image may have been removed or renamed while the job was queued
+            size_before = os.path.getsize(job.path)
+            job.process = await asyncio.create_subprocess_exec(
+                *job.command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True
+            )
+            lower_io_priority(job.process.pid)
+            await asyncio.gather(
+                read_image_job_output(job.process.stdout, job, captured),
+                read_image_job_output(job.process.stderr, job)
+            )
+            await job.process.wait()
+            job.exit_code = job.process.returncode
+
+            if job.state == "cancelled":
+                return
+            # qemu-img check exits with 2 for corruptions and 3 for leaks
+            if job.exit_code != 0 and not (job.operation == "check" and job.exit_code in (2, 3)):
+                raise RuntimeError(f"qemu-img exited with code {job.exit_code}")
+
+            if job.operation == "check":
+                job.result = json.loads(captured)
+            elif job.operation == "map":
+                job.result = await asyncio.get_running_loop().run_in_executor(
+                    None, summarize_image_map, json.loads(captured))
+            elif job.temp_path:
+                destination = job.output_path or job.path
+                os.replace(job.temp_path, destination)
+                job.result = {
+                    "output": os.path.basename(destination),
+                    "size_before": size_before,
+                    "size_after": os.path.getsize(destination)
+                }
+            job.progress = 100.0
+            job.set_state("finished")
+            print(f"Image job [{job.job_id}] finished")
+
+        except Exception as e:
+            job.error = str(e)
+            job.output.append(f"ERROR: {e}")
+            job.set_state("failed")
+            print(f"Image job [{job.job_id}] failed: {e}")
+        finally:
+            job.finished_at = time.time()
+            if job.temp_path and os.path.exists(job.temp_path):
+                os.remove(job.temp_path)
+            for path in job.paths:
+                if os.path.exists(path) and IMAGE_CATALOG.tracks(path):
+                    asyncio.ensure_future(IMAGE_CATALOG.probe(path))
+
+
+async def cancel_image_job(job):
+    """Stop a queued or running image job. Its temporary file is removed"""
+    if job.finished:
+        return
+
+    process = job.process
+    job.finished_at = time.time()
+    job.set_state("cancelled")
+    if process is None:
+        return
+
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            await asyncio.wait_for(process.wait(), PROCESS_STOP_TIMEOUT_SECONDS)
+            return
+        except asyncio.TimeoutError:
+            pass
+
+
+def backup_dir(vm_id):
+    return os.path.join(BACKUP_DIR, vm_id)
+
+
+def load_backup_manifest(vm_id):
+    """Read a VM's backup chain, oldest backup first"""
+    try:
+        with open(os.path.join(backup_dir(vm_id), "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"vm_id": vm_id, "backups": [], "needs_full": False}
+
+
+def save_backup_manifest(manifest):
+    """Replace a VM's manifest.json atomically"""
+    path = os.path.join(backup_dir(manifest["vm_id"]), "manifest.json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def add_backup_bitmaps(vm):
+    """Give every drive of a ready VM the backup dirty bitmap
+
+    qcow2 images store the bitmap, so it survives restarts and a chain can
+    continue across them. A bitmap created here, or one QEMU loaded as
+    inconsistent after a crash, has missed writes, so the drive's next
+    backup must be full.
+    """
+    existing = {}
+    for device in vm.qmp_execute('query-block'):
+        inserted = device.get("inserted") or {}
+        bitmaps = inserted.get("dirty-bitmaps", device.get("dirty-bitmaps", []))
+        existing[device["device"]] = {bitmap.get("name"): bitmap for bitmap in bitmaps}
+
+    for drive, info in vm.config.get("drives", {}).items():
+        bitmap = existing.get(drive, {}).get(BACKUP_BITMAP_NAME)
+        if bitmap is not None and not bitmap.get("inconsistent"):
+            vm.backup_bitmaps[drive] = False
+            continue
+        if bitmap is not None:
+            vm.qmp_execute('block-dirty-bitmap-remove', {"node": drive, "name": BACKUP_BITMAP_NAME})
+        vm.qmp_execute('block-dirty-bitmap-add', {
+            "node": drive,
+            "name": BACKUP_BITMAP_NAME,
+            "persistent": info["format"] == "qcow2"
+        })
+        vm.backup_bitmaps[drive] = True
+
+
+def plan_backup(vm, mode):
+    """Decide between a full and an incremental backup of vm
+
+    Returns (mode, parent backup_id, reason a full backup is needed). An
+    incremental backup needs the same images as the last backup, bitmaps
+    that have tracked every write since it, and no other VM's backup of
+    those images in between (that would have cleared the bitmap).
+    """
+    manifest = load_backup_manifest(vm.vm_id)
+    drives = vm.config.get("drives", {})
+    last = manifest["backups"][-1] if manifest["backups"] else None
+
+    reason = None
+    if last is None:
+        reason = "there is no earlier backup"
+    elif manifest.get("needs_full"):
+        reason = "the last full backup failed or the newest backup was deleted"
+    elif {drive: info["path"] for drive, info in drives.items()} != \
+            {drive: info["image"] for drive, info in last["drives"].items()}:
+        reason = f"the VM's disks changed since backup {last['backup_id']}"
+    elif any(vm.backup_bitmaps.get(drive, True) for drive in drives):
+        reason = "a dirty bitmap was created since the last backup"
+    elif not all(os.path.exists(os.path.join(backup_dir(vm.vm_id), info["file"])) for info in last["drives"].values()):
+        reason = f"files of backup {last['backup_id']} are missing"
+    else:
+        images = {info["path"] for info in drives.values()}
+        for other_id in os.listdir(BACKUP_DIR):
+            if other_id == vm.vm_id or not os.path.isdir(backup_dir(other_id)):
+                continue
+            for entry in load_backup_manifest(other_id)["backups"]:
+                if entry["created_at"] > last["created_at"] and \
+                        images & {info["image"] for info in entry["drives"].values()}:
+                    reason = f"VM {other_id} backed up the same disk since"
+
+    if mode == "incremental" and reason:
+        raise ApiError(f"Incremental backup not possible: {reason}", 409)
+    if mode == "full" or reason:
+        return "full", None, reason
+    return "incremental", last["backup_id"], None
+
+
+def start_backup(data):
+    """Validate a POST /backup request and start the backup on IO_LOOP
+
+    Returns (backup, reason it is full). Raises ApiError when rejected.
+    """
+    try:
+        vm_id = parse_vm_id(data.get('vm_id'))
+    except ValueError as e:
+        raise ApiError(str(e))
+    mode = data.get('mode', 'auto')
+    if mode not in BACKUP_MODES:
+        raise ApiError(f"mode must be one of: {', '.join(BACKUP_MODES)}")
+
+    with VM_LOCK:
+        vm = VMS.get(vm_id)
+        if vm is None or not vm.running:
+            raise ApiError(f"VM {vm_id} is not running", 409)
+        with BACKUPS_LOCK:
+            current = BACKUPS.get(vm_id)
+            if current is not None and not current.finished:
+                raise ApiError(f"Backup {current.backup_id} of VM {vm_id} is still running", 409)
+            mode, parent, reason = plan_backup(vm, mode)
+            drives = {drive: {"image": info["path"], "format": info["format"]}
+                      for drive, info in vm.config["drives"].items()}
+            backup = VMBackup(vm_id, mode, parent, drives)
+            BACKUPS[vm_id] = backup
+
+    publish_event("backup", backup.status())
+    run_on_io_loop(run_backup(vm, backup))
+    return backup, reason
+
+
+async def run_backup(vm, backup):
+    """Copy a running VM's drives with QEMU backup jobs
+
+    A target qcow2 is created per drive and attached with blockdev-add. One
+    transaction starts every drive's job so the backup is consistent across
+    disks; a full backup clears the bitmaps in the same transaction. Jobs
+    are polled with query-jobs until they conclude.
+    """
+    loop = asyncio.get_running_loop()
+
+    def qmp(command, arguments=None):
+        return loop.run_in_executor(None, vm.qmp_execute, command, arguments)
+
+    directory = backup_dir(vm.vm_id)
+    job_ids = {drive: f"backup-{drive}" for drive in backup.drives}
+    nodes = []
+    print(f"Backup [{vm.vm_id}]: {backup.mode} {backup.backup_id}")
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+        parent = None
+        if backup.parent:
+            parent = next((entry for entry in load_backup_manifest(vm.vm_id)["backups"]
+                           if entry["backup_id"] == backup.parent), None)
+            if parent is None:
+                raise RuntimeError(f"Parent backup {backup.parent} was deleted")
+        devices = {device["device"]: device for device in await qmp('query-block')}
+        actions = []
+        for drive, info in backup.drives.items():
+            target = os.path.join(directory, info["file"])
+            size = devices[drive]["inserted"]["image"]["virtual-size"]
+            backing = ["-b", os.path.join(directory, parent["drives"][drive]["file"]), "-F", "qcow2"] if parent else []
+            returncode, output = await run_probe(QEMU_IMG_BINARY, "create", "-q", "-f", "qcow2", *backing, target, str(size))
+            if returncode != 0:
+                raise RuntimeError(f"qemu-img create failed: {output.strip()}")
+
+            node = f"backup-{drive}"
+            await qmp('blockdev-add', {"driver": "qcow2", "node-name": node,
+                                       "file": {"driver": "file", "filename": target}})
+            nodes.append(node)
+
+            job = {"job-id": job_ids[drive], "device": drive, "target": node,
+                   "sync": backup.mode, "auto-dismiss": False}
+            if backup.mode == "full":
+                actions.append({"type": "block-dirty-bitmap-clear", "data": {"node": drive, "name": BACKUP_BITMAP_NAME}})
+            else:
+                job["bitmap"] = BACKUP_BITMAP_NAME
+            actions.append({"type": "blockdev-backup", "data": job})
+
+        # "grouped" fails every drive's job if one fails
+        await qmp('transaction', {"actions": actions, "properties": {"completion-mode": "grouped"}})
+
+        while True:
+            jobs = [job for job in await qmp('query-jobs') if job["id"] in job_ids.values()]
+            if len(jobs) != len(job_ids):
+                raise RuntimeError("Backup job disappeared")
+            total = sum(job["total-progress"] for job in jobs)
+            progress = round(100.0 * sum(job["current-progress"] for job in jobs) / total, 1) if total else 0.0
+            if progress != backup.progress:
+                backup.progress = progress
+                publish_event("backup", backup.status())
+            if all(job["status"] == "concluded" for job in jobs):
+                break
+            await asyncio.sleep(BACKUP_POLL_SECONDS)
+
+        errors = [f"{job['id']}: {job['error']}" for job in jobs if job.get("error")]
+        if errors:
+            raise RuntimeError("; ".join(errors))
+
+        for drive, info in backup.drives.items():
+            info["bytes"] = os.path.getsize(os.path.join(directory, info["file"]))
+            vm.backup_bitmaps[drive] = False
+        backup.progress = 100.0
+        backup.finished_at = time.time()
+        with BACKUPS_LOCK:
+            manifest = load_backup_manifest(vm.vm_id)
+            manifest["backups"].append(backup.manifest_entry())
+            manifest["needs_full"] = False
+            save_backup_manifest(manifest)
+        backup.set_state("finished")
+        print(f"Backup [{vm.vm_id}] {backup.backup_id} finished")
+
+    except Exception as e:
+        backup.error = str(e)
+        backup.finished_at = time.time()
+        if backup.mode == "full":
+            # The bitmaps may already be cleared, so the old chain cannot continue
+            with BACKUPS_LOCK:
+                manifest = load_backup_manifest(vm.vm_id)
+                manifest["needs_full"] = True
+                save_backup_manifest(manifest)
+        for info in backup.drives.values():
+            try:
+                os.remove(os.path.join(directory, info["file"]))
+            except FileNotFoundError:
+                pass
+        backup.set_state("failed")
+        print(f"Backup [{vm.vm_id}] {backup.backup_id} failed: {e}")
+    finally:
+        for job_id in job_ids.values():
+            try:
+                await qmp('job-dismiss', {"id": job_id})
+            except QMPError:
+                pass
+        for node in nodes:
+            try:
+                await qmp('blockdev-del', {"node-name": node})
+            except QMPError:
+                pass
+
+
+def delete_backup(vm_id, backup_id):
+    """Remove a backup and every incremental backup that builds on it
+
+    Returns the removed backup ids. Raises ApiError when a file is in use.
+    """
+    try:
+        vm_id = parse_vm_id(vm_id)
+    except ValueError as e:
+        raise ApiError(str(e))
+
+    with BACKUPS_LOCK:
+        current = BACKUPS.get(vm_id)
+        if current is not None and not current.finished:
+            raise ApiError(f"Backup {current.backup_id} of VM {vm_id} is still running", 409)
+        manifest = load_backup_manifest(vm_id)
+        removed = {backup_id}
+        for entry in manifest["backups"]:
+            if entry["parent"] in removed:
+                removed.add(entry["backup_id"])
+        entries = [entry for entry in manifest["backups"] if entry["backup_id"] in removed]
+        if not entries:
+            raise ApiError(f"Unknown backup {backup_id} of VM {vm_id}", 404)
+
+        paths = [os.path.join(backup_dir(vm_id), info["file"]) for entry in entries for info in entry["drives"].values()]
+        job = find_image_job(paths)
+        if job:
+            raise ApiError(f"Backup is busy with image {job.operation} job {job.job_id}", 409)
+
+        if manifest["backups"][-1]["backup_id"] in removed:
+            # The bitmaps were cleared when the deleted tip was taken, so an
+            # incremental on top of the remaining chain would miss its writes
+            manifest["needs_full"] = True
+        manifest["backups"] = [entry for entry in manifest["backups"] if entry["backup_id"] not in removed]
+        save_backup_manifest(manifest)
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    return [entry["backup_id"] for entry in entries]
+
+
+def build_restore_job(data):
+    """Validate a POST /backup/restore request and build its ImageJob
+
+    qemu-img convert reads the backup through its backing chain, so the
+    result is a standalone image of the drive at that point. It is written
+    to "output" in IMAGE_DIRS[0], or over the original image with
+    "replace": true.
+    """
+    try:
+        vm_id = parse_vm_id(data.get('vm_id'))
+    except ValueError as e:
+        raise ApiError(str(e))
+    backup_id = str(data.get('backup_id') or '').strip()
+    drive = data.get('drive', 'drive0')
+    backups = {entry["backup_id"]: entry for entry in load_backup_manifest(vm_id)["backups"]}
+    entry = backups.get(backup_id)
+    if entry is None:
+        raise ApiError(f"Unknown backup {backup_id} of VM {vm_id}", 404)
+    if drive not in entry["drives"]:
+        raise ApiError(f"Backup {backup_id} has no drive {drive}", 404)
+    info = entry["drives"][drive]
+    source = os.path.join(backup_dir(vm_id), info["file"])
+
+    if data.get('replace'):
+        output_path = info["image"]
+    else:
+        output = data.get('output')
+        if not output:
+            raise ApiError("Pass \"output\" (a new image name) or \"replace\": true")
+        validate_image_name(output)
+        output_path = os.path.realpath(os.path.join(IMAGE_DIRS[0], output))
+        if os.path.exists(output_path):
+            raise ApiError(f"Output image {output} already exists", 409)
+
+    directory = os.path.dirname(output_path)
+    os.makedirs(directory, exist_ok=True)
+    # At most the data of every file in the chain down to the full backup
+    needed = 0
+    point = entry
+    while point is not None:
+        needed += os.path.getsize(os.path.join(backup_dir(vm_id), point["drives"][drive]["file"]))
+        point = backups.get(point["parent"])
+    free = shutil.disk_usage(directory).free
+    if needed + IMAGE_UPLOAD_FREE_SPACE_RESERVE_MB * 1024 * 1024 > free:
+        raise ApiError(f"Not enough disk space: up to {needed} bytes needed, {free} free", 507)
+
+    temp_path = os.path.join(directory, f".{os.path.basename(output_path)}.{uuid.uuid4().hex[:8]}.tmp")
+    command = [QEMU_IMG_BINARY, "convert", "-p", "-f", "qcow2", "-O", info["format"], source, temp_path]
+    params = {"vm_id": vm_id, "backup_id": backup_id, "drive": drive, "format": info["format"]}
+    return ImageJob("restore", source, command, temp_path, output_path, params)
+
+
+async def supervise_terminal_session(session):
+    """Close a terminal session once its shell exits"""
+    await session.process.wait()
+    await asyncio.sleep(0.1)  # let the last output be read
+    await close_terminal_session(session)
+
+
+async def close_terminal_session(session):
+    with PTY_SESSIONS_LOCK:
+        PTY_SESSIONS.pop(session.session_id, None)
+    await session.close()
+    print(f"Terminal session {session.session_id} closed")
+
+
+async def reap_idle_terminal_sessions():
+    """Close terminal sessions that have not been used for a while"""
+    global PTY_REAPER
+
+    while True:
+        await asyncio.sleep(min(60, PTY_IDLE_TIMEOUT_SECONDS))
+        now = time.monotonic()
+        with PTY_SESSIONS_LOCK:
+            if not PTY_SESSIONS:
+                PTY_REAPER = None
+                return
+            idle = [session for session in PTY_SESSIONS.values()
+                    if now - session.last_active > PTY_IDLE_TIMEOUT_SECONDS]
+        for session in idle:
+            print(f"Terminal session {session.session_id} idle, closing")
+            await close_terminal_session(session)
+
+
+async def open_terminal_session(shell, cols, rows):
+    """Start a terminal session and register it"""
+    global PTY_REAPER
+
+    session = TerminalSession(shell, cols, rows)
+    await session.start()
+    asyncio.ensure_future(supervise_terminal_session(session))
+
+    with PTY_SESSIONS_LOCK:
+        PTY_SESSIONS[session.session_id] = session
+        if PTY_REAPER is None:
+            PTY_REAPER = asyncio.ensure_future(reap_idle_terminal_sessions())
+
+    print(f"Terminal session {session.session_id} started: {shell} (PID {session.process.pid})")
+    return session
+
+
+def get_terminal_session(session_id):
+    with PTY_SESSIONS_LOCK:
+        return PTY_SESSIONS.get(session_id)
+
+
+def parse_terminal_size(data, default_cols=80, default_rows=24):
+    """Return (cols, rows) from a request body. Raises ValueError"""
+    cols = int(data.get('cols', default_cols))
+    rows = int(data.get('rows', default_rows))
+    if not (1 <= cols <= 1000 and 1 <= rows <= 1000):
+        raise ValueError("cols and rows must be between 1 and 1000")
+    return cols, rows
+
+
+def parse_vm_id(value):
+    """Validate a VM id, falling back to the default VM"""
+    vm_id = str(value or DEFAULT_VM_ID).strip()
+    if not re.fullmatch(r'[a-zA-Z0-9_-]{1,32}', vm_id):
+        raise ValueError("VM id must be 1-32 letters, digits, hyphens or underscores")
+    return vm_id
+
+
+def stopped_vm_status(vm_id):
+    """Status for a VM id that has never been started"""
+    return {
+        "vm_id": vm_id,
+        "state": "stopped",
+        "running": False
+    }
+
+
+# API Routes
+
+@app.route('/vms', methods=['GET'])
+def list_vms():
+    """List all registered VMs"""
+    with VM_LOCK:
+        vms = [vm.status() for vm in VMS.values()]
+
+    return jsonify({
+        "vms": vms
+    }), 200
+
+
+@app.route('/vms/<vm_id>', methods=['DELETE'])
+def delete_vm(vm_id):
+    """Remove a stopped VM and its logs from the registry"""
+    with VM_LOCK:
+        vm = VMS.get(vm_id)
+        if vm is None:
+            return jsonify({
+                "status": "error",
+                "message": f"Unknown VM: {vm_id}"
+            }), 404
+
+        if vm.active:
+            return jsonify({
+                "status": "error",
+                "message": "Stop the VM before removing it"
+            }), 409
+
+        del VMS[vm_id]
+
+    return jsonify({
+        "status": "success",
+        "message": f"VM {vm_id} removed"
+    }), 200
+
+
+@app.route('/vm_status', methods=['GET'])
+def vm_status():
+    """Get current VM status"""
+    try:
+        vm_id = parse_vm_id(request.args.get('vm_id'))
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    vm = get_vm(vm_id)
+    return jsonify(vm.status() if vm else stopped_vm_status(vm_id)), 200
+
+
+@app.route('/vm_memory', methods=['GET'])
+def get_vm_memory():
+    """Report a VM's memory backing and current balloon size"""
+    try:
+        vm_id = parse_vm_id(request.args.get('vm_id'))
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    vm = get_vm(vm_id)
+    if vm is None or not vm.running:
+        return jsonify({
+            "status": "info",
+            "message": "VM is not running"
+        }), 200
+
+    memory = vm.start_params.get("memory") or {}
+    actual_mb = None
+    if memory.get("balloon"):
+        try:
+            actual_mb = balloon_size_mb(vm)
+        except Exception as e:
+            return jsonify({
+                "status": "error",
+                "message": f"Could not query balloon: {str(e)}"
+            }), 500
+
+    return jsonify({
+        "vm_id": vm_id,
+        "ram_mb": vm.config["ram_mb"],
+        "actual_mb": actual_mb,
+        "memory": memory,
+        "host_available_mb": psutil.virtual_memory().available // (1024 * 1024)
+    }), 200
+
+
+@app.route('/vm_memory', methods=['POST'])
+def set_vm_memory():
+    """Resize a running VM through its balloon or toggle auto_reclaim"""
+    data = request.get_json(silent=True) or {}
+    try:
+        vm_id = parse_vm_id(data.get('vm_id'))
+        target_mb = int(data['target_mb']) if data.get('target_mb') is not None else None
+    except (ValueError, TypeError) as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Invalid parameters: {str(e)}"
+        }), 400
+
+    vm = get_vm(vm_id)
+    if vm is None or not vm.running:
+        return jsonify({
+            "status": "info",
+            "message": "VM is not running"
+        }), 200
+
+    memory = vm.start_params.get("memory") or {}
+    if not memory.get("balloon"):
+        return jsonify({
+            "status": "error",
+            "message": f"VM {vm_id} was started without a balloon device"
+        }), 409
+
+    if target_mb is not None:
+        if not (BALLOON_MIN_MB <= target_mb <= vm.config["ram_mb"]):
+            return jsonify({
+                "status": "error",
+                "message": f"target_mb must be between {BALLOON_MIN_MB} and {vm.config['ram_mb']}"
+            }), 400
+        try:
+            set_balloon_target(vm, target_mb)
+        except Exception as e:
+            return jsonify({
+                "status": "error",
+                "message": f"Could not resize balloon: {str(e)}"
+            }), 500
+
+    if 'auto_reclaim' in data:
+        memory["auto_reclaim"] = bool(data['auto_reclaim'])
+
+    return jsonify({
+        "status": "success",
+        "message": f"VM {vm_id} memory updated",
+        "target_mb": target_mb,
+        "memory": memory
+    }), 200
+
+
+def resolve_disk_io(value, cores):
+    """Turn a disk_io request value into a complete, validated I/O profile
+
+    value is a profile name or a dict of overrides, optionally based on
+    {"profile": name}. Options the local QEMU was found not to support are
+    rejected here rather than surfacing as a QEMU startup failure.
+    """
+    overrides = {}
+    if isinstance(value, dict):
+        overrides = dict(value)
+        value = overrides.pop("profile", DEFAULT_DISK_IO_PROFILE)
+    if value not in DISK_IO_PROFILES:
+        raise ApiError(f"Unknown disk I/O profile: {value}")
+
+    unknown = set(overrides) - set(DISK_IO_PROFILES[DEFAULT_DISK_IO_PROFILE])
+    if unknown:
+        raise ApiError(f"Unknown disk I/O options: {', '.join(sorted(unknown))}")
+
+    disk_io = dict(DISK_IO_PROFILES[value], **overrides)
+    if disk_io["aio"] not in DISK_AIO_MODES:
+        raise ApiError(f"Invalid aio mode (expected {', '.join(DISK_AIO_MODES)})")
+    if disk_io["cache"] not in DISK_CACHE_MODES:
+        raise ApiError(f"Invalid cache mode (expected {', '.join(DISK_CACHE_MODES)})")
+    if disk_io["discard"] not in DISK_DISCARD_MODES:
+        raise ApiError("Invalid discard mode (expected ignore or unmap)")
+    if disk_io["detect_zeroes"] not in DISK_DETECT_ZEROES_MODES:
+        raise ApiError("Invalid detect_zeroes mode (expected off, on or unmap)")
+    if disk_io["aio"] == "native" and disk_io["cache"] not in ("none", "directsync"):
+        raise ApiError("aio=native requires cache none or directsync")
+    if disk_io["detect_zeroes"] == "unmap" and disk_io["discard"] != "unmap":
+        raise ApiError("detect_zeroes=unmap requires discard=unmap")
+
+    disk_io["iothread"] = bool(disk_io["iothread"])
+    if disk_io["num_queues"] == "auto":
+        disk_io["num_queues"] = min(cores, DISK_MAX_QUEUES)
+    try:
+        disk_io["num_queues"] = int(disk_io["num_queues"])
+    except (ValueError, TypeError):
+        raise ApiError("num_queues must be a number or \"auto\"")
+    if not (1 <= disk_io["num_queues"] <= DISK_MAX_QUEUES):
+        raise ApiError(f"num_queues must be between 1 and {DISK_MAX_QUEUES}")
+
+    support = DISK_IO_SUPPORT
+    if support is not None:
+        if disk_io["aio"] not in support["aio"]:
+            raise ApiError(f"aio={disk_io['aio']} is not supported by this QEMU (available: {', '.join(support['aio']) or 'none'})")
+        if disk_io["iothread"] and not support["iothread"]:
+            raise ApiError("This QEMU does not support iothreads for virtio-blk")
+        if disk_io["num_queues"] > 1 and not support["num_queues"]:
+            raise ApiError("This QEMU does not support multiqueue virtio-blk")
+
+    return disk_io
+
+
+def resolve_network(value, cores, net_device):
+    """Turn a /start_vm network value into complete, validated network options
+
+    value is a mode name or a dict of NETWORK_DEFAULTS overrides. Checks
+    against other VMs (tap devices, forwarded ports, link peers) are left
+    to assign_network(), which runs under VM_LOCK.
+    """
+    if isinstance(value, str):
+        value = {"mode": value}
+    if not isinstance(value, dict):
+        raise ApiError("network must be a mode name or an object of options")
+
+    unknown = set(value) - set(NETWORK_DEFAULTS)
+    if unknown:
+        raise ApiError(f"Unknown network options: {', '.join(sorted(unknown))}")
+
+    network = dict(NETWORK_DEFAULTS)
+    network.update(value)
+    mode = network["mode"]
+    if mode not in NETWORK_MODES:
+        raise ApiError(f"Invalid network mode (expected {', '.join(NETWORK_MODES)})")
+
+    support = NETWORK_SUPPORT
+    if support is not None:
+        backends = ("stream", "socket") if mode == "socket" else (mode,)
+        if not set(backends) & set(support["backends"]):
+            raise ApiError(f"This QEMU has no {mode} network backend (available: {', '.join(support['backends'])})")
+
+    if not isinstance(network["hostfwd"], list):
+        raise ApiError("hostfwd must be a list of port forwards")
+    if network["hostfwd"] and mode != "user":
+        raise ApiError("hostfwd needs network mode user")
+    forwards = []
+    for rule in network["hostfwd"]:
+        if isinstance(rule, str):
+            # "tcp:2222-22" or "udp:0.0.0.0:5353-53"
+            match = re.fullmatch(r'(tcp|udp):(?:([\d.]*):)?(\d+)-(\d+)', rule)
+            if not match:
+                raise ApiError(f"Invalid hostfwd rule {rule} (expected e.g. tcp:2222-22)")
+            rule = {"protocol": match[1], "host_addr": match[2], "host_port": match[3], "guest_port": match[4]}
+        try:
+            forward = {
+                "protocol": str(rule.get("protocol", "tcp")),
+                "host_addr": str(rule.get("host_addr") or NETWORK_HOSTFWD_ADDRESS),
+                "host_port": int(rule["host_port"]),
+                "guest_port": int(rule["guest_port"])
+            }
+            socket.inet_aton(forward["host_addr"])
+        except (AttributeError, KeyError, ValueError, TypeError, OSError):
+            raise ApiError("hostfwd rules need host_port, guest_port and an IPv4 host_addr")
+        if forward["protocol"] not in ("tcp", "udp"):
+            raise ApiError("hostfwd protocol must be tcp or udp")
+        if not (1 <= forward["host_port"] <= 65535 and 1 <= forward["guest_port"] <= 65535):
+            raise ApiError("hostfwd ports must be between 1 and 65535")
+        if any((old["protocol"], old["host_port"]) == (forward["protocol"], forward["host_port"]) for old in forwards):
+            raise ApiError(f"Host port {forward['protocol']}/{forward['host_port']} is forwarded twice")
+        forwards.append(forward)
+    network["hostfwd"] = forwards
+
+    if mode == "tap":
+        ifname = str(network["ifname"] or "")
+        if not re.fullmatch(r'[A-Za-z0-9_.-]{1,15}', ifname):
+            raise ApiError("Network mode tap needs the ifname of a tap device this user may open")
+        try:
+            with open(f"/sys/class/net/{ifname}/tun_flags") as f:
+                tun_flags = int(f.read(), 16)
+        except (OSError, ValueError):
+            raise ApiError(f"{ifname} is not a tap device", 409)
+        network["ifname"] = ifname
+
+        available = os.access(VHOST_NET_PATH, os.R_OK | os.W_OK)
+        if network["vhost"] == "auto":
+            network["vhost"] = available
+        elif network["vhost"] and not available:
+            raise ApiError(f"vhost-net needs read and write access to {VHOST_NET_PATH}", 409)
+        network["vhost"] = bool(network["vhost"])
+
+        # Several queue pairs need a tap created with multi_queue (IFF_MULTI_QUEUE)
+        multi_queue = bool(tun_flags & 0x100) and net_device == "virtio-net-pci"
+        if network["queues"] == "auto":
+            network["queues"] = min(cores, NETWORK_MAX_QUEUES) if multi_queue else 1
+        try:
+            network["queues"] = int(network["queues"])
+        except (ValueError, TypeError):
+            raise ApiError("queues must be a number or \"auto\"")
+        if not (1 <= network["queues"] <= NETWORK_MAX_QUEUES):
+            raise ApiError(f"queues must be between 1 and {NETWORK_MAX_QUEUES}")
+        if network["queues"] > 1 and not multi_queue:
+            raise ApiError(f"Multiqueue needs virtio-net-pci and a tap device created with multi_queue ({ifname} is not)")
+    else:
+        if network["ifname"]:
+            raise ApiError("ifname needs network mode tap")
+        if network["vhost"] is True or network["queues"] not in ("auto", 1):
+            raise ApiError("vhost and queues need network mode tap")
+        network.update(ifname=None, vhost=False, queues=1)
+
+    if mode == "socket":
+        network["link"] = str(network["link"] or "")
+        if not re.fullmatch(r'[a-zA-Z0-9_-]{1,32}', network["link"]):
+            raise ApiError("Network mode socket needs a link name of 1-32 letters, digits, hyphens or underscores")
+    elif network["link"]:
+        raise ApiError("link needs network mode socket")
+
+    return network
+
+
+def assign_network(vm_id, network):
+    """Check a resolved network against the other active VMs
+
+    Tap devices and forwarded host ports belong to one VM at a time. A
+    socket link joins two VMs: the first listens on a free local port and
+    the second connects to it. Returns the link endpoint or None.
+    Must be called with VM_LOCK held.
+    """
+    others = [vm for vm in VMS.values() if vm.vm_id != vm_id and vm.active]
+    for vm in others:
+        other = vm.start_params.get("network") or {}
+        if network["mode"] == "tap" and other.get("ifname") == network["ifname"]:
+            raise ApiError(f"Tap device {network['ifname']} is in use by VM {vm.vm_id}", 409)
+        used = {(forward["protocol"], forward["host_port"]) for forward in other.get("hostfwd", [])}
+        for forward in network["hostfwd"]:
+            if (forward["protocol"], forward["host_port"]) in used:
+                raise ApiError(f"Host port {forward['protocol']}/{forward['host_port']} is forwarded to VM {vm.vm_id}", 409)
+
+    for forward in network["hostfwd"]:
+        check_port_free(forward["host_addr"], forward["host_port"], forward["protocol"])
+
+    if network["mode"] != "socket":
+        return None
+
+    peers = [vm for vm in others if (vm.config.get("network_link") or {}).get("link") == network["link"]]
+    if len(peers) > 1:
+        raise ApiError(f"Link {network['link']} already joins VMs {peers[0].vm_id} and {peers[1].vm_id}", 409)
+    if peers:
+        peer = peers[0].config["network_link"]
+        return {"link": network["link"], "role": "connect" if peer["role"] == "listen" else "listen", "port": peer["port"]}
+
+    used_ports = {vm.config["network_link"]["port"] for vm in others if vm.config.get("network_link")}
+    for port in range(NETWORK_LINK_PORT_BASE, NETWORK_LINK_PORT_BASE + NETWORK_LINK_PORT_COUNT):
+        if port in used_ports:
+            continue
+        try:
+            check_port_free("127.0.0.1", port, "tcp")
+        except ApiError:
+            continue
+        return {"link": network["link"], "role": "listen", "port": port}
+    raise ApiError(f"No free port for link {network['link']} in "
+                   f"{NETWORK_LINK_PORT_BASE}-{NETWORK_LINK_PORT_BASE + NETWORK_LINK_PORT_COUNT - 1}", 503)
+
+
+def check_port_free(host, port, protocol):
+    """Raise ApiError if QEMU would not be able to listen on host:port"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM if protocol == "tcp" else socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+    except OSError as e:
+        raise ApiError(f"Cannot listen on {protocol} {host}:{port}: {e.strerror}", 409)
+    finally:
+        sock.close()
+
+
+def guest_mac(vm_id):
+    """A stable, locally administered MAC address for a VM's NIC"""
+    digest = hashlib.sha1(vm_id.encode()).digest()
+    return "52:54:00:" + ":".join(f"{byte:02x}" for byte in digest[:3])
+
+
+def network_args(network, link, net_device, mac=None):
+    """Build the -netdev/-device arguments for the guest NIC"""
+    if network["mode"] == "user":
+        netdev = "user,id=net0" + "".join(
+            f",hostfwd={forward['protocol']}:{forward['host_addr']}:{forward['host_port']}-:{forward['guest_port']}"
+            for forward in network["hostfwd"])
+    elif network["mode"] == "tap":
+        netdev = (f"tap,id=net0,ifname={network['ifname']},script=no,downscript=no,"
+                  f"vhost={'on' if network['vhost'] else 'off'}")
+        if network["queues"] > 1:
+            netdev += f",queues={network['queues']}"
+    elif NETWORK_SUPPORT is not None and "stream" in NETWORK_SUPPORT["backends"]:
+        netdev = (f"stream,id=net0,server={'on' if link['role'] == 'listen' else 'off'},"
+                  f"addr.type=inet,addr.host=127.0.0.1,addr.port={link['port']}")
+    else:
+        netdev = f"socket,id=net0,{link['role']}=127.0.0.1:{link['port']}"
+
+    device = f"{net_device},netdev=net0"
+    if network["queues"] > 1:
+        device += f",mq=on,vectors={2 * network['queues'] + 2}"
+    if mac:
+        device += f",mac={mac}"
+    return ["-netdev", netdev, "-device", device]
+
+
+def network_counters(vm):
+    """Guest NIC byte and packet counters, or None if the host cannot see them
+
+    Only tap devices have host-side counters. They are read from sysfs and
+    given from the guest's side, so the tap's transmit is the guest's rx.
+    """
+    network = vm.start_params.get("network") or {}
+    if network.get("mode") != "tap":
+        return None
+    counters = {}
+    try:
+        for guest, host in (("rx_bytes", "tx_bytes"), ("tx_bytes", "rx_bytes"),
+                            ("rx_packets", "tx_packets"), ("tx_packets", "rx_packets")):
+            with open(f"/sys/class/net/{network['ifname']}/statistics/{host}") as f:
+                counters[guest] = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return counters
+
+
+def prepare_network_benchmark(data):
+    """Validate a /network_benchmark request and pick the host endpoint
+
+    The guest reaches the host at 10.0.2.2 in user mode (SLIRP maps it to
+    the host's loopback) and at the tap device's host address in tap mode.
+    Socket links carry only guest-to-guest traffic.
+    """
+    try:
+        vm_id = parse_vm_id(data.get('vm_id'))
+        seconds = int(data.get('seconds', NETWORK_BENCHMARK_SECONDS))
+    except (ValueError, TypeError) as e:
+        raise ApiError(f"Invalid parameters: {str(e)}")
+    direction = data.get('direction', 'to_host')
+    if direction not in ("to_host", "to_guest"):
+        raise ApiError("direction must be \"to_host\" or \"to_guest\"")
+    if not (1 <= seconds <= NETWORK_BENCHMARK_MAX_SECONDS):
+        raise ApiError(f"seconds must be between 1 and {NETWORK_BENCHMARK_MAX_SECONDS}")
+
+    vm = get_vm(vm_id)
+    if vm is None or not vm.running:
+        raise ApiError(f"VM {vm_id} is not running", 409)
+    network = vm.start_params.get("network") or NETWORK_DEFAULTS
+
+    if network["mode"] == "user":
+        listen_host, guest_host = "127.0.0.1", "10.0.2.2"
+    elif network["mode"] == "tap":
+        addresses = [address.address for address in psutil.net_if_addrs().get(network["ifname"], [])
+                     if address.family == socket.AF_INET]
+        if not addresses:
+            raise ApiError(f"Tap device {network['ifname']} has no IPv4 address the guest could reach", 409)
+        listen_host = guest_host = addresses[0]
+    else:
+        raise ApiError("Socket links do not reach the host. Benchmark between the two guests "
+                       "instead, e.g. iperf3 -s in one and iperf3 -c <address> in the other", 409)
+
+    return {
+        "vm_id": vm_id,
+        "mode": network["mode"],
+        "direction": direction,
+        "seconds": seconds,
+        "listen_host": listen_host,
+        "guest_host": guest_host
+    }
+
+
+async def run_network_benchmark(config, benchmark):
+    """Serve one iperf-style TCP stream to or from the guest and time it
+
+    Returns once the listening port is known; the measurement continues in
+    the background and updates benchmark in place.
+    """
+    async def measure(reader, writer):
+        if benchmark["state"] != "waiting":
+            writer.close()
+            return
+        server.close()
+        benchmark["state"] = "running"
+        publish_event("network_benchmark", dict(benchmark))
+
+        started = time.monotonic()
+        deadline = started + config["seconds"]
+        try:
+            while time.monotonic() < deadline:
+                if config["direction"] == "to_host":
+                    chunk = await asyncio.wait_for(reader.read(IMAGE_TRANSFER_BLOCK_BYTES), deadline - time.monotonic())
+                    if not chunk:
+                        break
+                    benchmark["bytes"] += len(chunk)
+                else:
+                    writer.write(ZERO_BLOCK)
+                    await asyncio.wait_for(writer.drain(), deadline - time.monotonic())
+                    benchmark["bytes"] += len(ZERO_BLOCK)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+        elapsed = time.monotonic() - started
+        benchmark["elapsed_seconds"] = round(elapsed, 3)
+        benchmark["mbit_per_second"] = round(benchmark["bytes"] * 8 / elapsed / 1e6, 1) if elapsed > 0 else None
+        benchmark["state"] = "finished"
+        publish_event("network_benchmark", dict(benchmark))
+        print(f"Network benchmark [{config['vm_id']}]: {benchmark['mbit_per_second']} Mbit/s {config['direction']}")
+
+    async def expire():
+        await asyncio.sleep(NETWORK_BENCHMARK_CONNECT_TIMEOUT_SECONDS)
+        if benchmark["state"] == "waiting":
+            server.close()
+            benchmark["state"] = "failed"
+            benchmark["error"] = "The guest did not connect"
+            publish_event("network_benchmark", dict(benchmark))
+
+    server = await asyncio.start_server(measure, config["listen_host"], 0)
+    asyncio.ensure_future(expire())
+    return server.sockets[0].getsockname()[1]
+
+
+def free_hugepages_mb():
+    """Free memory in the host's default hugepage pool, in MB"""
+    info = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            info[key] = int(value.split()[0])
+    return info.get("HugePages_Free", 0) * info.get("Hugepagesize", 0) // 1024
+
+
+def resolve_memory(value, ram_mb):
+    """Turn a /start_vm memory value into complete, validated memory options
+
+    value is a backend name or a dict of MEMORY_DEFAULTS overrides. Hugepage
+    requests are checked against the free hugepage pool up front, since
+    QEMU would otherwise fail or fall back only after allocating.
+    """
+    if isinstance(value, str):
+        value = {"backend": value}
+    if not isinstance(value, dict):
+        raise ApiError("memory must be a backend name or an object of options")
+
+    unknown = set(value) - set(MEMORY_DEFAULTS)
+    if unknown:
+        raise ApiError(f"Unknown memory options: {', '.join(sorted(unknown))}")
+
+    memory = dict(MEMORY_DEFAULTS)
+    memory.update(value)
+    for key in ("hugepages", "prealloc", "share", "balloon", "auto_reclaim"):
+        memory[key] = bool(memory[key])
+
+    if memory["backend"] not in MEMORY_BACKENDS:
+        raise ApiError(f"Invalid memory backend (expected {', '.join(MEMORY_BACKENDS)})")
+    if memory["backend"] == "default" and (memory["hugepages"] or memory["share"]):
+        raise ApiError("hugepages and share need the memfd or file memory backend")
+    if memory["auto_reclaim"] and not memory["balloon"]:
+        raise ApiError("auto_reclaim needs the balloon device")
+
+    if memory["backend"] == "file":
+        memory["path"] = str(memory["path"] or (HUGEPAGES_PATH if memory["hugepages"] else ""))
+        if not os.path.isdir(memory["path"]):
+            raise ApiError(f"Memory backend path is not a directory: {memory['path'] or '(none)'}")
+    else:
+        memory["path"] = None
+
+    if memory["hugepages"]:
+        try:
+            available = free_hugepages_mb()
+        except OSError:
+            available = 0
+        if available < ram_mb:
+            raise ApiError(f"Not enough free hugepages: {available} MB free, {ram_mb} MB requested", 409)
+
+    return memory
+
+
+def memory_args(ram_mb, memory):
+    """Build the -m, memory backend and balloon arguments"""
+    args = ["-m", str(ram_mb)]
+    flags = f"share={'on' if memory['share'] else 'off'},prealloc={'on' if memory['prealloc'] else 'off'}"
+    if memory["backend"] == "memfd":
+        hugetlb = ",hugetlb=on" if memory["hugepages"] else ""
+        args += ["-object", f"memory-backend-memfd,id=mem0,size={ram_mb}M,{flags}{hugetlb}"]
+    elif memory["backend"] == "file":
+        args += ["-object", f"memory-backend-file,id=mem0,size={ram_mb}M,mem-path={qemu_opt_value(memory['path'])},{flags}"]
+    elif memory["prealloc"]:
+        args.append("-mem-prealloc")
+
+    if memory["backend"] != "default":
+        args += ["-machine", "memory-backend=mem0"]
+    if memory["balloon"]:
+        args += ["-device", "virtio-balloon-pci,id=balloon0,deflate-on-oom=on"]
+    return args
+
+
+def qemu_opt_value(value):
+    """Escape a value for a QEMU -opt list, where a comma is written ,,"""
+    return str(value).replace(",", ",,")
+
+
+def disk_args(index, path, disk_io, image_format="qcow2"):
+    """Build the -object/-drive/-device arguments for one virtio-blk disk"""
+    drive_id = f"drive{index}"
+    args = []
+    device = f"virtio-blk-pci,drive={drive_id}"
+    # Builds without the property reject it even as 1. Newer ones default to
+    # one queue per vCPU, so 1 is passed whenever the probe found it.
+    if disk_io["num_queues"] > 1 or (DISK_IO_SUPPORT is not None and DISK_IO_SUPPORT["num_queues"]):
+        device += f",num-queues={disk_io['num_queues']}"
+    if disk_io["iothread"]:
+        args += ["-object", f"iothread,id=iothread{index}"]
+        device += f",iothread=iothread{index}"
+    args += [
+        "-drive",
+        f"file={qemu_opt_value(path)},if=none,id={drive_id},format={image_format},cache={disk_io['cache']},"
+        f"aio={disk_io['aio']},discard={disk_io['discard']},detect-zeroes={disk_io['detect_zeroes']}"
+    ]
+    args += ["-device", device]
+    return args
+
+
+def host_fingerprint():
+    """Identify this host by CPU model, thread count and RAM"""
+    cpu_name = platform.machine()
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith(("model name", "Hardware")):
+                    cpu_name = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    ram_gb = round(psutil.virtual_memory().total / (1024 ** 3))
+    return f"{cpu_name} / {psutil.cpu_count(logical=True)} threads / {ram_gb} GB"
+
+
+def load_tcg_profiles():
+    """Read the saved benchmark winners, keyed by host fingerprint"""
+    try:
+        with open(TCG_PROFILE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_tcg_profile(profile):
+    """Store this host's benchmark winner, or forget it when profile is None"""
+    profiles = load_tcg_profiles()
+    if profile is None:
+        profiles.pop(host_fingerprint(), None)
+    else:
+        profiles[host_fingerprint()] = profile
+    os.makedirs(os.path.dirname(TCG_PROFILE_PATH), exist_ok=True)
+    tmp_path = TCG_PROFILE_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(tmp_path, TCG_PROFILE_PATH)
+
+
+def validate_tcg(tcg):
+    """Check TCG settings in place. Raises ApiError"""
+    if tcg["thread"] not in TCG_THREAD_MODES:
+        raise ApiError("Invalid TCG thread mode (expected multi or single)")
+    if tcg["smp_layout"] is not None and tcg["smp_layout"] not in TCG_SMP_LAYOUTS:
+        raise ApiError("Invalid smp_layout (expected sockets or cores)")
+    if tcg["tb_size"] is not None:
+        try:
+            tcg["tb_size"] = int(tcg["tb_size"])
+        except (ValueError, TypeError):
+            raise ApiError("tb_size must be a number of MB")
+        if not (1 <= tcg["tb_size"] <= TCG_MAX_TB_SIZE_MB):
+            raise ApiError(f"tb_size must be between 1 and {TCG_MAX_TB_SIZE_MB} MB")
+
+
+def resolve_tcg(value):
+    """Turn a /start_vm tcg value into (settings, tuned cpu model or None)
+
+    "auto" uses this host's saved benchmark winner when there is one,
+    "default" uses TCG_DEFAULTS, and a dict overrides "auto".
+    """
+    overrides = {}
+    if isinstance(value, dict):
+        overrides = dict(value)
+        value = "auto"
+    if value not in ("auto", "default"):
+        raise ApiError("tcg must be \"auto\", \"default\" or an object of settings")
+
+    unknown = set(overrides) - set(TCG_DEFAULTS)
+    if unknown:
+        raise ApiError(f"Unknown TCG options: {', '.join(sorted(unknown))}")
+
+    tuned = load_tcg_profiles().get(host_fingerprint()) if value == "auto" else None
+    tcg = dict(TCG_DEFAULTS)
+    tcg.update(tuned["tcg"] if tuned else {})
+    tcg.update(overrides)
+    validate_tcg(tcg)
+    return tcg, tuned["cpu_model"] if tuned else None
+
+
+def tcg_args(cores, tcg):
+    """Build the -accel and -smp arguments for TCG settings"""
+    accel = f"tcg,thread={tcg['thread']}"
+    if tcg["tb_size"]:
+        accel += f",tb-size={tcg['tb_size']}"
+    smp = str(cores)
+    if tcg["smp_layout"] == "sockets":
+        smp += f",sockets={cores},cores=1,threads=1"
+    elif tcg["smp_layout"] == "cores":
+        smp += f",sockets=1,cores={cores},threads=1"
+    return ["-accel", accel, "-smp", smp]
+
+
+def prepare_vm_start(data, pool_profile=None):
+    """Validate a /start_vm request, reserve resources and build the command
+
+    Returns (vm, argv, start_timeout). Raises ApiError when the request
+    is rejected. Shared by the Flask route and the --asgi handler. With
+    pool_profile the guest is launched paused (-S) for the warm pool.
+    """
+    data = data or {}
+
+    # A saved state only restores onto the exact machine it came from, so its
+    # recorded configuration replaces the hardware settings in the request
+    resume_from = str(data.get('resume_from', '') or '').strip()
+    saved_state = None
+    if resume_from:
+        saved_state = load_saved_state(resume_from)
+        data = dict(data, **saved_state["config"])
+
+    # Extract parameters
+    try:
+        if saved_state is not None and "memory" not in saved_state["config"]:
+            # States saved before memory options existed have no balloon
+            data = dict(data, memory={"balloon": False})
+        vm_id = parse_vm_id(data.get('vm_id'))
+        ram_mb = int(data.get('ram_mb', DEFAULT_RAM_MB))
+        cores = int(data.get('cores', DEFAULT_CORES))
+        cpu_model = data.get('cpu_model')
+        boot_order = str(data.get('boot_order', DEFAULT_BOOT_ORDER))
+        vga_model = str(data.get('vga_model', DEFAULT_VGA_MODEL))
+        net_device = str(data.get('net_device', DEFAULT_NET_DEVICE))
+
+        primary_disk_path = str(data.get('primary_disk_path', DEFAULT_PRIMARY_DISK_PATH)).strip()
+        cdrom_path = str(data.get('cdrom_path', DEFAULT_CDROM_PATH)).strip()
+        data_disk_path = str(data.get('data_disk_path', DEFAULT_DATA_DISK_PATH)).strip()
+
+        start_timeout = float(data.get('start_timeout', QMP_READY_TIMEOUT_SECONDS))
+
+        overlay = bool(data.get('overlay', False))
+        overlay_on_stop = str(data.get('overlay_on_stop', 'discard'))
+        disk_io_request = data.get('disk_io', DEFAULT_DISK_IO_PROFILE)
+        tcg_request = data.get('tcg', 'auto')
+        cpu_pinning = data.get('cpu_pinning', DEFAULT_CPU_PINNING)
+        memory_request = data.get('memory', {})
+        network_request = data.get('network', NETWORK_DEFAULTS["mode"])
+        if isinstance(cpu_pinning, list):
+            cpu_pinning = sorted(set(int(cpu) for cpu in cpu_pinning))
+
+    except (ValueError, TypeError) as e:
+        raise ApiError(f"Invalid parameters: {str(e)}")
+
+    # An explicit cpu_model wins over the one the benchmark picked
+    tcg, tuned_cpu_model = resolve_tcg(tcg_request)
+    cpu_model = str(cpu_model or tuned_cpu_model or DEFAULT_CPU_MODEL)
+
+    if not (0 <= start_timeout <= QMP_READY_MAX_SECONDS):
+        raise ApiError(f"Start timeout must be between 0 and {QMP_READY_MAX_SECONDS} seconds")
+
+    # Validate parameters
+    if not (512 <= ram_mb <= 32768):
+        raise ApiError("RAM must be between 512 MB and 32768 MB")
+
+    if not (1 <= cores <= 12):
+        raise ApiError("CPU cores must be between 1 and 12")
+
+    if not re.fullmatch(r'[a-zA-Z0-9_-]+', cpu_model):
+        raise ApiError("Invalid CPU model format")
+
+    if boot_order not in ['c', 'd', 'n', 'cd', 'dc', 'ncd', 'dnc']:
+        raise ApiError("Invalid boot order")
+
+    if vga_model not in ['std', 'qxl', 'virtio', 'vmware', 'cirrus']:
+        raise ApiError("Invalid VGA model")
+
+    if net_device not in ['virtio-net-pci', 'e1000', 'rtl8139']:
+        raise ApiError("Invalid network device")
+
+    if not primary_disk_path:
+        raise ApiError("Primary disk path is required")
+
+    primary_format = check_image(primary_disk_path, "Primary disk")
+
+    if cdrom_path:
+        check_image(cdrom_path, "CD-ROM ISO")
+
+    data_format = check_image(data_disk_path, "Data disk") if data_disk_path else None
+
+    if overlay_on_stop not in OVERLAY_STOP_ACTIONS:
+        raise ApiError("Invalid overlay_on_stop (expected discard, commit or keep)")
+
+    disk_io = resolve_disk_io(disk_io_request, cores)
+    memory = resolve_memory(memory_request, ram_mb)
+    network = resolve_network(network_request, cores, net_device)
+
+    if isinstance(cpu_pinning, list):
+        if not cpu_pinning or not set(cpu_pinning) <= set(HOST_CPUS):
+            raise ApiError(f"cpu_pinning must list host CPUs from {HOST_CPUS}")
+    elif cpu_pinning not in ("off", "auto"):
+        raise ApiError("cpu_pinning must be \"off\", \"auto\" or a list of host CPUs")
+    if cpu_pinning != "off" and not CPU_PINNING_SUPPORTED:
+        raise ApiError("CPU pinning is not supported on this host")
+
+    # With an overlay, the primary disk becomes a read-only backing file and
+    # all guest writes go to a new per-session image
+    backing = None
+    boot_disk_path = primary_disk_path
+    if overlay:
+        backing = os.path.realpath(primary_disk_path)
+        boot_disk_path = os.path.join(OVERLAY_DIR, f"{vm_id}-{int(time.time() * 1000)}.qcow2")
+
+    disks = [os.path.realpath(path) for path in (boot_disk_path, data_disk_path) if path]
+
+    if saved_state is not None:
+        for path, mtime in saved_state.get("disk_mtimes", {}).items():
+            if not os.path.exists(path) or os.path.getmtime(path) != mtime:
+                raise ApiError(f"Disk {path} has changed since state {resume_from} was saved", 409)
+
+    # Reserve host resources and a VNC display for this VM
+    with VM_LOCK:
+        vm = VMS.get(vm_id)
+        if vm is not None and vm.active:
+            raise ApiError(f"VM {vm_id} is already running", 200, "info")
+
+        owner = find_disk_owner(vm_id, disks, backing)
+        if owner:
+            raise ApiError(f"Disk is already in use by VM {owner}", 409)
+
+        job = find_image_job(disks + [backing] if backing else disks)
+        if job:
+            raise ApiError(f"Disk is busy with image {job.operation} job {job.job_id}", 409)
+
+        admission_error = check_admission(vm_id, ram_mb, cores)
+        if admission_error:
+            raise ApiError(admission_error, 409)
+
+        network_link = assign_network(vm_id, network)
+
+        if vm is None:
+            vm = VirtualMachine(vm_id)
+            VMS[vm_id] = vm
+
+        vm.config = {
+            "ram_mb": ram_mb,
+            "cores": cores,
+            "disks": disks,
+            "backing": backing,
+            "drives": {
+                "drive0": {"path": os.path.realpath(boot_disk_path), "format": "qcow2" if overlay else primary_format},
+                **({"drive1": {"path": os.path.realpath(data_disk_path), "format": data_format}} if data_disk_path else {})
+            },
+            "network_link": network_link,
+            # Guests sharing a link or bridge need distinct addresses
+            "mac": guest_mac(vm_id) if network["mode"] != "user" else None
+        }
+        vm.overlay = {
+            "path": boot_disk_path,
+            "backing": backing,
+            "backing_format": primary_format,
+            "on_stop": overlay_on_stop
+        } if overlay else None
+        vm.pool_profile = pool_profile
+        vm.start_params = {
+            "ram_mb": ram_mb,
+            "cores": cores,
+            "cpu_model": cpu_model,
+            "boot_order": boot_order,
+            "vga_model": vga_model,
+            "net_device": net_device,
+            "primary_disk_path": boot_disk_path,
+            "cdrom_path": cdrom_path,
+            "data_disk_path": data_disk_path,
+            "disk_io": disk_io,
+            "tcg": tcg,
+            "cpu_pinning": cpu_pinning,
+            "memory": memory,
+            "network": network
+        }
+        vm.vnc_display = allocate_vnc_display()
+        vm.exit_code = None
+        vm.ready_event = threading.Event()
+        vm.log_buffer.clear()
+        vm.metrics.clear()
+        vm.metrics_state = {}
+        vm.backup_bitmaps = {}
+        vm.set_state("starting")
+
+    # Build QEMU command
+    qemu_cmd = [
+        QEMU_SYSTEM_BINARY,
+        *tcg_args(cores, tcg),
+        *memory_args(ram_mb, memory),
+        "-cpu", cpu_model,
+        "-boot", f"order={boot_order}",
+        "-vga", vga_model,
+        *network_args(network, network_link, net_device, vm.config["mac"]),
+        *disk_args(0, boot_disk_path, disk_io, "qcow2" if overlay else primary_format),
+        "-vnc", f":{vm.vnc_display}",
+        "-qmp", f"unix:{qemu_opt_value(vm.qmp_socket_path)},server=on,wait=off"
+    ]
+
+    if cdrom_path:
+        qemu_cmd += ["-cdrom", cdrom_path]
+
+    if data_disk_path:
+        qemu_cmd.extend(disk_args(1, data_disk_path, disk_io, data_format))
+
+    if saved_state is not None:
+        state_path, _ = saved_state_paths(resume_from)
+        qemu_cmd += ["-incoming", f"exec:cat {shlex.quote(state_path)}"]
+
+    if pool_profile is not None:
+        qemu_cmd.append("-S")
+
+    return vm, qemu_cmd, start_timeout
+
+
+def start_vm_result(vm, waited):
+    """Build the /start_vm response once the VM is ready or the wait ended"""
+    result = "running" if vm.running else "starting" if vm.active else "failed"
+    observe_metric(START_VM_WAIT[result], waited)
+    waited = round(waited, 3)
+
+    if vm.running:
+        return {
+            "status": "success",
+            "message": f"VM {vm.vm_id} started successfully",
+            "start_seconds": waited,
+            "vm": vm.status()
+        }, 200
+    elif vm.active:
+        return {
+            "status": "processing",
+            "message": f"VM {vm.vm_id} is still starting after {waited}s. Watch /vm_status for progress.",
+            "vm": vm.status()
+        }, 202
+    else:
+        output = vm.recent_output()
+        detail = output[-1] if output else "Check logs for details."
+        return {
+            "status": "error",
+            "message": f"VM failed to start: {detail}",
+            "logs": output
+        }, 500
+
+
+def prepare_vm_stop(data):
+    """Mark a VM as stopping and return (vm, process). Raises ApiError"""
+    vm_id = parse_vm_id((data or {}).get('vm_id'))
+
+    with VM_LOCK:
+        vm = VMS.get(vm_id)
+        process = vm.process if vm else None
+        if process is None or vm.state not in ("starting", "pooled", "running"):
+            raise ApiError("VM is not running", 200, "info")
+        vm.set_state("stopping")
+        vm.stop_requested_at = time.monotonic()
+
+    print(f"Stopping QEMU process [{vm_id}]...")
+    return vm, process
+
+
+def pool_members(profile, states=("starting", "pooled")):
+    """Return the pool guests of a profile in one of states
+
+    Must be called with VM_LOCK held.
+    """
+    return [vm for vm in VMS.values() if vm.pool_profile == profile and vm.state in states]
+
+
+def apply_pool_profile(data):
+    """Fill a /start_vm request from its pool profile, if it names one
+
+    Pooled guests share the profile's disk, so profile starts always use an
+    overlay. Raises ApiError for an unknown profile.
+    """
+    data = data or {}
+    profile = data.get('profile')
+    if not profile:
+        return data
+
+    with VM_LOCK:
+        pool = POOL_PROFILES.get(profile)
+        if pool is None:
+            raise ApiError(f"Unknown pool profile: {profile}", 404)
+        merged = dict(pool["config"])
+    merged.update(data)
+    merged["overlay"] = True
+    return merged
+
+
+def claim_pooled_vm(data):
+    """Hand a ready pooled guest over to a /start_vm request
+
+    The guest is renamed to the requested vm_id. Returns None when the
+    request has no profile or the pool is empty. Raises ApiError.
+    """
+    profile = data.get('profile')
+    if not profile:
+        return None
+
+    try:
+        vm_id = parse_vm_id(data.get('vm_id'))
+        overlay_on_stop = data.get('overlay_on_stop')
+    except ValueError as e:
+        raise ApiError(f"Invalid parameters: {str(e)}")
+    if overlay_on_stop is not None and overlay_on_stop not in OVERLAY_STOP_ACTIONS:
+        raise ApiError("Invalid overlay_on_stop (expected discard, commit or keep)")
+
+    with VM_LOCK:
+        existing = VMS.get(vm_id)
+        if existing is not None and existing.active:
+            raise ApiError(f"VM {vm_id} is already running", 200, "info")
+
+        ready = pool_members(profile, ("pooled",))
+        if not ready:
+            return None
+
+        vm = min(ready, key=lambda pooled: pooled.started_at)
+        del VMS[vm.vm_id]
+        vm.vm_id = vm_id
+        vm.pool_profile = None
+        VMS[vm_id] = vm
+        if vm.overlay is not None and overlay_on_stop is not None:
+            vm.overlay["on_stop"] = overlay_on_stop
+        vm.set_state("starting")
+
+    print(f"Handing pooled VM to {vm_id} (profile {profile})")
+    run_on_io_loop(refill_pool(profile))
+    return vm
+
+
+def resume_pooled_vm(vm):
+    """Start the vCPUs of a claimed pooled guest. Raises ApiError"""
+    try:
+        vm.qmp_execute("cont")
+    except QMPError as e:
+        vm.push_output(f"ERROR: Could not resume pooled VM: {str(e)}")
+        vm.set_state("stopping")
+        run_on_io_loop(stop_process(vm.process))
+        raise ApiError(f"VM failed to start: {str(e)}", 500)
+    vm.set_state("running")
+
+
+def pool_status():
+    """Describe every pool profile and its guests"""
+    with VM_LOCK:
+        return {
+            profile: {
+                "size": pool["size"],
+                "config": pool["config"],
+                "ready": len(pool_members(profile, ("pooled",))),
+                "starting": len(pool_members(profile, ("starting",))),
+                "last_error": pool.get("last_error")
+            }
+            for profile, pool in POOL_PROFILES.items()
+        }
+
+
+async def refill_pool(profile):
+    """Launch paused guests one at a time until a profile's pool is full
+
+    Stops at the first failure and when pooled guests would use more than
+    POOL_MAX_RAM_FRACTION of host RAM, so a bad profile cannot loop.
+    """
+    global POOL_NEXT_ID
+
+    while True:
+        with VM_LOCK:
+            pool = POOL_PROFILES.get(profile)
+            if pool is None:
+                return
+
+            if len(pool_members(profile)) >= pool["size"]:
+                return
+
+            config = dict(pool["config"])
+            try:
+                if config.get("resume_from"):
+                    config.update(load_saved_state(str(config["resume_from"]))["config"])
+                ram_mb = int(config.get("ram_mb", DEFAULT_RAM_MB))
+            except (ApiError, OSError, ValueError, TypeError) as e:
+                pool["last_error"] = getattr(e, "message", str(e))
+                return
+            pooled_mb = sum(vm.config.get("ram_mb", 0) for vm in VMS.values()
+                            if vm.pool_profile is not None and vm.active)
+            budget_mb = psutil.virtual_memory().total // (1024 * 1024) * POOL_MAX_RAM_FRACTION
+            if pooled_mb + ram_mb > budget_mb:
+                pool["last_error"] = f"Pool RAM budget reached ({pooled_mb} of {int(budget_mb)} MB)"
+                return
+
+            vm_id = f"pool-{profile}-{POOL_NEXT_ID}"
+            POOL_NEXT_ID += 1
+            try:
+                vm, command, _ = prepare_vm_start(dict(pool["config"], vm_id=vm_id, overlay=True), profile)
+            except (ApiError, ValueError) as e:
+                pool["last_error"] = getattr(e, "message", str(e))
+                print(f"Pool [{profile}]: {pool['last_error']}")
+                return
+            pool["last_error"] = None
+
+        asyncio.ensure_future(supervise_qemu(vm, command))
+        await wait_until_async(lambda: vm.state != "starting", QMP_READY_MAX_SECONDS)
+        if vm.state != "pooled":
+            output = vm.recent_output()
+            with VM_LOCK:
+                if profile in POOL_PROFILES:
+                    POOL_PROFILES[profile]["last_error"] = output[-1] if output else "Pooled VM failed to start"
+            return
+
+
+async def drain_pool(vms):
+    """Stop pooled guests that are no longer wanted"""
+    for vm in vms:
+        process = vm.process
+        if process is None:
+            continue
+        vm.set_state("stopping")
+        await stop_process(process)
+        if vm.overlay is None:
+            finish_vm(vm, process)
+
+
+def start_background_tasks():
+    """Start the balloon policy and image catalog, probe disk I/O and network support, then fill the pools"""
+    async def start():
+        global BALLOON_POLICY_TASK, IMAGE_CATALOG_TASK
+        BALLOON_POLICY_TASK = asyncio.ensure_future(balloon_policy_loop())
+        IMAGE_CATALOG_TASK = asyncio.ensure_future(IMAGE_CATALOG.run())
+        try:
+            await probe_disk_io_support()
+        except Exception as e:
+            print(f"Disk I/O probe failed, options will not be checked: {e}")
+        try:
+            await probe_network_support()
+        except Exception as e:
+            print(f"Network probe failed, options will not be checked: {e}")
+        await asyncio.gather(*(refill_pool(profile) for profile in list(POOL_PROFILES)))
+
+    run_on_io_loop(start())
+
+
+class SerialConsole:
+    """Pattern matching over a guest's serial console on QEMU's stdio"""
+
+    def __init__(self, process):
+        self.process = process
+        self.tail = ""
+
+    async def expect(self, pattern, timeout):
+        """Read until pattern matches the console output. Raises on timeout or exit"""
+        deadline = time.monotonic() + timeout
+        while not re.search(pattern, self.tail):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError(f"Timed out waiting for {pattern!r} on the serial console")
+            try:
+                chunk = await asyncio.wait_for(self.process.stdout.read(4096), remaining)
+            except asyncio.TimeoutError:
+                continue
+            if not chunk:
+                last = self.tail.strip().splitlines()[-1:] or ["no output"]
+                raise RuntimeError(f"QEMU exited: {last[0]}")
+            self.tail = (self.tail + chunk.decode(errors='replace'))[-8192:]
+        self.tail = ""
+
+    async def send(self, text):
+        self.process.stdin.write(text.encode())
+        await self.process.stdin.drain()
+
+
+def prepare_tcg_benchmark(data):
+    """Validate a /tcg_benchmark request and return its configuration"""
+    data = data or {}
+    try:
+        disk = str(data.get('primary_disk_path', DEFAULT_PRIMARY_DISK_PATH)).strip()
+        ram_mb = int(data.get('ram_mb', DEFAULT_RAM_MB))
+        cores = int(data.get('cores', DEFAULT_CORES))
+        boot_timeout = float(data.get('boot_timeout', BENCHMARK_BOOT_TIMEOUT_SECONDS))
+        login_pattern = str(data.get('login_pattern', BENCHMARK_LOGIN_PATTERN))
+        re.compile(login_pattern)
+        login = data.get('login') or None
+        workload = str(data.get('workload', BENCHMARK_WORKLOAD))
+        matrix = dict(BENCHMARK_MATRIX, **(data.get('matrix') or {}))
+        save = bool(data.get('save', True))
+    except (ValueError, TypeError, re.error) as e:
+        raise ApiError(f"Invalid parameters: {str(e)}")
+
+    if not disk:
+        raise ApiError("Primary disk path is required")
+    disk_format = check_image(disk, "Primary disk")
+    if not (512 <= ram_mb <= 32768):
+        raise ApiError("RAM must be between 512 MB and 32768 MB")
+    if not (1 <= cores <= 12):
+        raise ApiError("CPU cores must be between 1 and 12")
+    if not (0 < boot_timeout <= 3600):
+        raise ApiError("boot_timeout must be between 0 and 3600 seconds")
+    if login is not None and not (isinstance(login, dict) and login.get('username')):
+        raise ApiError("login must be {\"username\": ..., \"password\": ...}")
+
+    unknown = set(matrix) - set(BENCHMARK_MATRIX)
+    if unknown:
+        raise ApiError(f"Unknown matrix keys: {', '.join(sorted(unknown))}")
+    if not all(isinstance(values, list) and values for values in matrix.values()):
+        raise ApiError("Each matrix entry must be a non-empty list")
+
+    runs = [dict(zip(matrix, values)) for values in itertools.product(*matrix.values())]
+    if len(runs) > BENCHMARK_MAX_RUNS:
+        raise ApiError(f"Matrix has {len(runs)} combinations, at most {BENCHMARK_MAX_RUNS} allowed")
+    for run in runs:
+        validate_tcg({"thread": run["thread"], "tb_size": run["tb_size"], "smp_layout": run["smp_layout"]})
+        if not re.fullmatch(r'[a-zA-Z0-9_-]+', str(run["cpu_model"])):
+            raise ApiError("Invalid CPU model format")
+
+    return {
+        "disk": os.path.realpath(disk),
+        "disk_format": disk_format,
+        "ram_mb": ram_mb,
+        "cores": cores,
+        "boot_timeout": boot_timeout,
+        "login_pattern": login_pattern,
+        "login": login,
+        "workload": workload,
+        "runs": runs,
+        "save": save
+    }
+
+
+async def benchmark_run(config, settings):
+    """Boot the benchmark disk once under settings and time it
+
+    The guest runs with -snapshot so its disk is never modified. Boot time
+    is measured to the login prompt on the serial console. With login
+    credentials the workload command is then timed inside the guest.
+    """
+    result = {"settings": settings, "boot_seconds": None, "workload_seconds": None, "score": None, "error": None}
+
+    with VM_LOCK:
+        previous = VMS.get(TCG_BENCHMARK_VM_ID)
+        error = (f"VM {TCG_BENCHMARK_VM_ID} is running" if previous is not None and previous.active else
+                 check_admission(TCG_BENCHMARK_VM_ID, config["ram_mb"], config["cores"]))
+        owner = find_disk_owner(TCG_BENCHMARK_VM_ID, [config["disk"]])
+        job = find_image_job([config["disk"]])
+        if not (owner or job or error):
+            # Reserve the guest's RAM, cores and disk like a starting VM, so
+            # starts and jobs during the run see them as taken
+            placeholder = VirtualMachine(TCG_BENCHMARK_VM_ID)
+            placeholder.config = {"ram_mb": config["ram_mb"], "cores": config["cores"],
+                                  "disks": [config["disk"]], "backing": None}
+            placeholder.set_state("starting")
+            VMS[TCG_BENCHMARK_VM_ID] = placeholder
+    if owner or job or error:
+        result["error"] = (f"Disk is in use by VM {owner}" if owner else
+                           f"Disk is busy with image job {job.job_id}" if job else error)
+        return result
+
+    try:
+        tcg = {"thread": settings["thread"], "tb_size": settings["tb_size"], "smp_layout": settings["smp_layout"]}
+        command = [
+            QEMU_SYSTEM_BINARY,
+            *tcg_args(config["cores"], tcg),
+            "-m", str(config['ram_mb']),
+            "-cpu", settings['cpu_model'],
+            "-snapshot",
+            *disk_args(0, config["disk"], resolve_disk_io(DEFAULT_DISK_IO_PROFILE, config["cores"]), config["disk_format"]),
+            "-netdev", "user,id=net0",
+            "-device", "virtio-net-pci,netdev=net0",
+            "-display", "none",
+            "-serial", "stdio",
+            "-monitor", "none"
+        ]
+
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+        if CPU_PINNING_SUPPORTED:
+            reset_cpu_affinity(process.pid)
+        console = SerialConsole(process)
+        started = time.monotonic()
+        try:
+            await console.expect(config["login_pattern"], config["boot_timeout"])
+            result["boot_seconds"] = round(time.monotonic() - started, 3)
+
+            login = config["login"]
+            if login:
+                # The markers are split with quotes so the echoed command line
+                # itself does not match
+                await console.send(login["username"] + "\n")
+                if login.get("password") is not None:
+                    await console.expect(r"[Pp]assword:\s*$", 30)
+                    await console.send(login["password"] + "\n")
+                await console.send('echo "phoenix-bench-""ready"\n')
+                await console.expect(r"phoenix-bench-ready", 60)
+
+                workload_started = time.monotonic()
+                await console.send(f'{config["workload"]}; echo "phoenix-bench-""done"\n')
+                await console.expect(r"phoenix-bench-done", config["boot_timeout"])
+                result["workload_seconds"] = round(time.monotonic() - workload_started, 3)
+
+            result["score"] = round(result["boot_seconds"] + (result["workload_seconds"] or 0), 3)
+        except Exception as e:
+            result["error"] = str(e)
+        finally:
+            await stop_process(process)
+    finally:
+        with VM_LOCK:
+            placeholder.set_state("stopped")
+            if VMS.get(TCG_BENCHMARK_VM_ID) is placeholder:
+                if previous is not None:
+                    VMS[TCG_BENCHMARK_VM_ID] = previous
+                else:
+                    del VMS[TCG_BENCHMARK_VM_ID]
+
+    return result
+
+
+def begin_tcg_benchmark(config):
+    """Reset the /tcg_benchmark status for a new run"""
+    TCG_BENCHMARK.clear()
+    TCG_BENCHMARK.update({
+        "state": "running",
+        "host": host_fingerprint(),
+        "disk": config["disk"],
+        "cores": config["cores"],
+        "total": len(config["runs"]),
+        "results": [],
+        "best": None,
+        "started_at": time.time(),
+        "finished_at": None
+    })
+    publish_event("tcg_benchmark", dict(TCG_BENCHMARK))
+
+
+async def run_tcg_benchmark(config):
+    """Run every benchmark combination in turn and save the fastest"""
+    try:
+        for settings in config["runs"]:
+            print(f"TCG benchmark {len(TCG_BENCHMARK['results']) + 1}/{TCG_BENCHMARK['total']}: {settings}")
+            result = await benchmark_run(config, settings)
+            TCG_BENCHMARK["results"].append(result)
+            publish_event("tcg_benchmark", dict(TCG_BENCHMARK))
+
+        scored = [result for result in TCG_BENCHMARK["results"] if result["score"] is not None]
+        if not scored:
+            TCG_BENCHMARK["state"] = "failed"
+            return dict(TCG_BENCHMARK)
+
+        best = min(scored, key=lambda result: result["score"])
+        settings = best["settings"]
+        TCG_BENCHMARK["best"] = {
+            "tcg": {"thread": settings["thread"], "tb_size": settings["tb_size"], "smp_layout": settings["smp_layout"]},
+            "cpu_model": settings["cpu_model"],
+            "boot_seconds": best["boot_seconds"],
+            "workload_seconds": best["workload_seconds"],
+            "score": best["score"],
+            "disk": config["disk"],
+            "cores": config["cores"],
+            "measured_at": time.time()
+        }
+        if config["save"]:
+            save_tcg_profile(TCG_BENCHMARK["best"])
+        TCG_BENCHMARK["state"] = "finished"
+        return dict(TCG_BENCHMARK)
+    except asyncio.CancelledError:
+        TCG_BENCHMARK["state"] = "cancelled"
+        raise
+    finally:
+        TCG_BENCHMARK["finished_at"] = time.time()
+        publish_event("tcg_benchmark", dict(TCG_BENCHMARK))
+
+
+def prepare_vm_suspend(data):
+    """Validate a /suspend_vm request and return (vm, process, name)"""
+    data = data or {}
+    vm_id = parse_vm_id(data.get('vm_id'))
+    name = str(data.get('name') or f"{vm_id}-{time.strftime('%Y%m%d-%H%M%S')}")
+    if not re.fullmatch(r'[a-zA-Z0-9_-]{1,64}', name):
+        raise ApiError("Invalid saved state name")
+
+    with VM_LOCK:
+        vm = VMS.get(vm_id)
+        if vm is None or not vm.running:
+            raise ApiError("VM is not running", 200, "info")
+        if os.path.exists(saved_state_paths(name)[1]):
+            raise ApiError(f"Saved state {name} already exists", 409)
+        vm.set_state("stopping")
+
+    print(f"Suspending QEMU process [{vm_id}] to {name}...")
+    return vm, vm.process, name
+
+
+def suspend_vm_result(vm, metadata):
+    return {
+        "status": "success",
+        "message": f"VM {vm.vm_id} suspended to {metadata['name']}",
+        "saved_state": metadata
+    }, 200
+
+
+@app.route('/start_vm', methods=['POST'])
+def start_vm():
+    """Start QEMU VM with provided configuration"""
+    try:
+        data = apply_pool_profile(request.get_json())
+
+        vm = claim_pooled_vm(data)
+        if vm is not None:
+            started = time.monotonic()
+            resume_pooled_vm(vm)
+            payload, status_code = start_vm_result(vm, time.monotonic() - started)
+            payload["profile"] = data['profile']
+            return jsonify(payload), status_code
+
+        vm, command, start_timeout = prepare_vm_start(data)
+    except ApiError as e:
+        return jsonify(e.payload()), e.status_code
+
+    run_on_io_loop(supervise_qemu(vm, command))
+
+    # Wait until QMP reports the guest running, QEMU exits, or the timeout passes
+    started = time.monotonic()
+    vm.ready_event.wait(timeout=start_timeout)
+
+    payload, status_code = start_vm_result(vm, time.monotonic() - started)
+    return jsonify(payload), status_code
+
+
+@app.route('/stop_vm', methods=['POST'])
+def stop_vm():
+    """Stop running QEMU VM"""
+    try:
+        vm, process = prepare_vm_stop(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+    except ApiError as e:
+        return jsonify(e.payload()), e.status_code
+
+    try:
+        run_on_io_loop(stop_process(process)).result()
+        if vm.overlay is None:
+            # Otherwise the supervisor finishes the VM after releasing the overlay
+            finish_vm(vm, process)
+
+        return jsonify({
+            "status": "success",
+            "message": f"VM {vm.vm_id} stopped successfully"
+        }), 200
+
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Failed to stop VM: {str(e)}"
+        }), 500
+
+
+@app.route('/pool', methods=['GET'])
+def get_pool():
+    """List warm pool profiles with their ready and starting guests"""
+    return jsonify({
+        "profiles": pool_status()
+    }), 200
+
+
+@app.route('/pool/<profile>', methods=['PUT'])
+def set_pool_profile(profile):
+    """Create or resize a warm pool profile
+
+    The JSON body holds size plus any /start_vm parameters; missing ones
+    fall back to /get_defaults.
+    """
+    data = request.get_json(silent=True) or {}
+
+    if not re.fullmatch(r'[a-zA-Z0-9_-]{1,20}', profile):
+        return jsonify({
+            "status": "error",
+            "message": "Profile names are 1-20 letters, digits, '-' or '_'"
+        }), 400
+
+    try:
+        size = int(data.get('size', 1))
+    except (ValueError, TypeError):
+        size = -1
+    if not (0 <= size <= MAX_VMS):
+        return jsonify({
+            "status": "error",
+            "message": f"Pool size must be between 0 and {MAX_VMS}"
+        }), 400
+
+    config = {key: value for key, value in data.items() if key not in ('size', 'vm_id', 'profile')}
+
+    with VM_LOCK:
+        POOL_PROFILES[profile] = {"size": size, "config": config}
+        members = sorted(pool_members(profile), key=lambda vm: vm.started_at or 0)
+        excess = members[size:]
+
+    if excess:
+        run_on_io_loop(drain_pool(excess))
+    run_on_io_loop(refill_pool(profile))
+
+    return jsonify({
+        "status": "success",
+        "message": f"Pool {profile} set to {size} VMs"
+    }), 200
+
+
+@app.route('/pool/<profile>', methods=['DELETE'])
+def delete_pool_profile(profile):
+    """Remove a warm pool profile and stop its idle guests"""
+    with VM_LOCK:
+        if POOL_PROFILES.pop(profile, None) is None:
+            return jsonify({
+                "status": "error",
+                "message": f"Unknown pool profile: {profile}"
+            }), 404
+        members = pool_members(profile)
+
+    run_on_io_loop(drain_pool(members))
+
+    return jsonify({
+        "status": "success",
+        "message": f"Pool {profile} removed, stopping {len(members)} VMs"
+    }), 200
+
+
+@app.route('/suspend_vm', methods=['POST'])
+def suspend_vm():
+    """Save a running VM's full machine state and shut it down"""
+    try:
+        vm, process, name = prepare_vm_suspend(request.get_json(silent=True))
+        metadata = run_on_io_loop(suspend_vm_async(vm, process, name)).result()
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+    except ApiError as e:
+        return jsonify(e.payload()), e.status_code
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Failed to suspend VM: {str(e)}"
+        }), 500
+
+    payload, status_code = suspend_vm_result(vm, metadata)
+    return jsonify(payload), status_code
+
+
+@app.route('/saved_states', methods=['GET'])
+def get_saved_states():
+    """List saved machine states that /start_vm can resume from"""
+    return jsonify({
+        "saved_states": list_saved_states()
+    }), 200
+
+
+@app.route('/saved_states/<name>', methods=['DELETE'])
+def delete_saved_state(name):
+    """Delete a saved machine state and the overlay kept for it"""
+    try:
+        state = load_saved_state(name)
+    except ApiError as e:
+        return jsonify(e.payload()), e.status_code
+
+    for path in saved_state_paths(name):
+        os.remove(path)
+
+    # The overlay goes too unless a VM runs on it or another state needs it
+    message = f"Saved state {name} deleted"
+    overlay = saved_state_overlay(state)
+    if overlay and os.path.exists(overlay):
+        with VM_LOCK:
+            owner = find_disk_owner(None, [overlay])
+        if owner is None and not any(saved_state_overlay(other) == overlay for other in list_saved_states()):
+            os.remove(overlay)
+            message += f" with overlay {os.path.basename(overlay)}"
+
+    return jsonify({
+        "status": "success",
+        "message": message
+    }), 200
+
+
+@app.route('/images', methods=['GET'])
+def get_images():
+    """List catalogued disk and ISO images with their cached qemu-img metadata
+
+    ?kind=disk|iso filters the list, ?refresh=1 rescans the catalog
+    directories first and ?path= probes and returns a single image.
+    """
+    path = request.args.get('path', '').strip()
+    kind = request.args.get('kind')
+    if kind not in (None, "disk", "iso"):
+        return jsonify({
+            "status": "error",
+            "message": "kind must be disk or iso"
+        }), 400
+
+    if path:
+        if not os.path.isfile(path):
+            return jsonify({
+                "status": "error",
+                "message": f"Image not found: {path}"
+            }), 404
+        # run_probe bounds the wait with its own timeout
+        entry = IMAGE_CATALOG.lookup(path) or run_on_io_loop(IMAGE_CATALOG.probe(path)).result()
+        if entry is None:
+            return jsonify({
+                "status": "error",
+                "message": f"Image not found: {path}"
+            }), 404
+        return jsonify({
+            "status": "success",
+            "image": IMAGE_CATALOG.describe(entry)
+        }), 200
+
+    if request.args.get('refresh') in ('1', 'true'):
+        run_on_io_loop(IMAGE_CATALOG.scan()).result()
+
+    return jsonify({
+        "status": "success",
+        "directories": IMAGE_CATALOG.directories,
+        "watching": IMAGE_CATALOG.watching,
+        "images": IMAGE_CATALOG.list(kind)
+    }), 200
+
+
+@app.route('/images/<name>', methods=['PUT'])
+def upload_image(name):
+    """Upload an image, whole or as resumable chunks
+
+    Chunks carry Content-Range: bytes <start>-<end>/<size> and may be sent
+    in any order. X-Chunk-Sha256 verifies a chunk and X-Image-Sha256 the
+    finished file. A chunk with X-Zero-Range: 1 and no body marks a range
+    of zeros, which is left as a hole. The body is streamed to disk.
+    """
+    try:
+        upload, start, length, zero_range, chunk_sha256 = parse_image_chunk(name, request.headers, request.args)
+        if zero_range:
+            image = upload.finish_chunk(start, length, length)
+        else:
+            digest = hashlib.sha256() if chunk_sha256 else None
+            received = 0
+            while received < length:
+                block = request.stream.read(min(IMAGE_TRANSFER_BLOCK_BYTES, length - received))
+                if not block:
+                    break
+                upload.write(start + received, block)
+                if digest:
+                    digest.update(block)
+                received += len(block)
+            image = upload.finish_chunk(start, length, received, digest and digest.hexdigest(), chunk_sha256)
+    except ApiError as e:
+        return jsonify(e.payload()), e.status_code
+    except OSError as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Failed to write image: {e}"
+        }), 500
+
+    payload, status_code = image_upload_response(upload, image)
+    return jsonify(payload), status_code
+
+
+@app.route('/images/<name>/upload', methods=['GET'])
+def get_image_upload(name):
+    """Progress of a resumable upload: received and missing byte ranges"""
+    try:
+        validate_image_name(name)
+        upload = ImageUpload.open(name)
+    except ApiError as e:
+        return jsonify(e.payload()), e.status_code
+    return jsonify({
+        "status": "success",
+        "upload": upload.status()
+    }), 200
+
+
+@app.route('/images/<name>/upload', methods=['DELETE'])
+def abort_image_upload(name):
+    """Abort an upload and delete what was received"""
+    try:
+        validate_image_name(name)
+        ImageUpload.open(name).abort()
+    except ApiError as e:
+        return jsonify(e.payload()), e.status_code
+    return jsonify({
+        "status": "success",
+        "message": f"Upload of {name} aborted"
+    }), 200
+
+
+@app.route('/images/<name>', methods=['GET'])
+def download_image(name):
+    """Download an image. Supports Range requests for resuming
+
+    Servers with wsgi.file_wrapper (gunicorn, uWSGI) send the file with
+    sendfile(). Elsewhere it is read in 1 MB blocks instead of Werkzeug's
+    default 8 KB. --asgi mode serves this route natively.
+    """
+    try:
+        path = find_image(name)
+    except ApiError as e:
+        return jsonify(e.payload()), e.status_code
+    request.environ.setdefault('wsgi.file_wrapper',
+                               lambda f, buffer_size=None: FileWrapper(f, IMAGE_TRANSFER_BLOCK_BYTES))
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                     download_name=name, conditional=True, etag=image_etag(os.stat(path)))
+
+
+@app.route('/images/<name>/extents', methods=['GET'])
+def get_image_extents(name):
+    """Byte ranges of an image that hold data
+
+    Clients can fetch only these with Range requests and leave the rest of
+    their copy as holes.
+    """
+    try:
+        path = find_image(name)
+        extents = data_extents(path)
+    except ApiError as e:
+        return jsonify(e.payload()), e.status_code
+    return jsonify({
+        "status": "success",
+        "size": os.path.getsize(path),
+        "data_bytes": sum(length for _, length in extents),
+        "extents": [[offset, length] for offset, length in extents]
+    }), 200
+
+
+@app.route('/images/<name>/jobs', methods=['POST'])
+def create_image_job(name):
+    """Start a qemu-img maintenance job on an image
+
+    {"operation": "compact"}, {"operation": "convert", "format": "raw"},
+    {"operation": "compress", "compression": "zstd"},
+    {"operation": "check", "repair": "leaks"}, {"operation": "map"} or
+    {"operation": "resize", "size": "+2G"}. compact, convert and compress
+    accept "output" to write a new image instead of replacing this one.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        job = submit_image_job(build_image_job(name, data))
+    except ApiError as e:
+        return jsonify(e.payload()), e.status_code
+
+    return jsonify({
+        "status": "success",
+        "message": f"Queued {job.operation} of {name}",
+        "job": job.status()
+    }), 202
+
+
+@app.route('/image_jobs', methods=['GET'])
+def list_image_jobs():
+    """List queued, running and recently finished image jobs"""
+    with IMAGE_JOBS_LOCK:
+        jobs = [job.status() for job in IMAGE_JOBS.values()]
+
+    return jsonify({
+        "jobs": jobs
+    }), 200
+
+
+@app.route('/image_jobs/<job_id>', methods=['GET'])
+def image_job_status(job_id):
+    """Get an image job's progress, result and qemu-img output newer than since"""
+    with IMAGE_JOBS_LOCK:
+        job = IMAGE_JOBS.get(job_id)
+    if job is None:
+        return jsonify({
+            "status": "error",
+            "message": f"Unknown image job: {job_id}"
+        }), 404
+
+    try:
+        since, limit = parse_cursor_args()
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    lines, next_cursor, overflow = job.output.read(since, limit)
+    return jsonify(dict(
+        job.status(),
+        output=[line for _, line in lines],
+        next=next_cursor,
+        overflow=overflow
+    )), 200
+
+
+@app.route('/image_jobs/<job_id>', methods=['DELETE'])
+def delete_image_job(job_id):
+    """Cancel an image job, leaving the original image untouched"""
+    with IMAGE_JOBS_LOCK:
+        job = IMAGE_JOBS.get(job_id)
+    if job is None:
+        return jsonify({
+            "status": "error",
+            "message": f"Unknown image job: {job_id}"
+        }), 404
+
+    if job.finished:
+        return jsonify({
+            "status": "info",
+            "message": f"Image job {job_id} is already {job.state}"
+        }), 200
+
+    run_on_io_loop(cancel_image_job(job)).result()
+    return jsonify({
+        "status": "success",
+        "message": f"Image job {job_id} cancelled",
+        "job": job.status()
+    }), 200
+
+
+@app.route('/backup', methods=['POST'])
+def create_backup():
+    """Back up a running VM's drives without pausing it
+
+    {"vm_id": "default", "mode": "auto"}. "auto" makes an incremental
+    backup when the chain allows it and a full one otherwise; "full" and
+    "incremental" force a mode. Progress is reported by GET /backups and
+    backup events.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        backup, reason = start_backup(data)
+    except ApiError as e:
+        return jsonify(e.payload()), e.status_code
+
+    message = f"Started {backup.mode} backup {backup.backup_id} of VM {backup.vm_id}"
+    if reason and data.get('mode', 'auto') == "auto":
+        message += f" (full because {reason})"
+    return jsonify({
+        "status": "success",
+        "message": message,
+        "backup": backup.status()
+    }), 202
+
+
+@app.route('/backups', methods=['GET'])
+def list_backups():
+    """List a VM's backup chain and its running or last backup"""
+    try:
+        vm_id = parse_vm_id(request.args.get('vm_id'))
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    with BACKUPS_LOCK:
+        manifest = load_backup_manifest(vm_id)
+        current = BACKUPS.get(vm_id)
+        current = current.status() if current else None
+
+    return jsonify({
+        "vm_id": vm_id,
+        "backup_dir": backup_dir(vm_id),
+        "backups": manifest["backups"],
+        "current": current
+    }), 200
+
+
+@app.route('/backups/<vm_id>/<backup_id>', methods=['DELETE'])
+def remove_backup(vm_id, backup_id):
+    """Delete a backup together with the incremental backups built on it"""
+    try:
+        removed = delete_backup(vm_id, backup_id)
+    except ApiError as e:
+        return jsonify(e.payload()), e.status_code
+
+    return jsonify({
+        "status": "success",
+        "message": f"Deleted {len(removed)} backup(s)",
+        "removed": removed
+    }), 200
+
+
+@app.route('/backup/restore', methods=['POST'])
+def restore_backup():
+    """Rebuild one drive as it was at a backup, as an image job
+
+    {"vm_id": "default", "backup_id": "...", "drive": "drive0",
+    "output": "restored.qcow2"} writes a new image to the image directory;
+    "replace": true overwrites the drive's original image instead.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        job = submit_image_job(build_restore_job(data))
+    except ApiError as e:
+        return jsonify(e.payload()), e.status_code
+
+    return jsonify({
+        "status": "success",
+        "message": f"Queued restore of backup {job.params['backup_id']} to {os.path.basename(job.output_path)}",
+        "job": job.status()
+    }), 202
+
+
+@app.route('/overlays', methods=['GET'])
+def get_overlays():
+    """List session overlay images and the VM using each one"""
+    return jsonify({
+        "overlays": list_overlays()
+    }), 200
+
+
+@app.route('/overlays/<name>', methods=['DELETE'])
+def delete_overlay(name):
+    """Delete an overlay image that no running VM is using"""
+    overlay = next((o for o in list_overlays() if o["name"] == name), None)
+    if overlay is None:
+        return jsonify({
+            "status": "error",
+            "message": f"Unknown overlay: {name}"
+        }), 404
+
+    if overlay["vm_id"]:
+        return jsonify({
+            "status": "error",
+            "message": f"Overlay is in use by VM {overlay['vm_id']}"
+        }), 409
+
+    if overlay["saved_state"]:
+        return jsonify({
+            "status": "error",
+            "message": f"Overlay is needed by saved state {overlay['saved_state']}. Delete the saved state instead"
+        }), 409
+
+    os.remove(overlay["path"])
+    return jsonify({
+        "status": "success",
+        "message": f"Overlay {name} deleted"
+    }), 200
+
+
+@app.route('/overlays/gc', methods=['POST'])
+def gc_overlays():
+    """Delete unused overlays, optionally only those older than older_than seconds"""
+    data = request.get_json(silent=True) or {}
+    try:
+        older_than = float(data.get('older_than', 0))
+    except (ValueError, TypeError):
+        return jsonify({
+            "status": "error",
+            "message": "older_than must be a number of seconds"
+        }), 400
+
+    removed = []
+    freed = 0
+    cutoff = time.time() - older_than
+    for overlay in list_overlays():
+        if overlay["vm_id"] or overlay["saved_state"] or overlay["modified_at"] > cutoff:
+            continue
+        try:
+            os.remove(overlay["path"])
+        except OSError:
+            continue
+        removed.append(overlay["name"])
+        freed += overlay["size_bytes"]
+
+    return jsonify({
+        "status": "success",
+        "message": f"Removed {len(removed)} overlays",
+        "removed": removed,
+        "freed_bytes": freed
+    }), 200
+
+
+@app.route('/vm_network', methods=['GET'])
+def get_vm_network():
+    """Report a VM's network backend, link peer and NIC counters"""
+    try:
+        vm_id = parse_vm_id(request.args.get('vm_id'))
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    vm = get_vm(vm_id)
+    if vm is None or not vm.active:
+        return jsonify({
+            "status": "info",
+            "message": "VM is not running"
+        }), 200
+
+    link = vm.config.get("network_link")
+    if link is not None:
+        with VM_LOCK:
+            peers = [other.vm_id for other in VMS.values() if other is not vm and other.active
+                     and (other.config.get("network_link") or {}).get("link") == link["link"]]
+        link = dict(link, peer=peers[0] if peers else None)
+
+    return jsonify({
+        "vm_id": vm_id,
+        "network": vm.start_params.get("network"),
+        "mac": vm.config.get("mac"),
+        "link": link,
+        "counters": network_counters(vm),
+        "support": NETWORK_SUPPORT
+    }), 200
+
+
+@app.route('/network_benchmark', methods=['POST'])
+def start_network_benchmark():
+    """Measure guest network throughput with an iperf-style TCP stream
+
+    {"vm_id": "default", "direction": "to_host" | "to_guest", "seconds": 10}.
+    The server listens on a free port and answers with the command to run
+    in the guest. The result appears in GET /network_benchmark.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        config = prepare_network_benchmark(data)
+    except ApiError as e:
+        return jsonify(e.payload()), e.status_code
+
+    vm_id = config["vm_id"]
+    current = NETWORK_BENCHMARKS.get(vm_id)
+    if current is not None and current["state"] in ("waiting", "running"):
+        return jsonify({
+            "status": "error",
+            "message": f"A network benchmark of VM {vm_id} is already {current['state']}"
+        }), 409
+
+    benchmark = {
+        "vm_id": vm_id,
+        "mode": config["mode"],
+        "direction": config["direction"],
+        "seconds": config["seconds"],
+        "state": "waiting",
+        "port": None,
+        "guest_command": None,
+        "bytes": 0,
+        "elapsed_seconds": None,
+        "mbit_per_second": None,
+        "error": None,
+        "started_at": time.time()
+    }
+    try:
+        benchmark["port"] = run_on_io_loop(run_network_benchmark(config, benchmark)).result()
+    except OSError as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Could not listen on {config['listen_host']}: {str(e)}"
+        }), 500
+
+    target = f"{config['guest_host']} {benchmark['port']}"
+    benchmark["guest_command"] = (f"cat /dev/zero | nc {target}" if config["direction"] == "to_host"
+                                  else f"nc {target} > /dev/null")
+    NETWORK_BENCHMARKS[vm_id] = benchmark
+    return jsonify({
+        "status": "processing",
+        "message": f"Run in the guest within {NETWORK_BENCHMARK_CONNECT_TIMEOUT_SECONDS} seconds: {benchmark['guest_command']}",
+        "benchmark": benchmark
+    }), 202
+
+
+@app.route('/network_benchmark', methods=['GET'])
+def get_network_benchmark():
+    """Progress and result of a VM's last network benchmark"""
+    try:
+        vm_id = parse_vm_id(request.args.get('vm_id'))
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    return jsonify(NETWORK_BENCHMARKS.get(vm_id) or {"vm_id": vm_id, "state": "idle"}), 200
+
+
+@app.route('/tcg_benchmark', methods=['POST'])
+def start_tcg_benchmark():
+    """Boot a disk under each TCG setting in the matrix in the background"""
+    global TCG_BENCHMARK_FUTURE
+
+    try:
+        config = prepare_tcg_benchmark(request.get_json(silent=True))
+    except ApiError as e:
+        return jsonify(e.payload()), e.status_code
+
+    if TCG_BENCHMARK_FUTURE is not None and not TCG_BENCHMARK_FUTURE.done():
+        return jsonify({
+            "status": "error",
+            "message": "A TCG benchmark is already running"
+        }), 409
+
+    begin_tcg_benchmark(config)
+    TCG_BENCHMARK_FUTURE = run_on_io_loop(run_tcg_benchmark(config))
+    return jsonify({
+        "status": "processing",
+        "message": f"Benchmarking {len(config['runs'])} TCG configurations. Watch /tcg_benchmark for progress.",
+        "runs": config["runs"]
+    }), 202
+
+
+@app.route('/tcg_benchmark', methods=['GET'])
+def get_tcg_benchmark():
+    """Progress and results of the last TCG benchmark"""
+    return jsonify(TCG_BENCHMARK), 200
+
+
+@app.route('/tcg_benchmark', methods=['DELETE'])
+def cancel_tcg_benchmark():
+    """Stop a running TCG benchmark"""
+    if TCG_BENCHMARK_FUTURE is None or TCG_BENCHMARK_FUTURE.done():
+        return jsonify({
+            "status": "info",
+            "message": "No TCG benchmark is running"
+        }), 200
+
+    TCG_BENCHMARK_FUTURE.cancel()
+    return jsonify({
+        "status": "success",
+        "message": "TCG benchmark cancelled"
+    }), 200
+
+
+@app.route('/tcg_profile', methods=['GET'])
+def get_tcg_profile():
+    """The TCG settings /start_vm uses on this host"""
+    return jsonify({
+        "host": host_fingerprint(),
+        "profile": load_tcg_profiles().get(host_fingerprint()),
+        "defaults": TCG_DEFAULTS
+    }), 200
+
+
+@app.route('/tcg_profile', methods=['DELETE'])
+def delete_tcg_profile():
+    """Forget this host's benchmark winner and go back to TCG_DEFAULTS"""
+    if host_fingerprint() not in load_tcg_profiles():
+        return jsonify({
+            "status": "info",
+            "message": "No TCG profile saved for this host"
+        }), 200
+
+    save_tcg_profile(None)
+    return jsonify({
+        "status": "success",
+        "message": "TCG profile removed"
+    }), 200
+
+
+def defaults_payload():
+    """Default /start_vm values, shared by /get_defaults and /dashboard"""
+    return {
+        "default_primary_disk_path": DEFAULT_PRIMARY_DISK_PATH,
+        "default_cdrom_path": DEFAULT_CDROM_PATH,
+        "default_data_disk_path": DEFAULT_DATA_DISK_PATH,
+        "default_ram_mb": DEFAULT_RAM_MB,
+        "default_cores": DEFAULT_CORES,
+        "default_cpu_model": DEFAULT_CPU_MODEL,
+        "default_boot_order": DEFAULT_BOOT_ORDER,
+        "default_vga_model": DEFAULT_VGA_MODEL,
+        "default_net_device": DEFAULT_NET_DEVICE,
+        "pool_profiles": sorted(POOL_PROFILES),
+        "disk_io_profiles": DISK_IO_PROFILES,
+        "disk_io_support": DISK_IO_SUPPORT,
+        "network_modes": NETWORK_MODES,
+        "network_support": NETWORK_SUPPORT
+    }
 
 
-def enqueue_output(pipe, output_queue):
-    """Read process output line by line and put into queue"""
+@app.route('/get_defaults', methods=['GET'])
+def get_defaults():
+    """Get default configuration values"""
+    return jsonify(defaults_payload()), 200
+
+
+@app.route('/qemu_logs', methods=['GET'])
+def qemu_logs():
+    """Get a VM's QEMU output logs newer than the since cursor"""
     try:
-        for line in iter(pipe.readline, ''):
-            if line:
-                output_queue.put(line.strip())
-    except Exception as e:
-        output_queue.put(f"ERROR: {str(e)}")
-    finally:
-        pipe.close()
+        vm_id = parse_vm_id(request.args.get('vm_id'))
+        since, limit = parse_cursor_args()
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Invalid parameters: {str(e)}"
+        }), 400
+
+    vm = get_vm(vm_id)
+    entries, next_cursor, overflow = vm.log_buffer.read(since, limit) if vm else ([], since, False)
+    logs = [line for _, line in entries]
+
+    if not logs and not since:
+        logs = ["No recent logs available"]
 
+    return jsonify({
+        "logs": logs,
+        "next": next_cursor,
+        "overflow": overflow
+    }), 200
+
+
+def parse_log_time(value):
+    """Parse a /logs/search time bound: Unix seconds or ISO 8601, or None"""
+    if value in (None, ''):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
 
-def run_qemu_thread(command):
-    """Run QEMU process in background thread"""
-    global QEMU_PROCESS, QEMU_RUNNING
 
-    print(f"Starting QEMU: {command}")
+@app.route('/logs/search', methods=['GET'])
+def search_logs():
+    """Search the persistent QEMU and terminal log store"""
+    if not LOG_STORE_ENABLED:
+        return jsonify({
+            "status": "error",
+            "message": "The persistent log store is disabled"
+        }), 404
 
     try:
-        QEMU_PROCESS = subprocess.Popen(
-            command,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1
-        )
+        query = request.args.get('q', '')
+        since_ts = parse_log_time(request.args.get('from'))
+        until_ts = parse_log_time(request.args.get('to'))
+        stream = request.args.get('stream')
+        if request.args.get('vm_id'):
+            stream = f"qemu:{parse_vm_id(request.args.get('vm_id'))}"
+        limit = min(int(request.args.get('limit', LOG_SEARCH_LIMIT)), LOG_SEARCH_LIMIT)
+        if limit < 1:
+            raise ValueError("limit must be >= 1")
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Invalid parameters: {str(e)}"
+        }), 400
+
+    if LOG_STORE.error is not None:
+        return jsonify({
+            "status": "error",
+            "message": f"The persistent log store is unavailable: {LOG_STORE.error}"
+        }), 503
+
+    started = time.monotonic()
+    records, truncated, scanned = LOG_STORE.search(query, since_ts, until_ts, stream, limit)
+    return jsonify({
+        "results": records,
+        "truncated": truncated,
+        "segments_scanned": scanned,
+        "search_seconds": round(time.monotonic() - started, 3)
+    }), 200
+
+
+@app.route('/run_terminal_command', methods=['POST'])
+def run_terminal_command():
+    """Execute a terminal command"""
+    data = request.get_json()
+    command = data.get('command', '').strip()
+
+    if not command:
+        return jsonify({
+            "status": "error",
+            "message": "No command provided"
+        }), 400
+
+    # With a session id the command is typed into that interactive shell
+    session_id = data.get('session_id')
+    if session_id:
+        session = get_terminal_session(session_id)
+        if session is None:
+            return jsonify({
+                "status": "error",
+                "message": f"Unknown terminal session: {session_id}"
+            }), 404
+        try:
+            session.write(command + "\n")
+        except (OSError, TimeoutError) as e:
+            return jsonify({
+                "status": "error",
+                "message": f"Failed to write to terminal: {str(e)}"
+            }), 500
+        return jsonify({
+            "status": "success",
+            "message": "Command sent to terminal session"
+        }), 200
+
+    # Queue the command for the bounded job runner
+    try:
+        job = submit_job(command)
+    except ApiError as e:
+        return jsonify(e.payload()), e.status_code
+
+    return jsonify({
+        "status": "processing",
+        "message": "Command sent to terminal",
+        "job_id": job.job_id,
+        "job": job.status()
+    }), 202
+
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    """List queued, running and recently finished terminal jobs"""
+    with JOBS_LOCK:
+        jobs = [job.status() for job in JOBS.values()]
+
+    return jsonify({
+        "jobs": jobs
+    }), 200
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Get a job's status, exit code and output newer than since"""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({
+            "status": "error",
+            "message": f"Unknown job: {job_id}"
+        }), 404
+
+    try:
+        since, limit = parse_cursor_args()
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    lines, next_cursor, overflow = job.output.read(since, limit)
+    return jsonify(dict(
+        job.status(),
+        output=[line for _, line in lines],
+        next=next_cursor,
+        overflow=overflow
+    )), 200
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def delete_job(job_id):
+    """Cancel a queued job or kill a running job's process group"""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({
+            "status": "error",
+            "message": f"Unknown job: {job_id}"
+        }), 404
+
+    if job.finished:
+        return jsonify({
+            "status": "info",
+            "message": f"Job {job_id} is already {job.state}"
+        }), 200
+
+    run_on_io_loop(cancel_job(job)).result()
+    return jsonify({
+        "status": "success",
+        "message": f"Job {job_id} cancelled",
+        "job": job.status()
+    }), 200
+
+
+@app.route('/get_terminal_output', methods=['GET'])
+def get_terminal_output():
+    """Get terminal command output newer than the since cursor"""
+    try:
+        since, limit = parse_cursor_args()
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Invalid parameters: {str(e)}"
+        }), 400
+
+    entries, next_cursor, overflow = TERMINAL_LOG_BUFFER.read(since, limit)
+    output_lines = [{
+        "message": line,
+        "type": classify_terminal_line(line)
+    } for _, line in entries]
+
+    return jsonify({
+        "output": output_lines,
+        "next": next_cursor,
+        "overflow": overflow
+    }), 200
+
+
+def parse_dashboard_args(args):
+    """Parse /dashboard parameters into (vm_id, sections, cursors, wait)
+
+    Raises ValueError for invalid values.
+    """
+    vm_id = parse_vm_id(args.get('vm_id'))
+
+    sections = [name.strip() for name in args.get('sections', DASHBOARD_DEFAULT_SECTIONS).split(',') if name.strip()]
+    unknown = set(sections) - set(DASHBOARD_SECTIONS)
+    if unknown:
+        raise ValueError(f"Unknown sections: {', '.join(sorted(unknown))}")
+
+    cursors = {name: int(args.get(f'{name}_since', 0)) for name in ("logs", "terminal", "metrics")}
+    if min(cursors.values()) < 0:
+        raise ValueError("Cursors must be >= 0")
+
+    wait = float(args.get('wait', 0))
+    if not (0 <= wait <= DASHBOARD_MAX_WAIT_SECONDS):
+        raise ValueError(f"wait must be between 0 and {DASHBOARD_MAX_WAIT_SECONDS} seconds")
+
+    return vm_id, sections, cursors, wait
+
+
+def build_dashboard(vm_id, sections, cursors):
+    """Collect the requested dashboard sections. Returns (payload, etag)
+
+    status and defaults are always included when requested; logs, terminal
+    and metrics only when there is something newer than their cursor. The
+    ETag identifies the server-side state (status, defaults and the newest
+    entry of each buffer) rather than the payload, so a client that has
+    caught up keeps the same ETag after advancing its cursors.
+    """
+    vm = get_vm(vm_id)
+    payload = {}
+    state = {"sections": sections}
+
+    if "status" in sections:
+        payload["status"] = state["status"] = vm.status() if vm else stopped_vm_status(vm_id)
+
+    if "logs" in sections and vm is not None:
+        state["logs"] = vm.log_buffer.last_seq()
+        entries, next_cursor, overflow = vm.log_buffer.read(cursors["logs"], LOG_READ_LIMIT)
+        if entries or overflow or next_cursor != cursors["logs"]:
+            payload["logs"] = {
+                "logs": [line for _, line in entries],
+                "next": next_cursor,
+                "overflow": overflow
+            }
+
+    if "terminal" in sections:
+        state["terminal"] = TERMINAL_LOG_BUFFER.last_seq()
+        entries, next_cursor, overflow = TERMINAL_LOG_BUFFER.read(cursors["terminal"], LOG_READ_LIMIT)
+        if entries or overflow or next_cursor != cursors["terminal"]:
+            payload["terminal"] = {
+                "output": [{"message": line, "type": classify_terminal_line(line)} for _, line in entries],
+                "next": next_cursor,
+                "overflow": overflow
+            }
+
+    if "metrics" in sections and vm is not None:
+        touch_metrics_sampler()
+        state["metrics"] = vm.metrics.last_seq()
+        entries, next_cursor, _ = vm.metrics.read(cursors["metrics"], METRICS_MAX_POINTS)
+        if entries or next_cursor != cursors["metrics"]:
+            payload["metrics"] = {
+                "samples": [sample for _, sample in entries],
+                "next": next_cursor
+            }
+
+    if "defaults" in sections:
+        payload["defaults"] = state["defaults"] = defaults_payload()
+
+    digest = hashlib.sha1(json.dumps(state, sort_keys=True).encode()).hexdigest()
+    return payload, f'"{digest[:24]}"'
+
+
+def dashboard_unchanged(payload, etag, if_none_match):
+    """True when the client already has this state and no entries are pending"""
+    return etag == if_none_match and not any(name in payload for name in ("logs", "terminal", "metrics"))
+
+
+def dashboard_poll_interval(sections, remaining):
+    """How long to wait for events before rebuilding the dashboard
+
+    Metrics samples are not published as events, so they are polled at the
+    sampling interval.
+    """
+    if "metrics" in sections:
+        return min(remaining, METRICS_SAMPLE_INTERVAL_SECONDS)
+    return remaining
+
+
+DASHBOARD_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Access-Control-Expose-Headers": "ETag"
+}
+
+
+@app.route('/dashboard', methods=['GET'])
+def dashboard():
+    """Status, logs, terminal output, metrics and defaults in one request
+
+    Pass the next cursors from the previous response as logs_since,
+    terminal_since and metrics_since. Send the previous ETag in
+    If-None-Match to get 304 when nothing changed; with wait=<seconds> the
+    request is held open until something changes or the wait runs out.
+    """
+    try:
+        vm_id, sections, cursors, wait = parse_dashboard_args(request.args)
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Invalid parameters: {str(e)}"
+        }), 400
+
+    if_none_match = request.headers.get('If-None-Match')
+    deadline = time.monotonic() + wait
+    while True:
+        event_cursor = EVENT_BUFFER.last_seq()
+        payload, etag = build_dashboard(vm_id, sections, cursors)
+        unchanged = dashboard_unchanged(payload, etag, if_none_match)
+        remaining = deadline - time.monotonic()
+        if not unchanged or remaining <= 0:
+            break
+        EVENT_BUFFER.wait(event_cursor, dashboard_poll_interval(sections, remaining))
+
+    headers = dict(DASHBOARD_HEADERS, ETag=etag)
+    if unchanged:
+        return Response(status=304, headers=headers)
+    return jsonify(payload), 200, headers
+
+
+def parse_event_filters(args, last_event_id):
+    """Parse /events parameters into (last_id, is_wanted, vm_filter)
+
+    Raises ValueError for an invalid last event id.
+    """
+    last_id = int(last_event_id or args.get('last_event_id', 0))
+
+    types = args.get('types', '')
+    wanted = set(t.strip() for t in types.split(',') if t.strip()) or None
+    vm_filter = args.get('vm_id')
+    session_filter = args.get('session_id')
+
+    def is_wanted(event_type, data):
+        if wanted is not None and event_type not in wanted:
+            return False
+        if session_filter is not None and data.get("session_id", session_filter) != session_filter:
+            return False
+        return vm_filter is None or data.get("vm_id", vm_filter) == vm_filter
+
+    return last_id, is_wanted, vm_filter
+
+
+def stream_preamble(is_wanted, vm_filter):
+    """Retry hint plus a vm_status snapshot sent when a stream opens"""
+    with VM_LOCK:
+        if vm_filter is not None:
+            vm = VMS.get(vm_filter)
+            snapshot = [vm.status() if vm else stopped_vm_status(vm_filter)]
+        else:
+            snapshot = [vm.status() for vm in VMS.values()]
+
+    chunks = [f"retry: {STREAM_RETRY_MS}\n\n"]
+    for status in snapshot:
+        if is_wanted("vm_status", status):
+            chunks.append(format_sse("vm_status", status))
+    return "".join(chunks)
+
+
+def collect_events(cursor, is_wanted):
+    """Format all events after cursor. Returns (text, new_cursor)
+
+    Sends a heartbeat comment when there is nothing to deliver.
+    """
+    pending, cursor, missed = EVENT_BUFFER.read(cursor)
+
+    chunks = []
+    if missed and pending:
+        chunks.append(format_sse("overflow", {"resumed_from": pending[0][0]}))
+
+    for event_id, (event_type, data) in pending:
+        if is_wanted(event_type, data):
+            chunks.append(format_sse(event_type, data, event_id))
+
+    return "".join(chunks) or ": heartbeat\n\n", cursor
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no"
+}
+
+
+@app.route('/terminal_sessions', methods=['GET'])
+def list_terminal_sessions():
+    """List open interactive terminal sessions"""
+    with PTY_SESSIONS_LOCK:
+        sessions = [session.status() for session in PTY_SESSIONS.values()]
+
+    return jsonify({
+        "sessions": sessions
+    }), 200
+
+
+@app.route('/terminal_sessions', methods=['POST'])
+def create_terminal_session():
+    """Open a persistent shell on a pseudo-terminal"""
+    data = request.get_json(silent=True) or {}
+    try:
+        cols, rows = parse_terminal_size(data)
+    except (ValueError, TypeError) as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Invalid parameters: {str(e)}"
+        }), 400
+
+    shell = str(data.get('shell') or PTY_SHELL)
+    with PTY_SESSIONS_LOCK:
+        if len(PTY_SESSIONS) >= MAX_PTY_SESSIONS:
+            return jsonify({
+                "status": "error",
+                "message": f"Maximum number of terminal sessions reached ({MAX_PTY_SESSIONS})"
+            }), 409
+
+    try:
+        session = run_on_io_loop(open_terminal_session(shell, cols, rows)).result()
+    except OSError as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Failed to start shell: {str(e)}"
+        }), 500
+
+    return jsonify({
+        "status": "success",
+        "message": f"Terminal session {session.session_id} started",
+        "session": session.status()
+    }), 200
+
+
+@app.route('/terminal_sessions/<session_id>/output', methods=['GET'])
+def terminal_session_output(session_id):
+    """Read raw output chunks newer than since, concatenated"""
+    session = get_terminal_session(session_id)
+    if session is None:
+        return jsonify({
+            "status": "error",
+            "message": f"Unknown terminal session: {session_id}"
+        }), 404
+
+    try:
+        since, limit = parse_cursor_args()
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    session.last_active = time.monotonic()
+    chunks, next_cursor, overflow = session.output.read(since, limit)
+    return jsonify({
+        "data": "".join(chunk for _, chunk in chunks),
+        "next": next_cursor,
+        "overflow": overflow
+    }), 200
+
+
+@app.route('/terminal_sessions/<session_id>/input', methods=['POST'])
+def terminal_session_input(session_id):
+    """Send keystrokes (including control characters) to a session"""
+    session = get_terminal_session(session_id)
+    if session is None:
+        return jsonify({
+            "status": "error",
+            "message": f"Unknown terminal session: {session_id}"
+        }), 404
+
+    data = request.get_json(silent=True) or {}
+    try:
+        session.write(str(data.get('data', '')))
+    except (OSError, TimeoutError) as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Failed to write to terminal: {str(e)}"
+        }), 500
+
+    return jsonify({
+        "status": "success",
+        "message": "Input sent"
+    }), 200
+
+
+@app.route('/terminal_sessions/<session_id>/resize', methods=['POST'])
+def terminal_session_resize(session_id):
+    """Change a session's terminal size"""
+    session = get_terminal_session(session_id)
+    if session is None:
+        return jsonify({
+            "status": "error",
+            "message": f"Unknown terminal session: {session_id}"
+        }), 404
+
+    try:
+        cols, rows = parse_terminal_size(request.get_json(silent=True) or {}, session.cols, session.rows)
+        session.resize(cols, rows)
+    except (ValueError, TypeError, OSError) as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Invalid parameters: {str(e)}"
+        }), 400
+
+    return jsonify({
+        "status": "success",
+        "message": f"Terminal resized to {cols}x{rows}"
+    }), 200
+
+
+@app.route('/terminal_sessions/<session_id>', methods=['DELETE'])
+def delete_terminal_session(session_id):
+    """Hang up a session's shell and close it"""
+    session = get_terminal_session(session_id)
+    if session is None:
+        return jsonify({
+            "status": "error",
+            "message": f"Unknown terminal session: {session_id}"
+        }), 404
+
+    run_on_io_loop(close_terminal_session(session)).result()
+    return jsonify({
+        "status": "success",
+        "message": f"Terminal session {session_id} closed"
+    }), 200
+
+
+@app.route('/events', methods=['GET'])
+def events():
+    """Stream QEMU logs, terminal output and VM status as Server-Sent Events
+
+    New subscribers only receive events published after they connect.
+    Clients resume after a reconnect with the Last-Event-ID header (sent
+    automatically by EventSource) or the last_event_id query parameter.
+    The types parameter limits the stream to a comma-separated list of
+    event types (qemu_log, terminal, vm_status), and vm_id limits VM events
+    to a single guest.
+    """
+    try:
+        last_id, is_wanted, vm_filter = parse_event_filters(request.args, request.headers.get('Last-Event-ID'))
+    except ValueError:
+        return jsonify({
+            "status": "error",
+            "message": "Invalid last event id"
+        }), 400
+
+    def generate():
+        # New subscribers start at the current end of the backlog
+        cursor = last_id or EVENT_BUFFER.last_seq()
+
+        yield stream_preamble(is_wanted, vm_filter)
+        while True:
+            EVENT_BUFFER.wait(cursor, STREAM_HEARTBEAT_SECONDS)
+            text, cursor = collect_events(cursor, is_wanted)
+            yield text
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers=SSE_HEADERS
+    )
+
+
+@app.route('/vm_metrics', methods=['GET'])
+def vm_metrics():
+    """Get downsampled performance metrics for a VM
+
+    window is the number of seconds of history to return and points the
+    maximum number of values per series. Sampling only runs while clients
+    keep reading this endpoint, so the first call after a quiet period may
+    return little or no data.
+    """
+    try:
+        vm_id = parse_vm_id(request.args.get('vm_id'))
+        window = float(request.args.get('window', 300))
+        points = min(int(request.args.get('points', 60)), METRICS_MAX_POINTS)
+        if window <= 0 or points < 1:
+            raise ValueError("window must be > 0 and points must be >= 1")
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Invalid parameters: {str(e)}"
+        }), 400
+
+    vm = get_vm(vm_id)
+    if vm is None:
+        return jsonify({
+            "status": "error",
+            "message": f"Unknown VM: {vm_id}"
+        }), 404
+
+    touch_metrics_sampler()
+
+    cutoff = time.time() - window
+    entries, _, _ = vm.metrics.read(0)
+    samples = [sample for _, sample in entries if sample["t"] >= cutoff]
+
+    return jsonify({
+        "vm_id": vm_id,
+        "state": vm.state,
+        "interval": METRICS_SAMPLE_INTERVAL_SECONDS,
+        "window": window,
+        "samples": len(samples),
+        "series": downsample(samples, points)
+    }), 200
 
-        QEMU_RUNNING = True
-        print(f"QEMU started with PID: {QEMU_PROCESS.pid}")
 
-        # Start output readers
-        stdout_thread = threading.Thread(
-            target=enqueue_output,
-            args=(QEMU_PROCESS.stdout, QEMU_OUTPUT_QUEUE),
-            daemon=True
-        )
-        stderr_thread = threading.Thread(
-            target=enqueue_output,
-            args=(QEMU_PROCESS.stderr, QEMU_OUTPUT_QUEUE),
-            daemon=True
-        )
+@app.route('/noVNC/')
+def novnc_index():
+    """Serve noVNC viewer page"""
+    return """
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>Project Phoenix VNC</title>
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    </head>
+    <body>
+        <h1>VNC Viewer</h1>
+        <p>Configure your VNC client to connect to this server on port 5900</p>
+        <p>When the server runs with --asgi, noVNC and other WebSocket clients can
+        connect through this port at /websockify?vm_id=default</p>
+    </body>
+    </html>
+    """, 200
 
-        stdout_thread.start()
-        stderr_thread.start()
 
-        # Wait for process to complete
-        QEMU_PROCESS.wait()
+@app.route('/vnc_connections', methods=['GET'])
+def vnc_connections():
+    """List open WebSocket-to-VNC proxy connections and lifetime totals"""
+    with VNC_CONNECTIONS_LOCK:
+        connections = [conn.status() for conn in VNC_CONNECTIONS.values()]
+        totals = dict(VNC_TOTALS)
 
-    except FileNotFoundError:
-        error_msg = "QEMU executable not found. Please install QEMU."
-        print(f"ERROR: {error_msg}")
-        QEMU_OUTPUT_QUEUE.put(error_msg)
-    except Exception as e:
-        error_msg = f"Failed to start QEMU: {str(e)}"
-        print(f"ERROR: {error_msg}")
-        QEMU_OUTPUT_QUEUE.put(error_msg)
-    finally:
-        QEMU_RUNNING = False
-        QEMU_PROCESS = None
-        print("QEMU process terminated")
+    return jsonify({
+        "connections": connections,
+        "totals": totals
+    }), 200
 
 
-def run_terminal_command_thread(command):
-    """Execute terminal command in background thread"""
-    TERMINAL_OUTPUT_QUEUE.put(f"$ {command}")
+@app.route(VNC_PROXY_PATH, methods=['GET'])
+def websockify():
+    """The VNC proxy needs WebSocket support, which only --asgi mode has"""
+    return jsonify({
+        "status": "error",
+        "message": "The WebSocket VNC proxy requires the server to run with --asgi"
+    }), 426
 
-    print(f"Executing: {command}")
 
-    try:
-        process = subprocess.Popen(
-            command,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1
-        )
+@app.route('/health', methods=['GET'])
+def health():
+    """Health check endpoint"""
+    return jsonify({
+        "status": "ok",
+        "vm_running": any_vm_running()
+    }), 200
 
-        for line in iter(process.stdout.readline, ''):
-            if line:
-                TERMINAL_OUTPUT_QUEUE.put(line.strip())
 
-        process.wait()
-        TERMINAL_OUTPUT_QUEUE.put(f"[Command finished with exit code {process.returncode}]")
-        print(f"Command finished: exit code {process.returncode}")
+def metrics_exposition():
+    """Render every control-plane metric in Prometheus text format"""
+    lines = []
 
-    except Exception as e:
-        error_msg = f"ERROR: Command execution failed: {str(e)}"
-        TERMINAL_OUTPUT_QUEUE.put(error_msg)
-        print(error_msg)
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{prom_labels(labels)} {value}")
 
+    with SERVER_METRICS_LOCK:
+        lines.append("# HELP phoenix_http_request_duration_seconds Time spent handling HTTP requests")
+        lines.append("# TYPE phoenix_http_request_duration_seconds histogram")
+        for (method, route), histogram in sorted(REQUEST_LATENCY.items()):
+            lines.extend(histogram.exposition("phoenix_http_request_duration_seconds", {"method": method, "route": route}))
+        metric("phoenix_http_requests_total", "counter", "HTTP requests by route and status",
+               [({"method": m, "route": r, "status": st}, n) for (m, r, st), n in sorted(REQUEST_COUNT.items())])
+        metric("phoenix_http_requests_in_flight", "gauge", "HTTP requests currently being handled",
+               [({"route": r}, n) for r, n in sorted(REQUESTS_IN_FLIGHT.items()) if n])
 
-# API Routes
+        for name, histogram, help_text in (
+                ("phoenix_vm_start_seconds", VM_START_SECONDS, "Time from launching QEMU until the guest was ready"),
+                ("phoenix_vm_stop_seconds", VM_STOP_SECONDS, "Time from a stop request until QEMU exited")):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            lines.extend(histogram.exposition(name))
+        lines.append("# HELP phoenix_start_vm_wait_seconds How long /start_vm held the request, by outcome")
+        lines.append("# TYPE phoenix_start_vm_wait_seconds histogram")
+        for result, histogram in sorted(START_VM_WAIT.items()):
+            lines.extend(histogram.exposition("phoenix_start_vm_wait_seconds", {"result": result}))
 
-@app.route('/vm_status', methods=['GET'])
-def vm_status():
-    """Get current VM status"""
-    return jsonify({
-        "running": QEMU_RUNNING
-    }), 200
+    with VM_LOCK:
+        vms = list(VMS.values())
+    states = collections.Counter(vm.state for vm in vms)
+    metric("phoenix_vms", "gauge", "Registered VMs by state", [({"state": st}, n) for st, n in sorted(states.items())])
+    metric("phoenix_qemu_processes", "gauge", "Live QEMU processes", [({}, sum(1 for vm in vms if vm.process))])
+    network_bytes = []
+    for vm in vms:
+        counters = network_counters(vm) if vm.active else None
+        if counters is not None:
+            network_bytes += [({"vm_id": vm.vm_id, "direction": "rx"}, counters["rx_bytes"]),
+                              ({"vm_id": vm.vm_id, "direction": "tx"}, counters["tx_bytes"])]
+    metric("phoenix_vm_network_bytes_total", "counter", "Guest NIC bytes seen on the host (tap networking only)",
+           network_bytes)
 
+    buffers = [({"buffer": "qemu", "vm_id": vm.vm_id}, len(vm.log_buffer)) for vm in vms]
+    buffers += [({"buffer": "terminal"}, len(TERMINAL_LOG_BUFFER)), ({"buffer": "events"}, len(EVENT_BUFFER))]
+    metric("phoenix_log_buffer_entries", "gauge", "Entries held in the in-memory log buffers", buffers)
+    metric("phoenix_log_store_pending_records", "gauge", "Log lines queued for the on-disk store",
+           [({}, LOG_STORE.pending_count())])
+    metric("phoenix_log_store_dropped_records_total", "counter", "Log lines dropped because the store was full or unavailable",
+           [({}, LOG_STORE.dropped)])
 
-@app.route('/start_vm', methods=['POST'])
-def start_vm():
-    """Start QEMU VM with provided configuration"""
-    global QEMU_PROCESS, QEMU_RUNNING
+    with JOBS_LOCK:
+        job_states = collections.Counter(job.state for job in JOBS.values())
+    metric("phoenix_terminal_jobs", "gauge", "Terminal jobs by state",
+           [({"state": st}, job_states.get(st, 0)) for st in ("queued", "running")])
+    with IMAGE_JOBS_LOCK:
+        image_job_states = collections.Counter(job.state for job in IMAGE_JOBS.values())
+    metric("phoenix_image_jobs", "gauge", "qemu-img maintenance jobs by state",
+           [({"state": st}, image_job_states.get(st, 0)) for st in ("queued", "running")])
+    with PTY_SESSIONS_LOCK:
+        sessions = sum(1 for session in PTY_SESSIONS.values() if not session.closed)
+    metric("phoenix_terminal_sessions", "gauge", "Open PTY terminal sessions", [({}, sessions)])
+    with VNC_CONNECTIONS_LOCK:
+        vnc_connections = len(VNC_CONNECTIONS)
+    metric("phoenix_vnc_connections", "gauge", "Open VNC WebSocket proxy connections", [({}, vnc_connections)])
 
-    if QEMU_RUNNING:
-        return jsonify({
-            "status": "info",
-            "message": "VM is already running"
-        }), 200
+    process = psutil.Process()
+    cpu = process.cpu_times()
+    metric("phoenix_threads", "gauge", "Python threads in the server", [({}, threading.active_count())])
+    metric("process_threads", "gauge", "OS threads in the server process", [({}, process.num_threads())])
+    metric("process_resident_memory_bytes", "gauge", "Resident memory of the server process", [({}, process.memory_info().rss)])
+    metric("process_cpu_seconds_total", "counter", "CPU time used by the server process", [({}, round(cpu.user + cpu.system, 3))])
+    return "\n".join(lines) + "\n"
 
-    data = request.get_json()
 
-    # Extract parameters
-    try:
-        ram_mb = int(data.get('ram_mb', DEFAULT_RAM_MB))
-        cores = int(data.get('cores', DEFAULT_CORES))
-        cpu_model = str(data.get('cpu_model', DEFAULT_CPU_MODEL))
-        boot_order = str(data.get('boot_order', DEFAULT_BOOT_ORDER))
-        vga_model = str(data.get('vga_model', DEFAULT_VGA_MODEL))
-        net_device = str(data.get('net_device', DEFAULT_NET_DEVICE))
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Control-plane metrics in Prometheus text format"""
+    return Response(metrics_exposition(), mimetype='text/plain; version=0.0.4')
 
-        primary_disk_path = str(data.get('primary_disk_path', DEFAULT_PRIMARY_DISK_PATH)).strip()
-        cdrom_path = str(data.get('cdrom_path', DEFAULT_CDROM_PATH)).strip()
-        data_disk_path = str(data.get('data_disk_path', DEFAULT_DATA_DISK_PATH)).strip()
 
+@app.route('/metrics/profiler', methods=['POST'])
+def toggle_profiler():
+    """Start or stop the sampling profiler ({"enabled": bool, "interval": seconds})"""
+    global PROFILER
+
+    data = request.get_json(silent=True) or {}
+    try:
+        enabled = bool(data.get('enabled', True))
+        interval = float(data.get('interval', PROFILER_INTERVAL_SECONDS))
+        if not (0.001 <= interval <= 1):
+            raise ValueError("interval must be between 0.001 and 1 seconds")
     except (ValueError, TypeError) as e:
         return jsonify({
             "status": "error",
             "message": f"Invalid parameters: {str(e)}"
         }), 400
 
-    # Validate parameters
-    if not (512 <= ram_mb <= 32768):
-        return jsonify({
-            "status": "error",
-            "message": "RAM must be between 512 MB and 32768 MB"
-        }), 400
+    if PROFILER is not None and PROFILER.running:
+        PROFILER.stop()
+    if enabled:
+        PROFILER = SamplingProfiler(interval)
+        PROFILER.start()
 
-    if not (1 <= cores <= 12):
-        return jsonify({
-            "status": "error",
-            "message": "CPU cores must be between 1 and 12"
-        }), 400
+    return jsonify({
+        "status": "success",
+        "message": f"Profiler {'started' if enabled else 'stopped'}",
+        "samples": PROFILER.samples if PROFILER else 0
+    }), 200
 
-    if not re.fullmatch(r'[a-zA-Z0-9_-]+', cpu_model):
-        return jsonify({
-            "status": "error",
-            "message": "Invalid CPU model format"
-        }), 400
 
-    if boot_order not in ['c', 'd', 'n', 'cd', 'dc', 'ncd', 'dnc']:
+@app.route('/metrics/profiler', methods=['GET'])
+def get_profile():
+    """The profiler's stacks in folded format for flamegraph tools"""
+    if PROFILER is None:
         return jsonify({
-            "status": "error",
-            "message": "Invalid boot order"
-        }), 400
+            "status": "info",
+            "message": "Profiler has not been started. POST /metrics/profiler to start it."
+        }), 200
 
-    if vga_model not in ['std', 'qxl', 'virtio', 'vmware', 'cirrus']:
+    try:
+        top = int(request.args['top']) if request.args.get('top') else None
+    except ValueError:
         return jsonify({
             "status": "error",
-            "message": "Invalid VGA model"
+            "message": "top must be a number"
         }), 400
 
-    if net_device not in ['virtio-net-pci', 'e1000', 'rtl8139']:
-        return jsonify({
-            "status": "error",
-            "message": "Invalid network device"
-        }), 400
+    return Response(PROFILER.folded(top), mimetype='text/plain', headers={
+        "X-Profiler-Samples": str(PROFILER.samples),
+        "X-Profiler-Running": str(PROFILER.running).lower()
+    })
 
-    if not primary_disk_path:
-        return jsonify({
-            "status": "error",
-            "message": "Primary disk path is required"
-        }), 400
 
-    if not os.path.exists(primary_disk_path):
-        return jsonify({
-            "status": "error",
-            "message": f"Primary disk not found: {primary_disk_path}"
-        }), 400
+# ============================================================
+# ASGI mode
+# ============================================================
+# The routes below can wait for a long time (VM start, stop, event streams),
+# so --asgi serves them as coroutines on IO_LOOP. Every other route is the
+# unchanged Flask view, run through asgiref's WSGI adapter.
 
-    if cdrom_path and not os.path.exists(cdrom_path):
-        return jsonify({
-            "status": "error",
-            "message": f"CD-ROM ISO not found: {cdrom_path}"
-        }), 400
+ASGI_ROUTES = {}
 
-    if data_disk_path and not os.path.exists(data_disk_path):
-        return jsonify({
-            "status": "error",
-            "message": f"Data disk not found: {data_disk_path}"
-        }), 400
 
-    # Build QEMU command
-    qemu_cmd = [
-        "qemu-system-x86_64",
-        "-accel tcg,thread=multi",
-        f"-smp {cores}",
-        f"-m {ram_mb}",
-        f"-cpu {cpu_model}",
-        f"-boot order={boot_order}",
-        f"-vga {vga_model}",
-        "-netdev user,id=net0",
-        f"-device {net_device},netdev=net0",
-        f"-drive file={primary_disk_path},if=virtio,cache=writeback,format=qcow2",
-        "-vnc :0"
+def asgi_route(method, path):
+    """Register a native coroutine handler for --asgi mode
+
+    A path ending in /* matches any single path segment in its place.
+    """
+    def decorator(handler):
+        ASGI_ROUTES[(method, path)] = handler
+        return handler
+    return decorator
+
+
+async def asgi_send(send, status_code, body, content_type="application/json", headers=None, more_body=False):
+    """Start an ASGI HTTP response with the same CORS header Flask-CORS adds"""
+    raw_headers = [
+        (b"content-type", content_type.encode()),
+        (b"access-control-allow-origin", b"*")
     ]
+    for name, value in (headers or {}).items():
+        raw_headers.append((name.lower().encode(), value.encode()))
 
-    if cdrom_path:
-        qemu_cmd.append(f"-cdrom {cdrom_path}")
+    await send({"type": "http.response.start", "status": status_code, "headers": raw_headers})
+    if isinstance(body, str):
+        body = body.encode()
+    await send({"type": "http.response.body", "body": body, "more_body": more_body})
 
-    if data_disk_path:
-        qemu_cmd.append(f"-drive file={data_disk_path},if=virtio,cache=writeback,format=qcow2")
 
-    command = " ".join(qemu_cmd)
+async def asgi_send_json(send, payload, status_code):
+    await asgi_send(send, status_code, json.dumps(payload))
 
-    # Clear previous logs
-    while not QEMU_OUTPUT_QUEUE.empty():
-        try:
-            QEMU_OUTPUT_QUEUE.get_nowait()
-        except queue.Empty:
+
+async def asgi_read_json(receive):
+    """Read the full request body and decode it as JSON"""
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ApiError("Client disconnected")
+        body += message.get("body", b"")
+        if not message.get("more_body"):
             break
 
-    # Start QEMU in thread
-    thread = threading.Thread(target=run_qemu_thread, args=(command,), daemon=True)
-    thread.start()
+    if not body:
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        raise ApiError("Invalid JSON body")
 
-    # Wait a moment to check if it started
-    time.sleep(2)
 
-    if QEMU_RUNNING:
-        return jsonify({
-            "status": "success",
-            "message": "VM started successfully"
-        }), 200
-    else:
-        return jsonify({
-            "status": "error",
-            "message": "VM failed to start. Check logs for details."
-        }), 500
+@asgi_route('POST', '/start_vm')
+async def asgi_start_vm(scope, receive, send):
+    try:
+        data = apply_pool_profile(await asgi_read_json(receive))
 
+        vm = claim_pooled_vm(data)
+        if vm is not None:
+            started = time.monotonic()
+            await asyncio.get_running_loop().run_in_executor(None, resume_pooled_vm, vm)
+            payload, status_code = start_vm_result(vm, time.monotonic() - started)
+            payload["profile"] = data['profile']
+            await asgi_send_json(send, payload, status_code)
+            return
 
-@app.route('/stop_vm', methods=['POST'])
-def stop_vm():
-    """Stop running QEMU VM"""
-    global QEMU_PROCESS, QEMU_RUNNING
+        vm, command, start_timeout = prepare_vm_start(data)
+    except ApiError as e:
+        await asgi_send_json(send, e.payload(), e.status_code)
+        return
 
-    if not QEMU_RUNNING or QEMU_PROCESS is None:
-        return jsonify({
-            "status": "info",
-            "message": "VM is not running"
-        }), 200
+    asyncio.ensure_future(supervise_qemu(vm, command))
 
-    try:
-        print("Stopping QEMU process...")
-        QEMU_PROCESS.terminate()
+    started = time.monotonic()
+    await wait_until_async(lambda: vm.state != "starting", start_timeout)
 
-        try:
-            QEMU_PROCESS.wait(timeout=5)
-        except subprocess.TimeoutExpired:
-            print("QEMU didn't stop gracefully, killing...")
-            QEMU_PROCESS.kill()
-            QEMU_PROCESS.wait()
+    payload, status_code = start_vm_result(vm, time.monotonic() - started)
+    await asgi_send_json(send, payload, status_code)
 
-        QEMU_RUNNING = False
-        QEMU_PROCESS = None
 
-        return jsonify({
-            "status": "success",
-            "message": "VM stopped successfully"
-        }), 200
+@asgi_route('POST', '/stop_vm')
+async def asgi_stop_vm(scope, receive, send):
+    try:
+        vm, process = prepare_vm_stop(await asgi_read_json(receive))
+    except ValueError as e:
+        await asgi_send_json(send, {"status": "error", "message": str(e)}, 400)
+        return
+    except ApiError as e:
+        await asgi_send_json(send, e.payload(), e.status_code)
+        return
 
+    try:
+        await stop_process(process)
+        if vm.overlay is None:
+            finish_vm(vm, process)
+        await asgi_send_json(send, {
+            "status": "success",
+            "message": f"VM {vm.vm_id} stopped successfully"
+        }, 200)
     except Exception as e:
-        return jsonify({
+        await asgi_send_json(send, {
             "status": "error",
             "message": f"Failed to stop VM: {str(e)}"
-        }), 500
+        }, 500)
 
 
-@app.route('/get_defaults', methods=['GET'])
-def get_defaults():
-    """Get default configuration values"""
-    return jsonify({
-        "default_primary_disk_path": DEFAULT_PRIMARY_DISK_PATH,
-        "default_cdrom_path": DEFAULT_CDROM_PATH,
-        "default_data_disk_path": DEFAULT_DATA_DISK_PATH,
-        "default_ram_mb": DEFAULT_RAM_MB,
-        "default_cores": DEFAULT_CORES,
-        "default_cpu_model": DEFAULT_CPU_MODEL,
-        "default_boot_order": DEFAULT_BOOT_ORDER,
-        "default_vga_model": DEFAULT_VGA_MODEL,
-        "default_net_device": DEFAULT_NET_DEVICE
-    }), 200
+@asgi_route('POST', '/suspend_vm')
+async def asgi_suspend_vm(scope, receive, send):
+    try:
+        vm, process, name = prepare_vm_suspend(await asgi_read_json(receive))
+        metadata = await suspend_vm_async(vm, process, name)
+    except ValueError as e:
+        await asgi_send_json(send, {"status": "error", "message": str(e)}, 400)
+        return
+    except ApiError as e:
+        await asgi_send_json(send, e.payload(), e.status_code)
+        return
+    except Exception as e:
+        await asgi_send_json(send, {"status": "error", "message": f"Failed to suspend VM: {str(e)}"}, 500)
+        return
 
+    payload, status_code = suspend_vm_result(vm, metadata)
+    await asgi_send_json(send, payload, status_code)
 
-@app.route('/qemu_logs', methods=['GET'])
-def qemu_logs():
-    """Get recent QEMU output logs"""
-    logs = []
 
-    while not QEMU_OUTPUT_QUEUE.empty():
-        try:
-            logs.append(QEMU_OUTPUT_QUEUE.get_nowait())
-        except queue.Empty:
+@asgi_route('GET', '/dashboard')
+async def asgi_dashboard(scope, receive, send):
+    args = dict(urllib.parse.parse_qsl(scope["query_string"].decode()))
+    if_none_match = dict(scope["headers"]).get(b"if-none-match", b"").decode() or None
+
+    try:
+        vm_id, sections, cursors, wait = parse_dashboard_args(args)
+    except ValueError as e:
+        await asgi_send_json(send, {"status": "error", "message": f"Invalid parameters: {str(e)}"}, 400)
+        return
+
+    deadline = time.monotonic() + wait
+    while True:
+        event_cursor = EVENT_BUFFER.last_seq()
+        payload, etag = build_dashboard(vm_id, sections, cursors)
+        unchanged = dashboard_unchanged(payload, etag, if_none_match)
+        remaining = deadline - time.monotonic()
+        if not unchanged or remaining <= 0:
             break
+        await EVENT_BUFFER.wait_async(event_cursor, dashboard_poll_interval(sections, remaining))
 
-    if not logs:
-        logs = ["No recent logs available"]
+    headers = dict(DASHBOARD_HEADERS, ETag=etag)
+    if unchanged:
+        await asgi_send(send, 304, "", headers=headers)
+    else:
+        await asgi_send(send, 200, json.dumps(payload), headers=headers)
 
-    return jsonify({
-        "logs": logs
-    }), 200
 
+@asgi_route('GET', '/events')
+async def asgi_events(scope, receive, send):
+    args = dict(urllib.parse.parse_qsl(scope["query_string"].decode()))
+    headers = dict(scope["headers"])
+    last_event_id = headers.get(b"last-event-id", b"").decode()
 
-@app.route('/run_terminal_command', methods=['POST'])
-def run_terminal_command():
-    """Execute a terminal command"""
-    data = request.get_json()
-    command = data.get('command', '').strip()
+    try:
+        last_id, is_wanted, vm_filter = parse_event_filters(args, last_event_id)
+    except ValueError:
+        await asgi_send_json(send, {"status": "error", "message": "Invalid last event id"}, 400)
+        return
 
-    if not command:
-        return jsonify({
-            "status": "error",
-            "message": "No command provided"
-        }), 400
+    async def wait_for_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
 
-    # Start command execution in thread
-    thread = threading.Thread(target=run_terminal_command_thread, args=(command,), daemon=True)
-    thread.start()
+    disconnected = asyncio.ensure_future(wait_for_disconnect())
+    cursor = last_id or EVENT_BUFFER.last_seq()
 
-    return jsonify({
-        "status": "processing",
-        "message": "Command sent to terminal"
-    }), 202
+    try:
+        await asgi_send(send, 200, stream_preamble(is_wanted, vm_filter),
+                        content_type="text/event-stream", headers=SSE_HEADERS, more_body=True)
 
+        while not disconnected.done():
+            waiter = asyncio.ensure_future(EVENT_BUFFER.wait_async(cursor, STREAM_HEARTBEAT_SECONDS))
+            await asyncio.wait([waiter, disconnected], return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                waiter.cancel()
+                break
+
+            text, cursor = collect_events(cursor, is_wanted)
+            await send({"type": "http.response.body", "body": text.encode(), "more_body": True})
+    finally:
+        disconnected.cancel()
+
+
+async def pump_vnc_to_client(reader, send, conn):
+    """Forward VNC server output to the WebSocket client
+
+    Each read is sent as one binary message without copying. The await on
+    send() holds off further reads while the client is slow.
+    """
+    while True:
+        data = await reader.read(VNC_PROXY_CHUNK_SIZE)
+        if not data:
+            return
+        await send({"type": "websocket.send", "bytes": data})
+        conn.bytes_to_client += len(data)
+        conn.frames_to_client += 1
+
+
+async def pump_client_to_vnc(receive, writer, conn):
+    """Forward WebSocket client messages to the VNC server
+
+    drain() only blocks once the transport buffer passes
+    VNC_PROXY_WRITE_HIGH_WATER, so small input events are not delayed.
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
+        data = message.get("bytes")
+        if data is None:
+            data = (message.get("text") or "").encode()
+        writer.write(data)
+        await writer.drain()
+        conn.bytes_to_vnc += len(data)
+        conn.frames_to_vnc += 1
+
+
+@asgi_route('PUT', '/images/*')
+async def asgi_upload_image(scope, receive, send):
+    # asgiref's WSGI adapter spools the whole body to a temporary file before
+    # the Flask view runs, so uploads are streamed natively instead
+    loop = asyncio.get_running_loop()
+    name = urllib.parse.unquote(scope["path"].rsplit("/", 1)[1])
+    headers = {key.decode("latin-1").title(): value.decode("latin-1") for key, value in scope["headers"]}
+    args = urllib.parse.parse_qs(scope.get("query_string", b"").decode())
+    try:
+        upload, start, length, zero_range, chunk_sha256 = parse_image_chunk(
+            name, headers, {key: values[-1] for key, values in args.items()})
+        digest = hashlib.sha256() if chunk_sha256 else None
+        received = 0
+        pending = bytearray()
+        more_body = not zero_range
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            pending += message.get("body", b"")
+            more_body = message.get("more_body", False)
+            # Write in whole blocks so zero detection sees aligned blocks
+            while len(pending) >= IMAGE_TRANSFER_BLOCK_BYTES or (pending and not more_body):
+                block = bytes(pending[:IMAGE_TRANSFER_BLOCK_BYTES])
+                del pending[:IMAGE_TRANSFER_BLOCK_BYTES]
+                if received + len(block) > length:
+                    raise ApiError("Body is longer than the Content-Range")
+                await loop.run_in_executor(None, upload.write, start + received, block)
+                if digest:
+                    digest.update(block)
+                received += len(block)
+        if zero_range:
+            received = length
+        image = await loop.run_in_executor(
+            None, upload.finish_chunk, start, length, received, digest and digest.hexdigest(), chunk_sha256)
+    except ApiError as e:
+        await asgi_send_json(send, e.payload(), e.status_code)
+        return
+    except OSError as e:
+        await asgi_send_json(send, {"status": "error", "message": f"Failed to write image: {e}"}, 500)
+        return
+
+    payload, status_code = image_upload_response(upload, image)
+    await asgi_send_json(send, payload, status_code)
 
-@app.route('/get_terminal_output', methods=['GET'])
-def get_terminal_output():
-    """Get terminal command output"""
-    output_lines = []
 
-    while not TERMINAL_OUTPUT_QUEUE.empty():
+@asgi_route('GET', '/images/*')
+async def asgi_download_image(scope, receive, send):
+    # Werkzeug's FileWrapper reads 8 KB at a time through the WSGI adapter,
+    # so downloads are read in IMAGE_TRANSFER_BLOCK_BYTES blocks natively
+    loop = asyncio.get_running_loop()
+    name = urllib.parse.unquote(scope["path"].rsplit("/", 1)[1])
+    headers = {key.decode("latin-1").title(): value.decode("latin-1") for key, value in scope["headers"]}
+    try:
+        path = find_image(name)
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    except ApiError as e:
+        await asgi_send_json(send, e.payload(), e.status_code)
+        return
+    except OSError as e:
+        await asgi_send_json(send, {"status": "error", "message": f"Failed to open image: {e}"}, 500)
+        return
+
+    async def wait_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    disconnected = asyncio.ensure_future(wait_disconnect())
+    try:
+        st = os.fstat(fd)
+        response_headers = image_download_headers(name, st)
+        etag = response_headers["ETag"]
+        if headers.get("If-None-Match") in (etag, "*"):
+            await asgi_send(send, 304, b"", "application/octet-stream", response_headers)
+            return
+
+        start, end = 0, st.st_size
+        status_code = 200
+        if_range = headers.get("If-Range")
+        if "Range" in headers and if_range in (None, etag, response_headers["Last-Modified"]):
+            ranges = parse_range_header(headers["Range"])
+            byte_range = ranges.range_for_length(st.st_size) if ranges else None
+            if byte_range is None:
+                response_headers["Content-Range"] = f"bytes */{st.st_size}"
+                await asgi_send(send, 416, b"", "application/octet-stream", response_headers)
+                return
+            start, end = byte_range
+            status_code = 206
+            response_headers["Content-Range"] = f"bytes {start}-{end - 1}/{st.st_size}"
+        response_headers["Content-Length"] = str(end - start)
+
+        await asgi_send(send, status_code, b"", "application/octet-stream", response_headers, more_body=True)
+        position = start
+        while position < end and not disconnected.done():
+            block = await loop.run_in_executor(
+                None, os.pread, fd, min(IMAGE_TRANSFER_BLOCK_BYTES, end - position), position)
+            if not block: # truncated while being sent
+                break
+            position += len(block)
+            await send({"type": "http.response.body", "body": block, "more_body": position < end})
+        if position < end and not disconnected.done():
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+    finally:
+        disconnected.cancel()
+        os.close(fd)
+
+
+@asgi_route('WEBSOCKET', VNC_PROXY_PATH)
+async def asgi_vnc_proxy(scope, receive, send):
+    """Bridge a WebSocket client (e.g. noVNC) to a VM's VNC server"""
+    args = dict(urllib.parse.parse_qsl(scope["query_string"].decode()))
+
+    if (await receive())["type"] != "websocket.connect":
+        return
+
+    try:
+        vm = get_vm(parse_vm_id(args.get('vm_id')))
+    except ValueError:
+        vm = None
+    if vm is None or not vm.running:
+        await send({"type": "websocket.close", "code": 1008})
+        return
+
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(VNC_PROXY_HOST, vm.vnc_port),
+            VNC_PROXY_CONNECT_TIMEOUT_SECONDS
+        )
+    except (OSError, asyncio.TimeoutError) as e:
+        print(f"VNC proxy [{vm.vm_id}]: cannot reach port {vm.vnc_port}: {e}")
+        await send({"type": "websocket.close", "code": 1011})
+        return
+
+    writer.transport.set_write_buffer_limits(high=VNC_PROXY_WRITE_HIGH_WATER)
+
+    # noVNC asks for the "binary" subprotocol; websockify accepts it too
+    accept = {"type": "websocket.accept"}
+    if "binary" in scope.get("subprotocols", []):
+        accept["subprotocol"] = "binary"
+    await send(accept)
+
+    client = scope.get("client")
+    conn = VNCProxyConnection(vm.vm_id, f"{client[0]}:{client[1]}" if client else None)
+    with VNC_CONNECTIONS_LOCK:
+        VNC_CONNECTIONS[conn.conn_id] = conn
+        VNC_TOTALS["connections"] += 1
+    print(f"VNC proxy [{vm.vm_id}]: connection {conn.conn_id} opened from {conn.client}")
+
+    pumps = [
+        asyncio.ensure_future(pump_vnc_to_client(reader, send, conn)),
+        asyncio.ensure_future(pump_client_to_vnc(receive, writer, conn))
+    ]
+    try:
+        done, pending = await asyncio.wait(pumps, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if task.exception() is not None:
+                print(f"VNC proxy [{vm.vm_id}]: connection {conn.conn_id} error: {task.exception()}")
+    finally:
+        writer.close()
         try:
-            line = TERMINAL_OUTPUT_QUEUE.get_nowait()
+            await send({"type": "websocket.close", "code": 1000})
+        except Exception:
+            # The client has already gone
+            pass
 
-            # Determine line type
-            line_type = 'info'
-            if line.startswith('$ '):
-                line_type = 'command'
-            elif line.startswith('[Command finished'):
-                line_type = 'status'
-            elif line.startswith('ERROR'):
-                line_type = 'error'
+        with VNC_CONNECTIONS_LOCK:
+            VNC_CONNECTIONS.pop(conn.conn_id, None)
+            for key in ("bytes_to_vnc", "bytes_to_client", "frames_to_vnc", "frames_to_client"):
+                VNC_TOTALS[key] += getattr(conn, key)
+        print(f"VNC proxy [{vm.vm_id}]: connection {conn.conn_id} closed "
+              f"({conn.bytes_to_client} bytes out, {conn.bytes_to_vnc} bytes in)")
 
-            output_lines.append({
-                "message": line,
-                "type": line_type
-            })
-        except queue.Empty:
-            break
 
-    return jsonify({
-        "output": output_lines
-    }), 200
+async def timed_asgi_handler(handler, route, scope, receive, send):
+    """Run a native ASGI route with the same metrics as the Flask hooks"""
+    status = 500
 
+    async def send_with_status(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        await send(message)
 
-@app.route('/noVNC/')
-def novnc_index():
-    """Serve noVNC viewer page"""
-    return """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Project Phoenix VNC</title>
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    </head>
-    <body>
-        <h1>VNC Viewer</h1>
-        <p>Configure your VNC client to connect to this server on port 5900</p>
-    </body>
-    </html>
-    """, 200
+    started = request_started(route)
+    try:
+        await handler(scope, receive, send_with_status)
+    finally:
+        request_finished(scope["method"], route, status, started)
 
 
-@app.route('/health', methods=['GET'])
-def health():
-    """Health check endpoint"""
-    return jsonify({
-        "status": "ok",
-        "vm_running": QEMU_RUNNING
-    }), 200
+def create_asgi_app():
+    """Build the ASGI application used by --asgi mode"""
+    from asgiref.wsgi import WsgiToAsgi
+
+    wsgi_app = WsgiToAsgi(app)
+
+    async def asgi_app(scope, receive, send):
+        if scope["type"] == "http":
+            route = scope["path"]
+            handler = ASGI_ROUTES.get((scope["method"], route))
+            if handler is None:
+                route = route.rsplit("/", 1)[0] + "/*"
+                handler = ASGI_ROUTES.get((scope["method"], route))
+            if handler is not None:
+                await timed_asgi_handler(handler, route, scope, receive, send)
+                return
+        elif scope["type"] == "websocket":
+            handler = ASGI_ROUTES.get(("WEBSOCKET", scope["path"]))
+            if handler is not None:
+                await handler(scope, receive, send)
+            else:
+                await receive()
+                await send({"type": "websocket.close", "code": 1008})
+            return
+        await wsgi_app(scope, receive, send)
+
+    return asgi_app
+
+
+def run_asgi_server(certfile=None, keyfile=None):
+    """Serve the API with uvicorn on IO_LOOP"""
+    try:
+        import uvicorn
+        import asgiref  # noqa: F401
+    except ImportError:
+        print("ERROR: --asgi requires uvicorn and asgiref")
+        print("  pip install uvicorn asgiref")
+        sys.exit(1)
+
+    ws_protocol = "websockets"
+    try:
+        import websockets  # noqa: F401
+    except ImportError:
+        ws_protocol = "none"
+        print(f"WARNING: websockets is not installed, {VNC_PROXY_PATH} (VNC over WebSocket) is disabled")
+        print("  pip install websockets")
+
+    config = uvicorn.Config(
+        create_asgi_app(),
+        host='0.0.0.0',
+        port=5000,
+        lifespan="off",
+        ws=ws_protocol,
+        ws_per_message_deflate=VNC_PROXY_DEFLATE,
+        ssl_certfile=certfile,
+        ssl_keyfile=keyfile
+    )
+
+    async def serve():
+        start_background_tasks()
+        await uvicorn.Server(config).serve()
+
+    asyncio.set_event_loop(IO_LOOP)
+    IO_LOOP.run_until_complete(serve())
 
 
 if __name__ == '__main__':
@@ -436,6 +7222,23 @@ if __name__ == '__main__':
     print("Project Phoenix Backend Server")
     print("=" * 60)
 
+    use_asgi = '--asgi' in sys.argv
+
+    # python backend.py --tcg-benchmark /path/to/disk.qcow2 [cores] [ram_mb]
+    if '--tcg-benchmark' in sys.argv:
+        args = sys.argv[sys.argv.index('--tcg-benchmark') + 1:]
+        try:
+            config = prepare_tcg_benchmark(dict(zip(("primary_disk_path", "cores", "ram_mb"), args)))
+        except ApiError as e:
+            print(f"Error: {e.message}")
+            sys.exit(1)
+        begin_tcg_benchmark(config)
+        report = run_on_io_loop(run_tcg_benchmark(config)).result()
+        for result in report["results"]:
+            print(f"  {result['settings']}: score={result['score']} error={result['error']}")
+        print(f"Best: {json.dumps(report['best'])}")
+        sys.exit(0 if report["state"] == "finished" else 1)
+
     # Check if SSL certificates exist
     cert_path = 'cert.pem'
     key_path = 'key.pem'
@@ -443,19 +7246,29 @@ if __name__ == '__main__':
     if os.path.exists(cert_path) and os.path.exists(key_path):
         print(f"Starting HTTPS server on 0.0.0.0:5000")
         print(f"Certificates found: Using HTTPS")
-        print(f"VM Running: {QEMU_RUNNING}")
+        print(f"Server mode: {'ASGI (uvicorn)' if use_asgi else 'threaded Flask'}")
+        print(f"Max VMs: {MAX_VMS}")
         print("=" * 60)
 
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        ssl_context.load_cert_chain(cert_path, key_path)
+        if use_asgi:
+            run_asgi_server(cert_path, key_path)
+        else:
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ssl_context.load_cert_chain(cert_path, key_path)
 
-        app.run(host='0.0.0.0', port=5000, debug=False, threaded=True, ssl_context=ssl_context)
+            start_background_tasks()
+            app.run(host='0.0.0.0', port=5000, debug=False, threaded=True, ssl_context=ssl_context)
     else:
         print(f"Starting HTTP server on 0.0.0.0:5000")
         print(f"WARNING: No SSL certificates found. Using HTTP.")
         print(f"To enable HTTPS, generate certificates with:")
         print(f"  openssl req -x509 -newkey rsa:4096 -nodes -out cert.pem -keyout key.pem -days 365")
-        print(f"VM Running: {QEMU_RUNNING}")
+        print(f"Server mode: {'ASGI (uvicorn)' if use_asgi else 'threaded Flask'}")
+        print(f"Max VMs: {MAX_VMS}")
         print("=" * 60)
 
-        app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
+        if use_asgi:
+            run_asgi_server()
+        else:
+            start_background_tasks()
+            app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
@@ -2,14 +2,27 @@
 
 import os
 import subprocess
-from flask import Flask, render_template_string, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_file, abort, Response, stream_with_context, g
+from werkzeug.security import safe_join
 from flask_cors import CORS
 import threading
 import time
-import queue
 import re
 import sys
+import json
+import socket
+import tempfile
+import collections
+import hashlib
+import gzip
+import mimetypes
 import psutil
+import bisect
+
+try:
+    import brotli # optional: pip install brotli
+except ImportError:
+    brotli = None
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -27,6 +40,18 @@ DEFAULT_BOOT_ORDER = "c"
 DEFAULT_VGA_MODEL = "virtio"
 DEFAULT_NET_DEVICE = "virtio-net-pci"
 DEFAULT_USB_DEVICES = []
+DEFAULT_VM_ID = "default"
+
+# Host admission control for running several guests at once
+MAX_VMS = 4
+HOST_RAM_RESERVE_MB = 1024
+VCPU_OVERCOMMIT_RATIO = 1.0
+
+# QMP control socket per VM; start_vm waits on it instead of sleeping
+QMP_SOCKET_DIR = os.path.join(tempfile.gettempdir(), "phoenix-qmp")
+QMP_READY_TIMEOUT_SECONDS = 30
+QMP_READY_MAX_SECONDS = 600
+QMP_COMMAND_TIMEOUT_SECONDS = 10
 #DEFAULT_WEBSOCK_IP_1 = "127.0.0.1:5901"
 #DEFAULT_WEBSOCK_IP_2 = "127.0.0.1:5900"
 
@@ -54,58 +79,465 @@ BASE_QEMU_COMMAND_TEMPLATE = (
 
 # --- END QEMU CONFIGURATION ---
 
-# Global variables for QEMU process management
-QEMU_PROCESS = None
-QEMU_RUNNING_STATUS = False
-QEMU_OUTPUT_QUEUE = queue.Queue()
-TERMINAL_OUTPUT_QUEUE = queue.Queue()
+# --- Bounded, cursor-addressable log buffers ---
+QEMU_LOG_CAPACITY = 5000
+TERMINAL_LOG_CAPACITY = 5000
+LOG_READ_LIMIT = 1000
+
+# Fixed-capacity ring of sequence-numbered entries. Reads don't consume anything:
+# every reader passes the last seq it saw and gets only newer entries back, so the
+# web UI and the mobile app no longer steal each other's lines. Seqs start at 1 and
+# are never reused, so an entry lives in slot seq % capacity.
+class LogBuffer:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._entries = [None] * capacity
+        self._next_seq = 1
+        self._first_seq = 1
+        self._cleared_seq = 0
+        self._condition = threading.Condition()
+
+    def append(self, entry):
+        with self._condition:
+            seq = self._next_seq
+            self._entries[seq % self.capacity] = entry
+            self._next_seq += 1
+            if self._next_seq - self._first_seq > self.capacity:
+                self._first_seq += 1 # oldest entry evicted
+            self._condition.notify_all()
+            return seq
+
+    def clear(self): # drops entries, keeps seqs monotonic
+        with self._condition:
+            self._entries = [None] * self.capacity
+            self._first_seq = self._next_seq
+            self._cleared_seq = self._next_seq - 1
+
+    def last_seq(self):
+        with self._condition:
+            return self._next_seq - 1
+
+    def __len__(self):
+        with self._condition:
+            return self._next_seq - self._first_seq
+
+    # Returns ([(seq, entry), ...], next_cursor, overflow). overflow means entries
+    # after `since` were evicted before this reader saw them. A cursor from the
+    # future (server restarted) is treated as a fresh reader.
+    def read(self, since=0, limit=None):
+        with self._condition:
+            if since >= self._next_seq:
+                since = 0
+            start = max(since + 1, self._first_seq)
+            end = self._next_seq if limit is None else min(self._next_seq, start + limit)
+            entries = [(seq, self._entries[seq % self.capacity]) for seq in range(start, end)]
+            overflow = self._first_seq - 1 > max(since, self._cleared_seq)
+            return entries, max(end - 1, since), overflow
+
+    def wait(self, since, timeout):
+        with self._condition:
+            return self._condition.wait_for(lambda: self._next_seq - 1 != since, timeout=timeout)
+
+TERMINAL_LOG_BUFFER = LogBuffer(TERMINAL_LOG_CAPACITY)
+
+def parse_cursor_args():
+    since = int(request.args.get('since', 0))
+    limit = min(int(request.args.get('limit', LOG_READ_LIMIT)), LOG_READ_LIMIT)
+    if since < 0 or limit < 1:
+        raise ValueError("since must be >= 0 and limit must be >= 1")
+    return since, limit
+
+# --- Request timing for /metrics ---
+# Every request is timed by the hooks below; /metrics renders everything in the
+# Prometheus text format. Histograms aren't thread-safe, so observe under the lock.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        index = bisect.bisect_left(LATENCY_BUCKETS, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+
+    def exposition(self, name, labels=""):
+        sep = "," if labels else ""
+        lines, cumulative = [], 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum:.6f}" if labels else f"{name}_sum {self.sum:.6f}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}" if labels else f"{name}_count {self.count}")
+        return lines
+
+METRICS_LOCK = threading.Lock()
+REQUEST_LATENCY = collections.defaultdict(Histogram) # (method, route)
+REQUEST_COUNT = collections.Counter() # (method, route, status)
+REQUESTS_IN_FLIGHT = collections.Counter() # route
+VM_START_SECONDS = Histogram() # QEMU launch until QMP reports running
+VM_STOP_SECONDS = Histogram()
+START_VM_WAIT = collections.defaultdict(Histogram) # /start_vm hold time by result
+
+def observe_metric(histogram, value):
+    with METRICS_LOCK:
+        histogram.observe(value)
+
+@app.before_request
+def start_request_timer():
+    g.metrics_route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.metrics_started = time.perf_counter()
+    with METRICS_LOCK:
+        REQUESTS_IN_FLIGHT[g.metrics_route] += 1
+
+@app.after_request
+def record_response_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+@app.teardown_request # streams (/events) end here when the client disconnects
+def finish_request_timer(error=None):
+    if "metrics_started" not in g:
+        return
+    elapsed = time.perf_counter() - g.metrics_started
+    with METRICS_LOCK:
+        REQUESTS_IN_FLIGHT[g.metrics_route] -= 1
+        REQUEST_LATENCY[(request.method, g.metrics_route)].observe(elapsed)
+        REQUEST_COUNT[(request.method, g.metrics_route, g.get("metrics_status", 500))] += 1
+
+# --- Event stream (/events) state ---
+STREAM_HEARTBEAT_SECONDS = 15
+STREAM_RETRY_MS = 3000
+DASHBOARD_MAX_WAIT_SECONDS = 30
+STREAM_BACKLOG_SIZE = 1000
+EVENT_BUFFER = LogBuffer(STREAM_BACKLOG_SIZE) # (type, data) entries
+
+def publish_event(event_type, data):
+    EVENT_BUFFER.append((event_type, data))
+
+def format_sse(event_type, data, event_id=None):
+    message = f"id: {event_id}\n" if event_id is not None else ""
+    return message + f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+def classify_terminal_line(line_content):
+    if line_content.startswith('$ '): return 'command'
+    elif line_content.startswith('[Command finished'): return 'status'
+    elif line_content.startswith('ERROR') or line_content.startswith('FATAL ERROR'): return 'error'
+    return 'info'
+
+def push_terminal_output(line):
+    TERMINAL_LOG_BUFFER.append(line)
+    line_content = line.strip()
+    publish_event("terminal", {"message": line_content, "type": classify_terminal_line(line_content)})
+
+# --- Minimal QMP client (one UNIX socket per VM) ---
+class QMPError(Exception):
+    pass
+
+# Commands are serialized with a lock so threads can share a connection; async
+# events that arrive while waiting for a reply are kept in self.events.
+class QMPClient:
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+        self.greeting = None
+        self.events = collections.deque(maxlen=100)
+        self._buffer = b""
+        self._lock = threading.Lock()
+
+    def connect(self, timeout=QMP_COMMAND_TIMEOUT_SECONDS):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(self.path)
+            self.greeting = self._read_message()
+            self.execute('qmp_capabilities')
+        except Exception:
+            self.close()
+            raise
+
+    def _read_message(self, allow_timeout=False):
+        # Split lines out of our own buffer: a makefile() reader becomes
+        # unusable after its first socket timeout, which wait_event relies on
+        while b"\n" not in self._buffer:
+            try:
+                chunk = self.sock.recv(65536)
+            except socket.timeout:
+                if allow_timeout:
+                    raise
+                raise QMPError("QMP connection failed: timed out")
+            except OSError as e:
+                raise QMPError(f"QMP connection failed: {e}")
+            if not chunk:
+                raise QMPError("QMP connection closed")
+            self._buffer += chunk
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return json.loads(line)
+
+    def execute(self, command, arguments=None):
+        message = {"execute": command}
+        if arguments:
+            message["arguments"] = arguments
+        with self._lock:
+            if self.sock is None:
+                raise QMPError("QMP is not connected")
+            try:
+                self.sock.sendall(json.dumps(message).encode() + b"\n")
+            except OSError as e:
+                raise QMPError(f"QMP connection failed: {e}")
+            while True:
+                response = self._read_message()
+                if "event" in response:
+                    self.events.append(response)
+                elif "error" in response:
+                    raise QMPError(response["error"].get("desc", "Unknown QMP error"))
+                else:
+                    return response.get("return")
+
+    def wait_event(self, names, timeout):
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                for event in list(self.events):
+                    if event["event"] in names:
+                        self.events.remove(event)
+                        return event
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.sock.settimeout(remaining)
+                try:
+                    self.events.append(self._read_message(allow_timeout=True))
+                except socket.timeout:
+                    return None
+                finally:
+                    self.sock.settimeout(QMP_COMMAND_TIMEOUT_SECONDS)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+# --- VM registry: one entry per guest, keyed by vm_id ---
+# Entries outlive their QEMU process so logs and exit codes stay readable;
+# starting the same vm_id again reuses the entry.
+class VirtualMachine:
+    ACTIVE_STATES = ("starting", "running", "stopping")
+
+    def __init__(self, vm_id):
+        self.vm_id = vm_id
+        self.process = None
+        self.state = "stopped"
+        self.config = {}
+        self.vnc_display = None
+        self.log_buffer = LogBuffer(QEMU_LOG_CAPACITY)
+        self.started_at = None
+        self.exit_code = None
+        self.qmp = None
+        self.ready_event = threading.Event()
+
+    @property
+    def qmp_socket_path(self):
+        return os.path.join(QMP_SOCKET_DIR, f"{self.vm_id}.sock")
+
+    @property
+    def running(self):
+        return self.state == "running"
+
+    @property
+    def active(self):
+        return self.state in self.ACTIVE_STATES
+
+    def set_state(self, state):
+        if self.state != state:
+            self.state = state
+            publish_event("vm_status", self.status())
+
+    def push_output(self, line):
+        self.log_buffer.append(line)
+        publish_event("qemu_log", {"vm_id": self.vm_id, "line": line.rstrip('\n')})
+
+    def qmp_execute(self, command, arguments=None):
+        if self.qmp is None:
+            raise QMPError(f"VM {self.vm_id} has no QMP connection")
+        return self.qmp.execute(command, arguments)
+
+    def recent_output(self, count=20):
+        entries, _, _ = self.log_buffer.read(max(self.log_buffer.last_seq() - count, 0))
+        return [line.rstrip('\n') for _, line in entries]
+
+    def status(self):
+        return {
+            "vm_id": self.vm_id,
+            "state": self.state,
+            "running": self.running,
+            "pid": self.process.pid if self.process else None,
+            "vnc_display": self.vnc_display,
+            "vnc_port": 5900 + self.vnc_display if self.vnc_display is not None else None,
+            "ram_mb": self.config.get("ram_mb"),
+            "cores": self.config.get("cores"),
+            "started_at": self.started_at,
+            "exit_code": self.exit_code,
+        }
+
+VMS = {}
+VM_LOCK = threading.RLock()
+
+def get_vm(vm_id):
+    with VM_LOCK:
+        return VMS.get(vm_id)
+
+def stopped_vm_status(vm_id):
+    return {"vm_id": vm_id, "state": "stopped", "running": False}
+
+def parse_vm_id(value):
+    vm_id = str(value or DEFAULT_VM_ID).strip()
+    if not re.fullmatch(r'[a-zA-Z0-9_-]{1,32}', vm_id):
+        raise ValueError("VM id must be 1-32 letters, digits, hyphens or underscores.")
+    return vm_id
+
+# The helpers below must be called with VM_LOCK held so concurrent starts see
+# each other's reservations.
+def check_admission(vm_id, ram_mb, cores):
+    active = [vm for vm in VMS.values() if vm.active and vm.vm_id != vm_id]
+    if len(active) >= MAX_VMS:
+        return f"Maximum number of running VMs reached ({MAX_VMS})."
+    host_cores = psutil.cpu_count(logical=True) or 1
+    reserved_cores = sum(vm.config.get("cores", 0) for vm in active)
+    if reserved_cores + cores > host_cores * VCPU_OVERCOMMIT_RATIO:
+        return f"Not enough host CPU cores: {reserved_cores} of {host_cores} already assigned, {cores} requested."
+    memory = psutil.virtual_memory()
+    total_mb = memory.total // (1024 * 1024)
+    available_mb = memory.available // (1024 * 1024)
+    reserved_mb = sum(vm.config.get("ram_mb", 0) for vm in active)
+    if reserved_mb + ram_mb > total_mb - HOST_RAM_RESERVE_MB:
+        return f"Not enough host RAM: {reserved_mb} MB of {total_mb} MB already assigned, {ram_mb} MB requested."
+    if ram_mb > available_mb - HOST_RAM_RESERVE_MB:
+        return f"Not enough free host RAM: {available_mb} MB available, {ram_mb} MB requested."
+    return None
+
+def allocate_vnc_display():
+    used = set(vm.vnc_display for vm in VMS.values() if vm.active)
+    display = 0
+    while display in used:
+        display += 1
+    return display
+
+def find_disk_owner(vm_id, paths):
+    for vm in VMS.values():
+        if vm.vm_id != vm_id and vm.active and set(paths) & set(vm.config.get("disks", [])):
+            return vm.vm_id
+    return None
 
 # --- Helper function to read process output in real-time ---
-def enqueue_output(out, output_queue):
+def enqueue_output(out, push_line):
     for line in iter(out.readline, ''):
-        output_queue.put(line)
+        push_line(line)
     out.close()
 
 # --- QEMU Process Functions ---
-def run_qemu_in_thread(command_str):
-    global QEMU_PROCESS, QEMU_RUNNING_STATUS
-    print(f"DEBUG(QEMU_THREAD): Attempting to start QEMU with command: {command_str}")
+# Safe to call twice (thread exit and /stop_vm); no-op if a newer start owns the VM.
+def finish_vm(vm, process):
+    with VM_LOCK:
+        if vm.process is not process:
+            return
+        vm.exit_code = process.returncode if process else None
+        vm.process = None
+        if vm.qmp is not None:
+            vm.qmp.close()
+            vm.qmp = None
+        vm.set_state("stopped" if vm.state == "stopping" or vm.exit_code == 0 else "failed")
+
+# Connects to the VM's QMP socket (retrying until QEMU creates it) and waits for
+# query-status to report one of ready_states. False if QEMU exits first.
+def wait_for_qmp_ready(vm, process, ready_states=("running",)):
+    deadline = time.monotonic() + QMP_READY_MAX_SECONDS
+    qmp = QMPClient(vm.qmp_socket_path)
+    while True:
+        if process.poll() is not None or time.monotonic() > deadline:
+            return False
+        try:
+            qmp.connect()
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            time.sleep(0.05)
+        except (OSError, QMPError) as e:
+            vm.push_output(f"ERROR(QMP): connection failed: {e}")
+            return False
+    vm.qmp = qmp
+    try:
+        status = qmp.execute('query-status')["status"]
+        while status not in ready_states:
+            remaining = deadline - time.monotonic()
+            if process.poll() is not None or remaining <= 0:
+                return False
+            qmp.wait_event(("RESUME", "STOP", "SHUTDOWN"), min(remaining, 1.0))
+            status = qmp.execute('query-status')["status"]
+    except QMPError as e:
+        vm.push_output(f"ERROR(QMP): status check failed: {e}")
+        return False
+    return True
+
+def run_qemu_in_thread(vm, command_str):
+    print(f"DEBUG(QEMU_THREAD): [{vm.vm_id}] Attempting to start QEMU with command: {command_str}")
     command_args = command_str.split()
+    ready_event = vm.ready_event
+    process = None
 
     try:
-        QEMU_PROCESS = subprocess.Popen(
+        os.makedirs(QMP_SOCKET_DIR, exist_ok=True)
+        if os.path.exists(vm.qmp_socket_path):
+            os.remove(vm.qmp_socket_path)
+        process = subprocess.Popen(
             command_args,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True,
             bufsize=1
         )
-        QEMU_RUNNING_STATUS = True
-        print(f"DEBUG(QEMU_THREAD): QEMU process started with PID: {QEMU_PROCESS.pid}")
+        vm.process = process
+        vm.started_at = time.time()
+        launched = time.monotonic()
+        print(f"DEBUG(QEMU_THREAD): [{vm.vm_id}] QEMU process started with PID: {process.pid}")
 
-        stdout_reader = threading.Thread(target=enqueue_output, args=(QEMU_PROCESS.stdout, QEMU_OUTPUT_QUEUE))
-        stderr_reader = threading.Thread(target=enqueue_output, args=(QEMU_PROCESS.stderr, QEMU_OUTPUT_QUEUE))
+        stdout_reader = threading.Thread(target=enqueue_output, args=(process.stdout, vm.push_output))
+        stderr_reader = threading.Thread(target=enqueue_output, args=(process.stderr, vm.push_output))
         stdout_reader.daemon = True
         stderr_reader.daemon = True
         stdout_reader.start()
         stderr_reader.start()
-        QEMU_PROCESS.wait()
+        if wait_for_qmp_ready(vm, process):
+            vm.set_state("running")
+            ready_event.set()
+            observe_metric(VM_START_SECONDS, time.monotonic() - launched)
+            print(f"DEBUG(QEMU_THREAD): [{vm.vm_id}] QMP reports the guest is running.")
+        process.wait()
+        stdout_reader.join(timeout=1) # let QEMU's exit message reach the log
+        stderr_reader.join(timeout=1)
     except FileNotFoundError:
         error_msg = f"ERROR(QEMU_THREAD): QEMU executable not found at '{command_args[0]}'. Ensure QEMU is installed and path is correct."
         print(error_msg, file=sys.stderr)
-        QEMU_OUTPUT_QUEUE.put(error_msg)
+        vm.push_output(error_msg)
     except Exception as e:
         error_msg = f"ERROR(QEMU_THREAD): An unexpected error occurred while trying to run QEMU: {e}"
         print(error_msg, file=sys.stderr)
-        QEMU_OUTPUT_QUEUE.put(error_msg)
-    finally:    
-        QEMU_RUNNING_STATUS = False
-        QEMU_PROCESS = None
-        print("DEBUG(QEMU_THREAD): QEMU process has terminated.")
+        vm.push_output(error_msg)
+    finally:
+        finish_vm(vm, process)
+        ready_event.set()
+        print(f"DEBUG(QEMU_THREAD): [{vm.vm_id}] QEMU process has terminated.")
 
 # --- Terminal Command Execution ---
 def run_terminal_command_in_thread(command_string):
-    TERMINAL_OUTPUT_QUEUE.put(f"$ {command_string}\n")
+    push_terminal_output(f"$ {command_string}\n")
     print(f"DEBUG(TERMINAL_THREAD): Executing command: {command_string}")
     try:
         process = subprocess.Popen(
@@ -117,22 +549,128 @@ def run_terminal_command_in_thread(command_string):
             bufsize=1
         )
         for line in iter(process.stdout.readline, ''):
-            TERMINAL_OUTPUT_QUEUE.put(line)
+            push_terminal_output(line)
         process.wait()
-        TERMINAL_OUTPUT_QUEUE.put(f"[Command finished with exit code {process.returncode}]\n")
+        push_terminal_output(f"[Command finished with exit code {process.returncode}]\n")
         print(f"DEBUG(TERMINAL_THREAD): Command finished with exit code {process.returncode}")
     except Exception as e:
         error_msg = f"ERROR(TERMINAL_THREAD): Failed to execute command: {e}\n"
-        TERMINAL_OUTPUT_QUEUE.put(error_msg)
+        push_terminal_output(error_msg)
         print(f"ERROR(TERMINAL_THREAD): {error_msg}", file=sys.stderr)
 
+# --- Page and asset cache ---
+# Pages are compiled and rendered once, then served from memory until the file
+# changes on disk. Static files get strong content ETags, Cache-Control and
+# .br/.gz variants, and are handed to the server by path so servers with
+# wsgi.file_wrapper (gunicorn, uWSGI) use sendfile(). Behind nginx/Apache set
+# ASSET_X_SENDFILE to let the proxy send the file instead.
+ASSET_MAX_AGE_SECONDS = 86400
+ASSET_COMPRESS_MIN_BYTES = 1024
+ASSET_COMPRESSIBLE_EXTENSIONS = ('.js', '.mjs', '.css', '.html', '.svg', '.json', '.map', '.txt')
+ASSET_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".phoenix", "asset-cache")
+ASSET_X_SENDFILE = False
+app.use_x_sendfile = ASSET_X_SENDFILE
+
+PAGE_CACHE = {} # name -> (stat key, body, gzip body, etag)
+ASSET_DIGESTS = {} # path -> (stat key, sha1 hex)
+asset_cache_lock = threading.Lock()
+
+def stat_key(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def accepts_encoding(name):
+    return request.accept_encodings[name] > 0
+
+def load_page(name):
+    path = os.path.join(basedir, name)
+    key = stat_key(path) # FileNotFoundError if missing
+    with asset_cache_lock:
+        cached = PAGE_CACHE.get(name)
+    if cached and cached[0] == key:
+        return cached
+    with open(path, 'r') as f:
+        body = app.jinja_env.from_string(f.read()).render().encode('utf-8')
+    cached = (key, body, gzip.compress(body, 9), '"' + hashlib.sha1(body).hexdigest() + '"')
+    with asset_cache_lock:
+        PAGE_CACHE[name] = cached
+    print(f"DEBUG(ASSETS): Compiled {name} ({len(body)} bytes)")
+    return cached
+
+def serve_page(name):
+    _, body, gzipped, etag = load_page(name)
+    use_gzip = accepts_encoding('gzip')
+    response = Response(gzipped if use_gzip else body, mimetype='text/html')
+    response.set_etag(etag.strip('"') + ('-gz' if use_gzip else ''))
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def asset_digest(path, key):
+    with asset_cache_lock:
+        cached = ASSET_DIGESTS.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    with asset_cache_lock:
+        ASSET_DIGESTS[path] = (key, digest.hexdigest())
+    return digest.hexdigest()
+
+# Prefers a .br/.gz shipped next to the file, otherwise compresses it once
+# into ASSET_CACHE_DIR keyed by content hash. Returns None to send it as-is.
+def compressed_variant(path, digest, encoding, size):
+    suffix = {'br': '.br', 'gzip': '.gz'}[encoding]
+    sibling = path + suffix
+    if os.path.isfile(sibling) and os.path.getmtime(sibling) >= os.path.getmtime(path):
+        return sibling
+    if size < ASSET_COMPRESS_MIN_BYTES or not path.endswith(ASSET_COMPRESSIBLE_EXTENSIONS):
+        return None
+    if encoding == 'br' and brotli is None:
+        return None
+    cached = os.path.join(ASSET_CACHE_DIR, digest + suffix)
+    if not os.path.exists(cached):
+        with open(path, 'rb') as f:
+            data = f.read()
+        data = brotli.compress(data) if encoding == 'br' else gzip.compress(data, 9)
+        os.makedirs(ASSET_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cached}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, cached)
+        print(f"DEBUG(ASSETS): Cached {encoding} copy of {path} ({size} -> {len(data)} bytes)")
+    return cached
+
+def send_asset(directory, filename):
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    key = stat_key(path)
+    digest = asset_digest(path, key)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    for encoding in ('br', 'gzip'):
+        if accepts_encoding(encoding) and request.range is None:
+            variant = compressed_variant(path, digest, encoding, key[1])
+            if variant:
+                response = send_file(variant, mimetype=mimetype, etag=f"{digest}-{encoding}",
+                                     last_modified=key[0] / 1e9, max_age=ASSET_MAX_AGE_SECONDS)
+                response.headers['Content-Encoding'] = encoding
+                response.headers['Vary'] = 'Accept-Encoding'
+                return response
+    response = send_file(path, mimetype=mimetype, etag=digest,
+                         last_modified=key[0] / 1e9, max_age=ASSET_MAX_AGE_SECONDS)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
 # --- Flask Routes ---
 @app.route('/')
 def index():
     try:
-        with open(os.path.join(basedir, 'index.html'), 'r') as f:
-            html_content = f.read()
-        return render_template_string(html_content)
+        return serve_page('index.html')
     except FileNotFoundError:
         return "Error: index.html not found. Make sure it's in the same directory as this script.", 404
 
@@ -142,24 +680,20 @@ def index():
 @app.route('/noVNC/')
 def novnc_index():
     try:
-        with open(os.path.join(basedir, 'vnc.html'), 'r') as f:
-            html_content = f.read()
-        return render_template_string(html_content)
+        return serve_page('vnc.html')
     except FileNotFoundError:
         return "Error: vnc.html not found in directory", 404
 
 @app.route('/noVNC/<path:filename>')
 def novnc_files(filename):
-    return send_from_directory(os.path.join(basedir, ''), filename)
+    return send_asset(basedir, filename)
 
 
 
 @app.route('/terminal')
 def serve_terminal():
     try:
-        with open(os.path.join(basedir, 'terminal.html'), 'r') as f:
-            html_content = f.read()
-        return render_template_string(html_content)
+        return serve_page('terminal.html')
     except FileNotFoundError:
         return "Error: terminal.html not found in directory"
 
@@ -167,17 +701,12 @@ def serve_terminal():
 # --- Fututi icoana si dumnezeul tau mergi fututen gura ---
 @app.route('/start_vm', methods=['POST'])
 def start_vm():
-    """Handles requests to start the QEMU VM with dynamic parameters."""
-    global QEMU_PROCESS, QEMU_RUNNING_STATUS
-
-    if QEMU_PROCESS is not None:
-        print("DEBUG(API): VM is already running, ignoring start request.")
-        return jsonify({"status": "info", "message": "VM is already running."}), 200
-
+    """Handles requests to start a QEMU VM (vm_id, default "default") with dynamic parameters."""
     data = request.get_json()
 
     # --- Extract and Validate Parameters ---
     try:
+        vm_id = parse_vm_id(data.get('vm_id'))
         ram_mb = int(data.get('ram_mb', DEFAULT_RAM_MB))
         cores = int(data.get('cores', DEFAULT_CORES))
         cpu_model = str(data.get('cpu_model', DEFAULT_CPU_MODEL))
@@ -188,6 +717,7 @@ def start_vm():
         primary_disk_path = str(data.get('primary_disk_path', DEFAULT_PRIMARY_DISK_PATH)).strip()
         cdrom_path = str(data.get('cdrom_path', DEFAULT_CDROM_PATH)).strip()
         data_disk_path = str(data.get('data_disk_path', DEFAULT_DATA_DISK_PATH)).strip()
+        start_timeout = float(data.get('start_timeout', QMP_READY_TIMEOUT_SECONDS))
 
     except (ValueError, TypeError) as e:
         error_msg = f"Invalid input for VM parameters: {e}. Please provide valid values."
@@ -199,6 +729,10 @@ def start_vm():
         error_msg = "RAM must be between 512 MB and 32768 MB."
         print(f"ERROR(API): {error_msg}")
         return jsonify({"status": "error", "message": error_msg}), 400
+    if not (0 <= start_timeout <= QMP_READY_MAX_SECONDS):
+        error_msg = f"Start timeout must be between 0 and {QMP_READY_MAX_SECONDS} seconds."
+        print(f"ERROR(API): {error_msg}")
+        return jsonify({"status": "error", "message": error_msg}), 400
     if not (1 <= cores <= 12):
         error_msg = "Cores must be between 1 and 12."
         print(f"ERROR(API): {error_msg}")
@@ -237,6 +771,31 @@ def start_vm():
         print(f"ERROR(API): {error_msg}")
         return jsonify({"status": "error", "message": error_msg}), 400
 
+    # --- Admission control: reserve host resources and a VNC display ---
+    disks = [path for path in (primary_disk_path, data_disk_path) if path]
+    with VM_LOCK:
+        vm = VMS.get(vm_id)
+        if vm is not None and vm.active:
+            print(f"DEBUG(API): VM {vm_id} is already running, ignoring start request.")
+            return jsonify({"status": "info", "message": f"VM {vm_id} is already running."}), 200
+        owner = find_disk_owner(vm_id, disks)
+        if owner:
+            error_msg = f"Disk is already in use by VM {owner}."
+            print(f"ERROR(API): {error_msg}")
+            return jsonify({"status": "error", "message": error_msg}), 409
+        admission_error = check_admission(vm_id, ram_mb, cores)
+        if admission_error:
+            print(f"ERROR(API): {admission_error}")
+            return jsonify({"status": "error", "message": admission_error}), 409
+        if vm is None:
+            vm = VMS[vm_id] = VirtualMachine(vm_id)
+        vm.config = {"ram_mb": ram_mb, "cores": cores, "disks": disks}
+        vm.vnc_display = allocate_vnc_display()
+        vm.exit_code = None
+        vm.ready_event = threading.Event()
+        vm.log_buffer.clear() # clear any previous QEMU logs before starting a new session
+        vm.set_state("starting")
+
     # --- Construct the QEMU Command ---
     qemu_command_parts = [
         BASE_QEMU_COMMAND_TEMPLATE.format(
@@ -248,6 +807,8 @@ def start_vm():
             net_device=net_device
         )
     ]
+    qemu_command_parts.append(f"-vnc :{vm.vnc_display}")
+    qemu_command_parts.append(f"-qmp unix:{vm.qmp_socket_path},server=on,wait=off")
 
     # Add primary disk
     qemu_command_parts.append(
@@ -275,68 +836,102 @@ def start_vm():
     print(f"DEBUG(API): Received request to START VM with config: RAM={ram_mb}MB, Cores={cores}, CPU={cpu_model}, Primary Disk={primary_disk_path}, CD-ROM={cdrom_path}, Data Disk={data_disk_path}, Boot Order={boot_order}, VGA={vga_model}, Net={net_device}")
     print(f"DEBUG(API): Full QEMU command: {dynamic_qemu_command}")
 
-    # Clear any previous QEMU logs before starting a new session
-    while not QEMU_OUTPUT_QUEUE.empty(): QEMU_OUTPUT_QUEUE.get_nowait()
-
     # Start QEMU in a separate thread to keep the Flask app responsive
-    threading.Thread(target=run_qemu_in_thread, args=(dynamic_qemu_command,)).start()
+    threading.Thread(target=run_qemu_in_thread, args=(vm, dynamic_qemu_command)).start()
 
-    time.sleep(3) # Give QEMU a moment to attempt starting
+    # Returns as soon as QMP reports the guest running or QEMU exits, instead of a fixed sleep
+    started = time.monotonic()
+    vm.ready_event.wait(timeout=start_timeout)
+    waited = round(time.monotonic() - started, 3)
+    observe_metric(START_VM_WAIT["running" if vm.running else "starting" if vm.active else "failed"], waited)
 
-    # Check QEMU_RUNNING_STATUS to see if it successfully started
-    if QEMU_RUNNING_STATUS:
-        message = "VM started successfully. Connect your VNC client to 127.0.0.1:5900 (display 0)."
-        status = "success"
+    # Check the VM state to see if it successfully started
+    if vm.running:
+        message = f"VM {vm_id} started successfully in {waited}s. Connect your VNC client to 127.0.0.1:{5900 + vm.vnc_display} (display {vm.vnc_display})."
+        print(f"DEBUG(API): {message}")
+        return jsonify({"status": "success", "message": message, "start_seconds": waited, "vm": vm.status()}), 200
+    elif vm.active:
+        message = f"VM {vm_id} is still starting after {waited}s. Watch /vm_status for progress."
         print(f"DEBUG(API): {message}")
+        return jsonify({"status": "processing", "message": message, "vm": vm.status()}), 202
     else:
-        message = "VM failed to start or encountered an error. Check Termux console or /qemu_logs for details."
-        status = "error"
+        output = vm.recent_output()
+        message = f"VM failed to start: {output[-1] if output else 'check Termux console or /qemu_logs for details.'}"
         print(f"DEBUG(API): {message}")
-
-    return jsonify({"status": status, "message": message}), 200
+        return jsonify({"status": "error", "message": message, "logs": output}), 500
 
 
 
 @app.route('/stop_vm', methods=['POST'])
 def stop_vm():
-    global QEMU_PROCESS
-    if QEMU_PROCESS is not None:
-        try:
-            QEMU_PROCESS.terminate()
-            QEMU_PROCESS.wait(timeout=5)
-        except subprocess.TimeoutExpired:
-            QEMU_PROCESS.kill()
-        except Exception as e:
-            return jsonify({"status": "error", "message": f"Failed to stop VM: {e}"}), 500
-        QEMU_PROCESS = None
-        return jsonify({"status": "success", "message": "VM stopped successfully."}), 200
-    else:
-        return jsonify({"status": "info", "message": "VM is not running."}), 200
+    data = request.get_json(silent=True) or {}
+    try:
+        vm_id = parse_vm_id(data.get('vm_id'))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    with VM_LOCK:
+        vm = VMS.get(vm_id)
+        process = vm.process if vm else None
+        if process is None or vm.state not in ("starting", "running"):
+            return jsonify({"status": "info", "message": "VM is not running."}), 200
+        vm.set_state("stopping")
+    stop_started = time.monotonic()
+    try:
+        process.terminate()
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Failed to stop VM: {e}"}), 500
+    finish_vm(vm, process)
+    observe_metric(VM_STOP_SECONDS, time.monotonic() - stop_started)
+    return jsonify({"status": "success", "message": f"VM {vm_id} stopped successfully."}), 200
+
 
+@app.route('/vms', methods=['GET'])
+def list_vms():
+    with VM_LOCK:
+        return jsonify({"vms": [vm.status() for vm in VMS.values()]}), 200
 
+@app.route('/vms/<vm_id>', methods=['DELETE'])
+def delete_vm(vm_id):
+    with VM_LOCK:
+        vm = VMS.get(vm_id)
+        if vm is None:
+            return jsonify({"status": "error", "message": f"Unknown VM: {vm_id}"}), 404
+        if vm.active:
+            return jsonify({"status": "error", "message": "Stop the VM before removing it."}), 409
+        del VMS[vm_id]
+    return jsonify({"status": "success", "message": f"VM {vm_id} removed."}), 200
 
 @app.route('/vm_status', methods=['GET'])
 def vm_status():
-    global QEMU_RUNNING_STATUS
-    status_text = "running" if QEMU_RUNNING_STATUS else "stopped"
-    return jsonify({"running": QEMU_RUNNING_STATUS}), 200
+    try:
+        vm_id = parse_vm_id(request.args.get('vm_id'))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    vm = get_vm(vm_id)
+    return jsonify(vm.status() if vm else stopped_vm_status(vm_id)), 200
 
  
 @app.route('/qemu_logs', methods=['GET'])
 def qemu_logs():
-    logs = []
-    while True:
-        try:
-            logs.append(QEMU_OUTPUT_QUEUE.get_nowait())
-        except queue.Empty:
-            break
-    if not logs:
+    # ?vm_id=<id>&since=<seq> returns only newer lines; pass back "next" on the following call
+    try:
+        vm_id = parse_vm_id(request.args.get('vm_id'))
+        since, limit = parse_cursor_args()
+    except ValueError as e:
+        return jsonify({"status": "error", "message": f"Invalid parameters: {e}"}), 400
+    vm = get_vm(vm_id)
+    entries, next_cursor, overflow = vm.log_buffer.read(since, limit) if vm else ([], since, False)
+    logs = [line for _, line in entries]
+    if not logs and not since:
         logs.append("No recent QEMU logs captured here.")
-    return jsonify({"logs": logs}), 200
+    return jsonify({"logs": logs, "next": next_cursor, "overflow": overflow}), 200
 
-@app.route('/get_defaults', methods=['GET'])
-def get_defaults():
-    return jsonify({
+def defaults_payload():
+    return {
         "default_primary_disk_path": DEFAULT_PRIMARY_DISK_PATH,
         "default_cdrom_path": DEFAULT_CDROM_PATH,
         "default_data_disk_path": DEFAULT_DATA_DISK_PATH,
@@ -346,7 +941,11 @@ def get_defaults():
         "default_boot_order": DEFAULT_BOOT_ORDER,
         "default_vga_model": DEFAULT_VGA_MODEL,
         "default_net_device": DEFAULT_NET_DEVICE,
-    })
+    }
+
+@app.route('/get_defaults', methods=['GET'])
+def get_defaults():
+    return jsonify(defaults_payload())
 
 @app.route('/run_terminal_command', methods=['POST'])
 def run_terminal_command():
@@ -360,19 +959,160 @@ def run_terminal_command():
 
 @app.route('/get_terminal_output', methods=['GET'])
 def get_terminal_output():
+    try:
+        since, limit = parse_cursor_args()
+    except ValueError as e:
+        return jsonify({"status": "error", "message": f"Invalid cursor: {e}"}), 400
+    entries, next_cursor, overflow = TERMINAL_LOG_BUFFER.read(since, limit)
     output_lines = []
+    for _, line in entries:
+        line_content = line.strip()
+        output_lines.append({"message": line_content, "type": classify_terminal_line(line_content)})
+    return jsonify({"output": output_lines, "next": next_cursor, "overflow": overflow}), 200
+
+# One round-trip for the UI: ?sections=status,logs,terminal,defaults with
+# logs_since / terminal_since cursors. The ETag names the server state, so
+# If-None-Match gets a 304 once the client has caught up, and ?wait=<s> holds
+# the request open until something changes.
+def build_dashboard(vm_id, sections, cursors):
+    vm = get_vm(vm_id)
+    payload, state = {}, {"sections": sections}
+    if "status" in sections:
+        payload["status"] = state["status"] = vm.status() if vm else stopped_vm_status(vm_id)
+    if "logs" in sections and vm is not None:
+        state["logs"] = vm.log_buffer.last_seq()
+        entries, next_cursor, overflow = vm.log_buffer.read(cursors["logs"], LOG_READ_LIMIT)
+        if entries or overflow or next_cursor != cursors["logs"]:
+            payload["logs"] = {"logs": [line for _, line in entries], "next": next_cursor, "overflow": overflow}
+    if "terminal" in sections:
+        state["terminal"] = TERMINAL_LOG_BUFFER.last_seq()
+        entries, next_cursor, overflow = TERMINAL_LOG_BUFFER.read(cursors["terminal"], LOG_READ_LIMIT)
+        if entries or overflow or next_cursor != cursors["terminal"]:
+            output = [{"message": line.strip(), "type": classify_terminal_line(line.strip())} for _, line in entries]
+            payload["terminal"] = {"output": output, "next": next_cursor, "overflow": overflow}
+    if "defaults" in sections:
+        payload["defaults"] = state["defaults"] = defaults_payload()
+    etag = '"' + hashlib.sha1(json.dumps(state, sort_keys=True).encode()).hexdigest()[:24] + '"'
+    return payload, etag
+
+@app.route('/dashboard', methods=['GET'])
+def dashboard():
+    try:
+        vm_id = parse_vm_id(request.args.get('vm_id'))
+        sections = [name.strip() for name in request.args.get('sections', 'status,logs,terminal').split(',') if name.strip()]
+        if set(sections) - {"status", "logs", "terminal", "defaults"}:
+            raise ValueError("sections must be status, logs, terminal or defaults")
+        cursors = {name: int(request.args.get(f'{name}_since', 0)) for name in ("logs", "terminal")}
+        wait = float(request.args.get('wait', 0))
+        if min(cursors.values()) < 0 or not (0 <= wait <= DASHBOARD_MAX_WAIT_SECONDS):
+            raise ValueError(f"cursors must be >= 0 and wait at most {DASHBOARD_MAX_WAIT_SECONDS}s")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": f"Invalid parameters: {e}"}), 400
+
+    if_none_match = request.headers.get('If-None-Match')
+    deadline = time.monotonic() + wait
     while True:
-        try:
-            line_content = TERMINAL_OUTPUT_QUEUE.get_nowait().strip()
-            line_type = 'info'
-            if line_content.startswith('$ '): line_type = 'command'
-            elif line_content.startswith('[Command finished'): line_type = 'status'
-            elif line_content.startswith('ERROR') or line_content.startswith('FATAL ERROR'): line_type = 'error'
-            output_lines.append({"message": line_content, "type": line_type})
-        except queue.Empty:
+        event_cursor = EVENT_BUFFER.last_seq()
+        payload, etag = build_dashboard(vm_id, sections, cursors)
+        unchanged = etag == if_none_match and not ("logs" in payload or "terminal" in payload)
+        remaining = deadline - time.monotonic()
+        if not unchanged or remaining <= 0:
             break
-    return jsonify({"output": output_lines}), 200
+        EVENT_BUFFER.wait(event_cursor, remaining)
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Access-Control-Expose-Headers": "ETag"}
+    if unchanged:
+        return Response(status=304, headers=headers)
+    return jsonify(payload), 200, headers
+
+# Push-based replacement for polling /qemu_logs, /get_terminal_output and /vm_status.
+# Reconnecting clients resume from Last-Event-ID (EventSource sends it automatically)
+# or ?last_event_id=. ?types=qemu_log,terminal,vm_status filters the stream and
+# ?vm_id= limits VM events to one guest.
+@app.route('/events', methods=['GET'])
+def events():
+    try:
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id', 0))
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid last event id."}), 400
+    wanted = set(t.strip() for t in request.args.get('types', '').split(',') if t.strip()) or None
+    vm_filter = request.args.get('vm_id')
+
+    def is_wanted(event_type, data):
+        if wanted is not None and event_type not in wanted:
+            return False
+        return vm_filter is None or data.get("vm_id", vm_filter) == vm_filter
+
+    def generate():
+        cursor = last_id
+        if not cursor: # new subscribers start at the end of the backlog
+            cursor = EVENT_BUFFER.last_seq()
+        yield f"retry: {STREAM_RETRY_MS}\n\n"
+        if wanted is None or "vm_status" in wanted:
+            with VM_LOCK:
+                if vm_filter is not None:
+                    vm = VMS.get(vm_filter)
+                    snapshot = [vm.status() if vm else stopped_vm_status(vm_filter)]
+                else:
+                    snapshot = [vm.status() for vm in VMS.values()]
+            for status in snapshot:
+                yield format_sse("vm_status", status)
+        while True:
+            EVENT_BUFFER.wait(cursor, STREAM_HEARTBEAT_SECONDS)
+            pending, cursor, missed = EVENT_BUFFER.read(cursor)
+            if missed and pending:
+                yield format_sse("overflow", {"resumed_from": pending[0][0]})
+            if not pending:
+                yield ": heartbeat\n\n"
+                continue
+            for event_id, (event_type, data) in pending:
+                if is_wanted(event_type, data):
+                    yield format_sse(event_type, data, event_id)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Prometheus text format. Request metrics carry the Flask route rule (not the raw
+# path) so /vms/<vm_id> stays one series.
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    lines = []
+    def metric(name, kind, help_text, samples):
+        lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"])
+        lines.extend(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}" for labels, value in samples)
+
+    with METRICS_LOCK:
+        lines.extend(["# HELP phoenix_http_request_duration_seconds Time spent handling HTTP requests",
+                      "# TYPE phoenix_http_request_duration_seconds histogram"])
+        for (method, route), histogram in sorted(REQUEST_LATENCY.items()):
+            lines.extend(histogram.exposition("phoenix_http_request_duration_seconds", f'method="{method}",route="{route}"'))
+        metric("phoenix_http_requests_total", "counter", "HTTP requests by route and status",
+               [(f'method="{m}",route="{r}",status="{st}"', n) for (m, r, st), n in sorted(REQUEST_COUNT.items())])
+        metric("phoenix_http_requests_in_flight", "gauge", "HTTP requests currently being handled",
+               [(f'route="{r}"', n) for r, n in sorted(REQUESTS_IN_FLIGHT.items()) if n])
+        for name, histogram, help_text in (("phoenix_vm_start_seconds", VM_START_SECONDS, "Time from launching QEMU until the guest was running"),
+                                           ("phoenix_vm_stop_seconds", VM_STOP_SECONDS, "Time /stop_vm took to stop QEMU")):
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} histogram"])
+            lines.extend(histogram.exposition(name))
+        lines.extend(["# HELP phoenix_start_vm_wait_seconds How long /start_vm held the request, by outcome",
+                      "# TYPE phoenix_start_vm_wait_seconds histogram"])
+        for result, histogram in sorted(START_VM_WAIT.items()):
+            lines.extend(histogram.exposition("phoenix_start_vm_wait_seconds", f'result="{result}"'))
 
+    with VM_LOCK:
+        vms = list(VMS.values())
+    states = collections.Counter(vm.state for vm in vms)
+    metric("phoenix_vms", "gauge", "Registered VMs by state", [(f'state="{st}"', n) for st, n in sorted(states.items())])
+    metric("phoenix_qemu_processes", "gauge", "Live QEMU processes", [("", sum(1 for vm in vms if vm.process))])
+    metric("phoenix_log_buffer_entries", "gauge", "Entries held in the in-memory log buffers",
+           [(f'buffer="qemu",vm_id="{vm.vm_id}"', len(vm.log_buffer)) for vm in vms]
+           + [('buffer="terminal"', len(TERMINAL_LOG_BUFFER)), ('buffer="events"', len(EVENT_BUFFER))])
+    process = psutil.Process()
+    cpu = process.cpu_times()
+    metric("phoenix_threads", "gauge", "Python threads in the server", [("", threading.active_count())])
+    metric("process_resident_memory_bytes", "gauge", "Resident memory of the server process", [("", process.memory_info().rss)])
+    metric("process_cpu_seconds_total", "counter", "CPU time used by the server process", [("", round(cpu.user + cpu.system, 3))])
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
 
 
 if __name__ == '__main__':
@@ -382,4 +1122,4 @@ if __name__ == '__main__':
 
     print(f"DEBUG(MAIN): Flask application directory: {basedir}")
     print(f"DEBUG(MAIN): Flask static files will be served from: {static_folder_path}")
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)